@@ -1,2 +1,3 @@
-from .kmeans import KMeans
+from .kmeans import KMeans, KMeansInit
 from .kmeans1d import KMeans1D
+from .coreset import KMeansCoreset
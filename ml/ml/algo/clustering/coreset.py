@@ -0,0 +1,73 @@
+import math
+
+import torch
+from torch import Tensor
+
+from ml.algo.clustering.kmeans import KMeans
+from ml.utils import Metric
+
+
+class KMeansCoreset:
+    """
+    Weighted coreset built by sensitivity (importance) sampling with respect to a rough k-means solution
+    (Bachem et al., Scalable k-Means Clustering via Lightweight Coresets). Weighted sums over the coreset are
+    unbiased estimates of the same sums over the full data, which makes it a drop-in replacement for fitting
+    mixtures on large point sets.
+    """
+    idx: Tensor = None
+    """Indices of the sampled points of shape (M,)"""
+    weights: Tensor = None
+    """Importance weights of the sampled points of shape (M,), summing to N in expectation"""
+
+    def __init__(
+            self,
+            repr_dim: int, size: int, k: int,
+            metric: Metric = Metric.DOTP,
+            niter: int = 20,
+            gpu: bool = False, verbose: bool = False,
+    ) -> None:
+        super().__init__()
+        self.repr_dim = repr_dim
+        self.size = size
+        self.k = k
+        self.metric = metric
+
+        self.kmeans = KMeans(repr_dim, k, metric=metric, niter=niter, nredo=1, gpu=gpu, verbose=verbose)
+
+    def fit(self, x: Tensor):
+        N = len(x)
+        if N <= self.size:
+            self.idx = torch.arange(N, device=x.device)
+            self.weights = torch.ones(N, dtype=x.dtype, device=x.device)
+            return self
+
+        # Rough solution used to bound the sensitivity of each point. For cosine the points are normalized first,
+        # such that squared euclidean distances are (twice) cosine distances as in the spherical k-means.
+        if self.metric == Metric.COSINE:
+            x = torch.nn.functional.normalize(x, dim=1)
+        z = self.kmeans.fit(x).assign(x).to(x.device)
+        centroids = self.kmeans.get_centroids().to(x.device, x.dtype)
+        d2 = (x - centroids[z]).square().sum(dim=1)
+
+        sizes = torch.zeros(self.k, dtype=x.dtype, device=x.device).index_add_(0, z, torch.ones_like(d2))
+        cost = torch.zeros(self.k, dtype=x.dtype, device=x.device).index_add_(0, z, d2)
+        cost_mean = d2.mean().clamp_min(torch.finfo(x.dtype).eps)
+
+        alpha = 16 * (math.log(self.k) + 2)
+        sensitivity = (
+            alpha * d2 / cost_mean
+            + 2 * alpha * cost[z] / (sizes[z] * cost_mean)
+            + 4 * N / sizes[z]
+        )
+        q = sensitivity / sensitivity.sum()
+
+        # Duplicate draws are merged into a single point with the summed weight
+        draws = torch.multinomial(q, self.size, replacement=True)
+        self.idx, counts = torch.unique(draws, return_counts=True)
+        self.weights = counts.to(x.dtype) / (self.size * q[self.idx])
+
+        return self
+
+    def sample(self, x: Tensor) -> Tensor:
+        assert self.idx is not None, "should fit before sampling"
+        return x[self.idx]
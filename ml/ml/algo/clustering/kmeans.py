@@ -1,3 +1,6 @@
+from enum import Enum
+from typing import Optional, Tuple
+
 import faiss
 import numpy as np
 import torch
@@ -7,10 +10,31 @@ from ml.utils import Metric
 from ml.utils.tensor import ensure_numpy
 
 
+class KMeansInit(Enum):
+    RANDOM = 'random'
+    KMEANSPP = 'kmeans++'
+
+
+def kmeans_pp(x: Tensor, k: int, weights: Tensor = None) -> Tensor:
+    """
+    k-means++ seeding (Arthur & Vassilvitskii). Every next centroid is sampled with probability proportional to the
+    (weighted) squared distance of a point to its nearest centroid chosen so far.
+    """
+    w = weights if weights is not None else torch.ones(len(x), dtype=x.dtype, device=x.device)
+    idx = [int(torch.multinomial(w, 1))]
+    d2 = (x - x[idx[0]]).square().sum(dim=1)
+    for _ in range(1, k):
+        p = w * d2
+        idx.append(int(torch.multinomial(p, 1)) if p.sum() > 0 else int(torch.randint(len(x), (1,))))
+        d2 = torch.minimum(d2, (x - x[idx[-1]]).square().sum(dim=1))
+
+    return x[idx]
+
+
 class KMeans:
     clus: faiss.Clustering
     index: faiss.Index
-    centroids: np.ndarray
+    centroids: Optional[np.ndarray]
 
     def __init__(
             self,
@@ -18,19 +42,36 @@ class KMeans:
             k: int,
             metric: Metric = Metric.DOTP,
             niter: int = 1000, nredo: int = 5,
-            gpu: bool = False, verbose: bool = False
+            gpu: bool = False, verbose: bool = False,
+            max_points_per_centroid: int = 256,
+            init: KMeansInit = KMeansInit.RANDOM,
+            tol: Optional[float] = None,
+            warm_start: bool = False,
     ) -> None:
+        """
+        :param max_points_per_centroid: Centroids are trained on a random subsample of at most this many points per
+            centroid. Assignments are still made for all points
+        :param init: Seeding of the centroids if no initial centroids are given
+        :param tol: Runs Lloyd iterations in torch on the subsample until the relative improvement of the objective
+            drops below tol. Runs all niter faiss iterations if None
+        :param warm_start: Starts from the centroids of the previous fit (if their shape matches)
+        """
         super().__init__()
         self.repr_dim = repr_dim
         self.k = k
         self.gpu = gpu
         self.verbose = verbose
         self.metric = metric
+        self.init = init
+        self.tol = tol
+        self.warm_start = warm_start
+        self.centroids = None
 
         self.params = faiss.ClusteringParameters()
         self.params.niter = niter
         self.params.nredo = nredo
         self.params.verbose = verbose
+        self.params.max_points_per_centroid = max_points_per_centroid
 
         if self.metric == Metric.COSINE:
             self.params.spherical = True
@@ -43,25 +84,107 @@ class KMeans:
         if init_centroids is not None:
             init_centroids = ensure_numpy(init_centroids)
 
-        # Initialize cluster_model
-        self.repr_dim = x.shape[1]
-        self.clus = faiss.Clustering(self.repr_dim, self.k, self.params)
-        if init_centroids is not None:
-            nc, d2 = init_centroids.shape
-            assert d2 == self.repr_dim
-            faiss.copy_array_to_vector(init_centroids.ravel(), self.clus.centroids)
+        # Train on a bounded subsample
+        n_max = self.params.max_points_per_centroid * self.k
+        if len(x) > n_max:
+            idx = ensure_numpy(torch.randperm(len(x))[:n_max])
+            x = x[idx]
+            weights = weights[idx] if weights is not None else None
+
+        if init_centroids is None and self.warm_start and self.centroids is not None \
+                and self.centroids.shape == (self.k, x.shape[1]):
+            init_centroids = self.centroids
 
         # Initialize index
+        self.repr_dim = x.shape[1]
         self.index = faiss.index_factory(self.repr_dim, "Flat", self.metric.faiss_metric())
         if self.gpu:
             self.index = faiss.index_cpu_to_all_gpus(self.index, ngpu=self.gpu)
 
-        # Train KMeans
+        # Faiss redoes random seedings itself, given centroids are only refined once
+        if self.tol is None and (init_centroids is not None or self.init == KMeansInit.RANDOM):
+            self._train(x, weights, init_centroids)
+            return self
+
+        # Seeded fits are redone nredo times keeping the one with the best objective
+        x_t = torch.from_numpy(x)
+        w_t = torch.from_numpy(weights) if weights is not None else None
+        best_obj, best_centroids = None, None
+        for _ in range(1 if init_centroids is not None else self.params.nredo):
+            centroids = torch.from_numpy(init_centroids) if init_centroids is not None else self._seed(x_t, w_t)
+            if self.tol is None:
+                obj = self._train(x, weights, ensure_numpy(centroids))
+                centroids = torch.from_numpy(self.centroids)
+            else:
+                centroids, obj = self._lloyd(x_t, w_t, centroids)
+
+            if best_obj is None or obj < best_obj:
+                best_obj, best_centroids = obj, centroids
+
+        self.centroids = ensure_numpy(best_centroids)
+        return self
+
+    def _seed(self, x: Tensor, weights: Optional[Tensor]) -> Tensor:
+        """
+        Initial centroids of shape (k, D) by k-means++ or uniformly sampled points.
+        """
+        if self.init == KMeansInit.KMEANSPP:
+            x = torch.nn.functional.normalize(x, dim=1) if self.metric == Metric.COSINE else x
+            return kmeans_pp(x, self.k, weights)
+        else:
+            return x[torch.randperm(len(x))[:self.k]]
+
+    def _lloyd(self, x: Tensor, weights: Optional[Tensor], centroids: Tensor) -> Tuple[Tensor, float]:
+        """
+        Weighted Lloyd iterations on the (subsampled) points until the relative improvement of the objective drops
+        below tol, for at most niter iterations. Empty clusters keep their centroid.
+        Returns the centroids and the final objective (lower is better).
+        """
+        w = weights.to(x.dtype) if weights is not None else torch.ones(len(x), dtype=x.dtype)
+        centroids = centroids.to(x.dtype)
+        prev_obj = obj = None
+        for _ in range(self.params.niter):
+            if self.metric == Metric.COSINE:
+                sim, z = (x @ centroids.T).max(dim=1)
+                d = -sim
+            else:
+                d, z = torch.cdist(x, centroids, p=1 if self.metric == Metric.L1 else 2).min(dim=1)
+                d = d if self.metric == Metric.L1 else d.square()
+            obj = float((w * d).sum())
+
+            Ns = torch.zeros(self.k, dtype=x.dtype).index_add_(0, z, w)
+            sums = torch.zeros_like(centroids).index_add_(0, z, w.unsqueeze(1) * x)
+            centroids = torch.where((Ns > 0).unsqueeze(1), sums / Ns.clamp_min(1e-12).unsqueeze(1), centroids)
+            if self.params.spherical:
+                centroids = torch.nn.functional.normalize(centroids, dim=1)
+
+            if prev_obj is not None and abs(prev_obj - obj) <= self.tol * abs(obj):
+                break
+            prev_obj = obj
+
+        return centroids, obj
+
+    def _train(self, x: np.ndarray, weights: Optional[np.ndarray], init_centroids: Optional[np.ndarray]) -> float:
+        """
+        Runs the faiss k-means iterations and returns the final objective (lower is better).
+        """
+        self.clus = faiss.Clustering(self.repr_dim, self.k, self.params)
+        if init_centroids is not None:
+            nc, d2 = init_centroids.shape
+            assert d2 == self.repr_dim
+            self.clus.nredo = 1
+            faiss.copy_array_to_vector(
+                np.ascontiguousarray(init_centroids, dtype=np.float32).ravel(), self.clus.centroids
+            )
+
         self.clus.train(x, self.index, weights)
         centroids = faiss.vector_float_to_array(self.clus.centroids)
         self.centroids = centroids.reshape(self.k, self.repr_dim)
 
-        return self
+        # Faiss reports the summed similarity for inner product indices
+        stats = self.clus.iteration_stats
+        obj = stats.at(stats.size() - 1).obj
+        return -obj if self.metric.faiss_metric() == faiss.METRIC_INNER_PRODUCT else obj
 
     def assign(self, x):
         assert self.centroids is not None, "should train before assigning"
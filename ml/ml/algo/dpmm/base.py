@@ -1,11 +1,15 @@
 from abc import abstractmethod
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Tuple, TypeVar, Generic, List
+from queue import Queue, Empty
+from typing import Any, Tuple, TypeVar, Generic, List, Optional, Iterable
 
+import faiss
 import torch
+import torch.multiprocessing as mp
 from torch import Tensor
 
-from ml.algo.dpmm.statistics import InitMode, GaussianParams
+from ml.algo.dpmm.statistics import InitMode, GaussianParams, block_rows, resp_entropy, Precision
 from ml.utils import Metric, HParams
 
 
@@ -28,6 +32,39 @@ class EMCallback:
     def on_improvement(self, model: 'BaseMixture', params: Any) -> None:
         pass
 
+    def on_restart_step(self, model: 'BaseMixture', restart: int, lower_bound: float, k: int) -> None:
+        """
+        Progress of a restart running in a worker process (see fit with n_jobs > 1), which replaces on_after_step.
+        The model holds the params of the parent, not those of the restart.
+        """
+        pass
+
+
+class EMQueueCallback(EMCallback):
+    """
+    Forwards the progress of a restart running in a worker process to the parent through a queue. Steps only send
+    the lower bound and the number of components, the params of the restart come back with its result.
+    """
+
+    def __init__(self, queue: Queue, restart: int) -> None:
+        super().__init__()
+        self.queue = queue
+        self.restart = restart
+
+    def on_after_step(self, model: 'BaseMixture', lower_bound: Tensor) -> None:
+        self.queue.put((self.restart, float(lower_bound), model.n_components))
+
+
+def _fit_restart(
+    model: 'BaseMixture', X: Tensor, max_iter: int,
+    incremental: bool, initial_params: Any, z_init: Optional[Tensor],
+    seed: int, n_threads: int, callback: EMCallback, weights: Optional[Tensor],
+) -> Tuple[Tensor, Any, int]:
+    torch.manual_seed(seed)
+    torch.set_num_threads(n_threads)
+    faiss.omp_set_num_threads(n_threads)
+    return model._fit_single(X, max_iter, incremental, initial_params, z_init, callback, weights)
+
 
 class EMAggCallback(EMCallback):
     def __init__(self, callbacks: List[EMCallback]) -> None:
@@ -58,6 +95,10 @@ class EMAggCallback(EMCallback):
         for callback in self.callbacks:
             callback.on_improvement(model, params)
 
+    def on_restart_step(self, model: 'BaseMixture', restart: int, lower_bound: float, k: int) -> None:
+        for callback in self.callbacks:
+            callback.on_restart_step(model, restart, lower_bound, k)
+
 
 @dataclass
 class MixtureParams(HParams):
@@ -66,6 +107,17 @@ class MixtureParams(HParams):
     init_mode: InitMode = InitMode.KMEANS
     metric: Metric = Metric.DOTP
     tol: float = 1e-4
+    mem_budget: int = 64
+    """Memory budget (in MB) for the intermediate tensors of a single E-step block."""
+    step_delay: float = 1.0
+    """Delay tau of the stochastic EM step size schedule rho_t = (t + tau)^-kappa"""
+    step_forget: float = 0.7
+    """Forgetting rate kappa in (0.5, 1] of the stochastic EM step size schedule"""
+    precision: Precision = Precision.NATIVE
+    """Precision of the data, statistics and params (e.g. FLOAT64 for numerically hard data)"""
+    estep_precision: Precision = Precision.NATIVE
+    """Precision of the products with the precision matrices in the E-step (e.g. BFLOAT16 for speed). The distances,
+    responsibilities and statistics are still accumulated in the fit precision"""
 
 
 P = TypeVar('P')
@@ -79,17 +131,25 @@ class BaseMixture(Generic[P]):
         self.hparams = hparams
         self.n_components = hparams.init_k
         self.is_fitted = False
+        self.stochastic_steps = 0
+        """Number of stochastic EM steps taken so far, continued by incremental fits (see fit_stochastic)"""
 
     @property
     def inited(self):
         return self.params is not None
 
     @abstractmethod
-    def _init(self, X: Tensor) -> None:
+    def _init(self, X: Tensor, weights: Tensor = None) -> None:
         pass
 
     @abstractmethod
-    def _init_params(self, X: Tensor, z_init: Tensor = None) -> None:
+    def _init_params(self, X: Tensor, z_init: Tensor = None, weights: Tensor = None) -> None:
+        pass
+
+    def _clear_cache(self) -> None:
+        """
+        Drops data derived caches of earlier fits. Called at the start of every fit.
+        """
         pass
 
     def fit(
@@ -99,64 +159,278 @@ class BaseMixture(Generic[P]):
         incremental: bool = False,
         callbacks: List[EMCallback] = None,
         z_init: Tensor = None,
+        n_jobs: int = 1,
+        weights: Tensor = None,
+        keep_prior: bool = False,
     ) -> None:
+        """
+        :param n_jobs: Number of worker processes to run the restarts in parallel. Each worker gets a deterministic
+            seed and an equal share of the intra-op threads. Steps are reported through on_restart_step instead of
+            on_after_step.
+        :param weights: Optional per-point weights of shape (N,), e.g. the importance weights of a coreset. A point
+            with weight w counts as w copies of itself in the prior, the statistics and the lower bound.
+        :param keep_prior: Keep the prior of the previous fit instead of re-estimating it from X (requires
+            incremental), e.g. when X is the next snapshot of the same embedding space
+        """
         assert not incremental or self.params is not None, "Incremental fit requires initialized params"
+        assert not keep_prior or incremental, "Keeping the prior requires an incremental fit"
         callback = EMAggCallback(callbacks or [])
+        X, weights = self._cast(X), self._cast(weights)
 
-        self._init(X)
+        self._clear_cache()
+        if not keep_prior:
+            self._init(X, weights)
         callback.on_after_init(self)
 
         max_lower_bound = -torch.inf
         best_params = None
-        converged = False
 
         initial_params = self._get_params()
-        for i in range(n_init):
-            if incremental:
-                self._set_params(initial_params)
-            else:
-                self._init_params(X, z_init=z_init)
-            callback.on_after_init_params(self)
-
-            lower_bound = -torch.inf
-            j = 0
-            for j in range(1, max_iter + 1):
-                prev_lower_bound = lower_bound
-
-                callback.on_before_step(self)
-                _, log_r = self._e_step(X)
-                self._m_step(X, log_r)
-                lower_bound = self._compute_lower_bound(X, log_r)
-                callback.on_after_step(self, lower_bound)
-
-                change = lower_bound - prev_lower_bound
-                if abs(change) < self.hparams.tol:
-                    converged = self._on_converge(X, log_r)
-                    if converged:
-                        break
-
+        if n_jobs > 1 and n_init > 1:
+            results = self._fit_parallel(
+                X, n_init, max_iter, incremental, initial_params, z_init, callback, n_jobs, weights
+            )
+        else:
+            results = (
+                self._fit_single(X, max_iter, incremental, initial_params, z_init, callback, weights)
+                for _ in range(n_init)
+            )
+
+        for lower_bound, params, j in results:
+            self._set_params(params)
             if lower_bound > max_lower_bound or max_lower_bound == -torch.inf:
                 max_lower_bound = lower_bound
-                best_params = self._get_params()
+                best_params = params
                 callback.on_improvement(self, best_params)
 
-            callback.on_done(self, self._get_params(), j)
+            callback.on_done(self, params, j)
 
         self._set_params(best_params)  # TODO: subcluster params shouldnt count here
         self.is_fitted = True
 
+    def _fit_single(
+        self,
+        X: Tensor, max_iter: int,
+        incremental: bool, initial_params: P, z_init: Optional[Tensor],
+        callback: EMCallback, weights: Optional[Tensor] = None,
+    ) -> Tuple[Tensor, P, int]:
+        """
+        Runs a single EM restart. Returns the final lower bound, the resulting params and the number of iterations.
+        """
+        if incremental:
+            self._set_params(initial_params)
+        else:
+            self._init_params(X, z_init=z_init, weights=weights)
+        callback.on_after_init_params(self)
+
+        lower_bound = -torch.inf
+        j = 0
+        for j in range(1, max_iter + 1):
+            prev_lower_bound = lower_bound
+
+            callback.on_before_step(self)
+            entropy, log_r = self._e_step(X)
+            self._m_step(X, log_r, weights)
+            lower_bound = self._compute_lower_bound(entropy, weights)
+            callback.on_after_step(self, lower_bound)
+
+            change = lower_bound - prev_lower_bound
+            if abs(change) < self.hparams.tol:
+                converged = self._on_converge(X, log_r, weights)
+                if converged:
+                    break
+
+        return lower_bound, self._get_params(), j
+
+    def _fit_parallel(
+        self,
+        X: Tensor, n_init: int, max_iter: int,
+        incremental: bool, initial_params: P, z_init: Optional[Tensor],
+        callback: EMCallback, n_jobs: int, weights: Optional[Tensor] = None,
+    ) -> List[Tuple[Tensor, P, int]]:
+        """
+        Runs the restarts in a pool of worker processes. The progress of every step is reported per restart through
+        on_restart_step, while the params of each restart are only returned once it is done.
+        """
+        ctx = mp.get_context('spawn')
+        seeds = torch.randint(0, 2 ** 31 - 1, (n_init,)).tolist()
+        n_threads = max(1, torch.get_num_threads() // n_jobs)
+
+        with ctx.Manager() as manager, ProcessPoolExecutor(n_jobs, mp_context=ctx) as pool:
+            queue = manager.Queue()
+            futures = [
+                pool.submit(
+                    _fit_restart, self, X, max_iter, incremental, initial_params, z_init,
+                    seeds[i], n_threads, EMQueueCallback(queue, i), weights,
+                )
+                for i in range(n_init)
+            ]
+
+            while not all(future.done() for future in futures) or not queue.empty():
+                try:
+                    restart, lower_bound, k = queue.get(timeout=0.1)
+                except Empty:
+                    continue
+
+                callback.on_restart_step(self, restart, lower_bound, k)
+
+            return [future.result() for future in futures]
+
+    def fit_stochastic(
+        self,
+        batches: Iterable[Tensor],
+        n_samples: int = None,
+        max_iter: int = 100,
+        incremental: bool = False,
+        callbacks: List[EMCallback] = None,
+        keep_prior: bool = False,
+    ) -> None:
+        """
+        Stochastic variational EM over a re-iterable stream of mini-batches (e.g. an EmbeddingsLoader), such that X
+        never has to be materialized. The sufficient statistics of each batch are scaled to the dataset size and
+        interpolated into the running statistics with step size rho_t, after which the posteriors are updated.
+        Each iteration is a full pass over the batches, which stops early once the relative change of the (noisy)
+        lower bound falls below tol. The prior and initial params are estimated from the first batch. Incremental
+        fits continue from the statistics of the current posterior and the step size schedule where the previous fit
+        left off.
+
+        :param n_samples: Total number of points in the stream. Defaults to the size of the loader's dataset.
+        :param keep_prior: Keep the prior of the previous fit instead of re-estimating it (requires incremental)
+        """
+        assert not incremental or self.params is not None, "Incremental fit requires initialized params"
+        assert not keep_prior or incremental, "Keeping the prior requires an incremental fit"
+        callback = EMAggCallback(callbacks or [])
+        n_samples = n_samples if n_samples is not None else len(batches.dataset)
+
+        # The posterior statistics are recovered with the prior they were estimated with
+        stats = self._posterior_stats() if incremental else None
+        self._clear_cache()
+        X_init = self._cast(next(iter(batches))) if not keep_prior else None
+        if not keep_prior:
+            self._init(X_init)
+        callback.on_after_init(self)
+
+        if not incremental:
+            self._init_params(X_init)
+            self.stochastic_steps = 0
+        callback.on_after_init_params(self)
+
+        t = self.stochastic_steps
+        lower_bound = -torch.inf
+        j = 0
+        for j in range(1, max_iter + 1):
+            prev_lower_bound = lower_bound
+
+            callback.on_before_step(self)
+            lower_bounds = []
+            for X_b in batches:
+                X_b = self._cast(X_b)
+                entropy, log_r = self._e_step(X_b)
+                stats_b = self._estimate_stats(X_b, log_r)
+                if stats is None:
+                    stats, rho = stats_b, 1.0
+                else:
+                    rho = (t + self.hparams.step_delay) ** -self.hparams.step_forget
+                stats = self._interpolate_stats(stats, stats_b, rho, n_samples / len(X_b))
+                stats = self._m_step_stats(stats)
+                lower_bounds.append(self._compute_lower_bound(entropy))
+                t += 1
+                self.stochastic_steps = t
+
+            lower_bound = torch.stack(lower_bounds).mean()
+            callback.on_after_step(self, lower_bound)
+
+            # The accumulated statistics already average over the whole pass, so mutations are proposed every pass
+            changed, stats = self._mutate_stats(stats)
+            change = lower_bound - prev_lower_bound
+            if not changed and abs(change) < self.hparams.tol * abs(lower_bound):
+                break
+
+        callback.on_improvement(self, self._get_params())
+        callback.on_done(self, self._get_params(), j)
+        self.is_fitted = True
+
+    @abstractmethod
+    def _estimate_stats(self, X: Tensor, log_r: Any, weights: Tensor = None) -> Any:
+        """
+        Sufficient statistics of a batch given its responsibilities.
+        """
+        pass
+
+    @abstractmethod
+    def _interpolate_stats(self, stats: Any, stats_new: Any, rho: float, scale: float) -> Any:
+        pass
+
+    @abstractmethod
+    def _posterior_stats(self) -> Any:
+        """
+        Sufficient statistics the current posterior was estimated from.
+        """
+        pass
+
+    @abstractmethod
+    def _m_step_stats(self, stats: Any) -> Any:
+        """
+        M-step from the accumulated sufficient statistics. Returns the statistics, which may be restructured
+        if components are added or removed.
+        """
+        pass
+
+    def _mutate_stats(self, stats: Any) -> Tuple[bool, Any]:
+        """
+        Structural changes (e.g. split/merge moves) based on the accumulated statistics after a stochastic pass.
+        """
+        return False, stats
+
     def predict(self, X: Tensor) -> Tensor:
-        return self._estimate_weighted_log_prob(X).argmax(dim=1)
+        z, _ = self.estimate_labels(X)
+        return z
+
+    def _cast(self, X: Optional[Tensor]) -> Optional[Tensor]:
+        """
+        Converts points (or point weights) to the precision of the fit. Params follow the device and dtype of the
+        data they are estimated from.
+        """
+        return X.to(self.hparams.precision.dtype(X.dtype)) if X is not None else None
+
+    def _block_size(self, X: Tensor, k: int = None) -> int:
+        """
+        Number of points per E-step block such that the k x B x D intermediates fit within the memory budget.
+
+        :param k: Number of components scored per point. Defaults to all components
+        """
+        max_numel = self.hparams.mem_budget * 2 ** 20 // X.element_size()
+        return block_rows((k or self.n_components) * (X.shape[1] + 1), max_numel)
+
+    def estimate_labels(self, X: Tensor) -> Tuple[Tensor, Tensor]:
+        """
+        Computes the hard labels and per-point log normalizer block by block without materializing the full
+        N x K log responsibility matrix.
+        """
+        X = self._cast(X)
+        log_weights = self._estimate_log_weights()
+
+        z, log_prob_norm = [], []
+        for X_b in X.split(self._block_size(X)):
+            weighted_log_prob = log_weights + self._estimate_log_prob(X_b)
+            z.append(weighted_log_prob.argmax(dim=1))
+            log_prob_norm.append(torch.logsumexp(weighted_log_prob, dim=1))
+
+        return torch.cat(z), torch.cat(log_prob_norm)
 
     def _e_step(self, X: Tensor) -> Tuple[Tensor, Tensor]:
-        log_prob_norm, log_prob = self._estimate_log_prob_resp(X)
-        return log_prob_norm.mean(), log_prob
+        """
+        Returns the per-point entropy of the responsibilities, which is all the lower bound needs from the data,
+        together with the log responsibilities.
+        """
+        _, log_prob, entropy = self._estimate_log_prob_resp(X)
+        return entropy, log_prob
 
     @abstractmethod
-    def _m_step(self, X: Tensor, log_r: Tensor) -> None:
+    def _m_step(self, X: Tensor, log_r: Tensor, weights: Tensor = None) -> None:
         pass
 
-    def _on_converge(self, X: Tensor, log_r: Tensor) -> bool:
+    def _on_converge(self, X: Tensor, log_r: Tensor, weights: Tensor = None) -> bool:
         return True
 
     def _estimate_weighted_log_prob(self, X: Tensor) -> Tensor:
@@ -170,18 +444,33 @@ class BaseMixture(Generic[P]):
     def _estimate_log_prob(self, X: Tensor) -> Tensor:
         pass
 
-    def _estimate_log_prob_resp(self, X: Tensor) -> Tuple[Tensor, Tensor]:
-        weighted_log_prob = self._estimate_weighted_log_prob(X)
-        log_prob_norm = torch.logsumexp(weighted_log_prob, dim=1)
-        log_resp = weighted_log_prob - log_prob_norm[:, None]
-        return log_prob_norm, log_resp
+    def _estimate_log_prob_resp(self, X: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+        Computes the per-point log normalizer, the log responsibilities and the per-point entropy of the
+        responsibilities in a single blocked pass, such that the lower bound does not have to read them again.
+        """
+        log_weights = self._estimate_log_weights()
+
+        log_prob_norm, log_resp, entropy = [], [], []
+        for X_b in X.split(self._block_size(X)):
+            weighted_log_prob = log_weights + self._estimate_log_prob(X_b)
+            log_prob_norm_b = torch.logsumexp(weighted_log_prob, dim=1)
+            log_resp_b = weighted_log_prob - log_prob_norm_b[:, None]
+            log_prob_norm.append(log_prob_norm_b)
+            log_resp.append(log_resp_b)
+            entropy.append(resp_entropy(log_resp_b))
+
+        return torch.cat(log_prob_norm), torch.cat(log_resp), torch.cat(entropy)
 
     def estimate_log_resp(self, X: Tensor) -> Tensor:
-        log_prob_norm, log_resp = self._estimate_log_prob_resp(X)
+        _, log_resp, _ = self._estimate_log_prob_resp(self._cast(X))
         return log_resp
 
     @abstractmethod
-    def _compute_lower_bound(self, X: Tensor, log_r: Tensor) -> Tensor:
+    def _compute_lower_bound(self, entropy: Tensor, weights: Tensor = None) -> Tensor:
+        """
+        :param entropy: Per-point entropy of the responsibilities as computed by the E-step
+        """
         pass
 
     def _get_params(self) -> P:
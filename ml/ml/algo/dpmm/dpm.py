@@ -1,13 +1,18 @@
+import weakref
 from dataclasses import dataclass
 from pathlib import Path
-from typing import NamedTuple, Optional, Any
+from typing import NamedTuple, Optional, Any, Tuple, Union
 
+import faiss
+import numpy as np
 import torch
 from torch import Tensor
 
 from ml.algo.dpmm.base import BaseMixture, MixtureParams, P
 from ml.algo.dpmm.prior import DirPrior, NWPrior, DirParams, NWParams
-from ml.algo.dpmm.statistics import estimate_gaussian_parameters, initial_assignment, GaussianParams, to_hard_assignment
+from ml.algo.dpmm.statistics import estimate_gaussian_parameters, initial_assignment, GaussianParams, initial_labels, \
+    interpolate_params, CovarianceType, to_full_covs, estimate_gaussian_parameters_sparse, resp_entropy
+from ml.utils import ensure_numpy
 from shared import get_logger
 
 logger = get_logger(Path(__file__).stem)
@@ -18,6 +23,23 @@ class DPMMParams(NamedTuple):
     nw: NWParams
 
 
+class SparseResp(NamedTuple):
+    idx: Tensor
+    """Candidate components of each point of shape (N, m)"""
+    log_r: Tensor
+    """Log responsibilities of the candidates of shape (N, m)"""
+
+    def labels(self) -> Tensor:
+        return self.idx.gather(1, self.log_r.argmax(dim=1, keepdim=True)).squeeze(1)
+
+    def to_dense(self, k: int) -> Tensor:
+        # Non-candidates get a finite floor such that renormalizing rows stays well-defined
+        log_r = torch.full(
+            (len(self.idx), k), torch.finfo(self.log_r.dtype).min, dtype=self.log_r.dtype, device=self.log_r.device
+        )
+        return log_r.scatter(1, self.idx, self.log_r)
+
+
 @dataclass
 class DirichletProcessMixtureParams(MixtureParams):
     prior_alpha: Optional[float] = None
@@ -29,17 +51,34 @@ class DirichletProcessMixtureParams(MixtureParams):
     prior_sigma_scale: float = 1.0
     """The scale parameter for the Wishart distribution"""
     update_hard: bool = True
+    cov_type: CovarianceType = CovarianceType.FULL
+    """Covariance family of the components: full, diag (Normal-Gamma prior), spherical or low-rank plus diagonal"""
+    cov_rank: int = 8
+    """Rank of the low-rank part of low-rank plus diagonal covariances"""
+    top_m: Optional[int] = None
+    """Number of nearest components (by mean) scored per point in the E-step. Scores all components if None"""
 
 
 class DirichletProcessMixture(BaseMixture[DPMMParams]):
     hparams: DirichletProcessMixtureParams
     prior_dir: DirPrior = None
     prior_nw: NWPrior = None
+    X_host: Optional[Tuple[weakref.ref, np.ndarray]] = None
+    """Float32 host copy of the points of the current fit for the faiss index (see _host_points). Cleared every fit"""
 
     def __init__(self, hparams: DirichletProcessMixtureParams) -> None:
         super().__init__(hparams)
 
-    def _init(self, X: Tensor) -> None:
+    def _clear_cache(self) -> None:
+        self.X_host = None
+
+    def __getstate__(self) -> dict:
+        # The host copy of X is a weak reference, which can not be pickled (e.g. for parallel restarts)
+        state = self.__dict__.copy()
+        state.pop('X_host', None)
+        return state
+
+    def _init(self, X: Tensor, weights: Tensor = None) -> None:
         self.hparams.prior_alpha = 1.0 / self.n_components if self.hparams.prior_alpha is None \
             else self.hparams.prior_alpha
         self.prior_dir = DirPrior.from_params(self.hparams.prior_alpha)
@@ -52,28 +91,73 @@ class DirichletProcessMixture(BaseMixture[DPMMParams]):
             self.hparams.prior_nu = D + 1
 
         self.prior_nw = NWPrior.from_data(
-            X, self.hparams.prior_kappa, self.hparams.prior_nu, self.hparams.prior_sigma_scale
+            X, self.hparams.prior_kappa, self.hparams.prior_nu, self.hparams.prior_sigma_scale,
+            self.hparams.cov_type, self.hparams.cov_rank, weights,
         )
 
-    def _init_params(self, X: Tensor, z_init: Tensor = None) -> None:
-        r = initial_assignment(X, self.n_components, self.hparams.init_mode, self.hparams.metric, z_init)
+    def _init_params(self, X: Tensor, z_init: Tensor = None, weights: Tensor = None) -> None:
         if self.hparams.update_hard:
-            r = to_hard_assignment(r)
+            z = initial_labels(X, self.n_components, self.hparams.init_mode, self.hparams.metric, z_init, weights)
+            self._m_step_hard(X, z, self.n_components, weights)
+        else:
+            r = initial_assignment(
+                X, self.n_components, self.hparams.init_mode, self.hparams.metric, z_init, weights
+            )
+            self._update_params(estimate_gaussian_parameters(
+                X, r, self.hparams.reg_cov, weights=weights, cov_type=self.hparams.cov_type
+            ))
 
-        Ns, mus, covs = estimate_gaussian_parameters(X, r, self.hparams.reg_cov)
+    def _m_step(self, X: Tensor, log_r: Tensor, weights: Tensor = None):
+        self._update_params(self._estimate_stats(X, log_r, weights))
 
-        Ns_post = self.prior_dir.estimate_post(Ns)
-        params_post = self.prior_nw.estimate_post(Ns, mus, covs)
-        self._set_params(DPMMParams(Ns_post, params_post))
+    def _estimate_stats(self, X: Tensor, log_r: Tensor, weights: Tensor = None) -> GaussianParams:
+        if isinstance(log_r, SparseResp):
+            return self._estimate_stats_sparse(X, log_r, weights)
+
+        if self.hparams.update_hard:
+            return estimate_gaussian_parameters(
+                X, log_r.argmax(dim=1), self.hparams.reg_cov, weights=weights, k=log_r.shape[1],
+                cov_type=self.hparams.cov_type
+            )
+        else:
+            return estimate_gaussian_parameters(
+                X, log_r.exp(), self.hparams.reg_cov, weights=weights, cov_type=self.hparams.cov_type
+            )
 
-    def _m_step(self, X: Tensor, log_r: Tensor):
+    def _estimate_stats_sparse(self, X: Tensor, log_r: SparseResp, weights: Tensor = None) -> GaussianParams:
         if self.hparams.update_hard:
-            r = to_hard_assignment(log_r)
+            return estimate_gaussian_parameters(
+                X, log_r.labels(), self.hparams.reg_cov, weights=weights, k=self.n_components,
+                cov_type=self.hparams.cov_type
+            )
         else:
-            r = log_r.exp()
+            return estimate_gaussian_parameters_sparse(
+                X, log_r.idx, log_r.log_r.exp(), self.n_components, self.hparams.reg_cov, weights=weights,
+                cov_type=self.hparams.cov_type
+            )
+
+    def _interpolate_stats(
+        self, stats: GaussianParams, stats_new: GaussianParams, rho: float, scale: float
+    ) -> GaussianParams:
+        return interpolate_params(stats, stats_new, rho, scale)
+
+    def _posterior_stats(self) -> GaussianParams:
+        return self.prior_nw.estimate_stats(self.params.nw)
 
-        Ns, mus, covs = estimate_gaussian_parameters(X, r, self.hparams.reg_cov)
+    def _m_step_stats(self, stats: GaussianParams) -> GaussianParams:
+        self._update_params(stats)
+        return stats
 
+    def _m_step_hard(self, X: Tensor, z: Tensor, k: int, weights: Tensor = None) -> None:
+        """
+        M-step from integer labels. Works with O(N) memory as no dense assignment matrix is constructed.
+        """
+        self._update_params(estimate_gaussian_parameters(
+            X, z, self.hparams.reg_cov, weights=weights, k=k, cov_type=self.hparams.cov_type
+        ))
+
+    def _update_params(self, params: GaussianParams) -> None:
+        Ns, mus, covs = params
         Ns_post = self.prior_dir.estimate_post(Ns)
         params_post = self.prior_nw.estimate_post(Ns, mus, covs)
         self._set_params(DPMMParams(Ns_post, params_post))
@@ -82,28 +166,105 @@ class DirichletProcessMixture(BaseMixture[DPMMParams]):
         return self.prior_dir.estimate_log_prob(self.params.dir)
 
     def _estimate_log_prob(self, X: Tensor) -> Tensor:
-        return self.prior_nw.estimate_log_prob(X, self.params.nw)
+        return self.prior_nw.estimate_log_prob(X, self.params.nw, self.hparams.estep_precision.dtype(X.dtype))
+
+    def _estimate_log_prob_resp(self, X: Tensor) -> Tuple[Tensor, Union[Tensor, SparseResp], Tensor]:
+        if self.hparams.top_m is None or self.hparams.top_m >= self.n_components:
+            return super()._estimate_log_prob_resp(X)
+
+        m = self.hparams.top_m
+        log_weights = self._estimate_log_weights()
+        compute_dtype = self.hparams.estep_precision.dtype(X.dtype)
+        index, X_host = self._component_index(X)
+
+        idx, log_prob_norm, log_resp, entropy = [], [], [], []
+        step = self._block_size(X, m)
+        for start in range(0, len(X), step):
+            X_b = X[start:start + step]
+            idx_b = self._nearest_components(X_b, m, index, X_host[start:start + step] if index is not None else None)
+            weighted_log_prob = (
+                log_weights[idx_b]
+                + self.prior_nw.estimate_log_prob_indexed(X_b, idx_b, self.params.nw, compute_dtype)
+            )
+            log_prob_norm_b = torch.logsumexp(weighted_log_prob, dim=1)
+            log_resp_b = weighted_log_prob - log_prob_norm_b[:, None]
+            idx.append(idx_b)
+            log_prob_norm.append(log_prob_norm_b)
+            log_resp.append(log_resp_b)
+            entropy.append(resp_entropy(log_resp_b))
+
+        return torch.cat(log_prob_norm), SparseResp(torch.cat(idx), torch.cat(log_resp)), torch.cat(entropy)
+
+    def _component_index(self, X: Tensor) -> Tuple[Optional[faiss.Index], Optional[np.ndarray]]:
+        """
+        faiss index over the component means, together with the points as a float32 host array to search it with.
+        Points on other devices are searched on their device instead (without an index).
+
+        The components are scored by their Gaussian log-probs, which depend on the Euclidean (Mahalanobis) distance
+        to the means whatever metric the embeddings were trained with. Candidates are therefore retrieved by L2
+        distance, as inner products favour means with a large norm.
+        """
+        if X.device.type != 'cpu':
+            return None, None
+
+        index = faiss.IndexFlatL2(X.shape[1])
+        index.add(np.ascontiguousarray(ensure_numpy(self.params.nw.mus), dtype=np.float32))
+        return index, self._host_points(X)
 
-    def _compute_lower_bound(self, X, log_r) -> Tensor:
+    def _host_points(self, X: Tensor) -> np.ndarray:
+        """
+        Float32 view of the points on the host. Float32 points are not copied. Other points are converted once and
+        reused as long as X is alive, as all E-steps of a fit see the same X.
+        """
+        if X.dtype == torch.float32 and X.is_contiguous():
+            return X.numpy()
+
+        if self.X_host is None or self.X_host[0]() is not X:
+            self.X_host = (weakref.ref(X), np.ascontiguousarray(ensure_numpy(X), dtype=np.float32))
+        return self.X_host[1]
+
+    def _nearest_components(
+        self, X: Tensor, m: int, index: Optional[faiss.Index] = None, X_host: Optional[np.ndarray] = None
+    ) -> Tensor:
+        """
+        Retrieves the m components with the nearest means for each point of a block. Searches the faiss index with
+        the host copy of the block if given, and searches on the device of X otherwise.
+        """
+        if index is not None:
+            _, idx = index.search(X_host, m)
+            return torch.from_numpy(idx)
+
+        # L2 distances, same as the faiss index
+        return torch.cdist(X, self.params.nw.mus).topk(m, dim=1, largest=False).indices
+
+    def estimate_log_resp(self, X: Tensor) -> Tensor:
+        log_resp = super().estimate_log_resp(X)
+        return log_resp.to_dense(self.n_components) if isinstance(log_resp, SparseResp) else log_resp
+
+    def _compute_lower_bound(self, entropy: Tensor, weights: Tensor = None) -> Tensor:
         _, D = self.params.nw.mus.shape
-        log_wishart = self.prior_nw.log_norm(self.params.nw.nus, self.params.nw.Ws, D).sum()
+        log_wishart = self.prior_nw.log_norm(self.params.nw.nus, self.params.nw.Ws_logdet, D).sum()
         log_dir = -self.prior_dir.log_norm(self.params.dir).sum()
 
         return (
-            -torch.sum(log_r.exp() * log_r)
+            (entropy.sum() if weights is None else torch.dot(entropy, weights))
             - log_wishart
             - log_dir
             - 0.5 * D * self.params.nw.kappas.log().sum()
         )
 
     def _set_params(self, params: DPMMParams) -> None:
+        if params is not None:
+            params = DPMMParams(params.dir, params.nw.cached())
         super()._set_params(params)
         if params is not None:
             self.n_components = len(params.nw.mus)
 
     @property
     def cluster_params(self) -> GaussianParams:
-        return GaussianParams(self.params.dir.a - 1, self.params.nw.mus, self.params.nw.covs)
+        return GaussianParams(
+            self.params.dir.a - 1, self.params.nw.mus, to_full_covs(self.params.nw.mus, self.params.nw.covs)
+        )
 
     def _get_params_prior(self) -> Any:
         return (
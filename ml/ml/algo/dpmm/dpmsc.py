@@ -2,18 +2,19 @@ from copy import copy
 from dataclasses import dataclass
 from enum import IntEnum
 from pathlib import Path
-from typing import NamedTuple, List, Tuple, Any
+from typing import NamedTuple, List, Tuple, Any, Optional, Union
 
 import torch
 from torch import Tensor
 
 from ml.algo.dpmm.base import BaseMixture
-from ml.algo.dpmm.dpm import DPMMParams, DirichletProcessMixture, DirichletProcessMixtureParams
+from ml.algo.dpmm.dpm import DPMMParams, DirichletProcessMixture, DirichletProcessMixtureParams, SparseResp
 from ml.algo.dpmm.mh import MetropolisHastings, MHParams
-from ml.algo.dpmm.prior import DirPrior, NWPrior
-from ml.algo.dpmm.statistics import InitMode, estimate_gaussian_parameters, GaussianParams
+from ml.algo.dpmm.stacked import StackedDirichletProcessMixture, map_params
+from ml.algo.dpmm.statistics import InitMode, estimate_gaussian_parameters, GaussianParams, \
+    estimate_gaussian_parameters_segmented, interpolate_params, split_params, merge_params_batched, add_params
 from ml.models.base.base_model import BaseModel
-from ml.utils import unique_count, mask_from_idx
+from ml.utils import unique_count, mask_from_idx, partition_perm
 from ml.utils.training import ClusteringStage
 from shared import get_logger
 
@@ -28,7 +29,38 @@ class Action(IntEnum):
 
 class DPMSCParams(NamedTuple):
     cluster: DPMMParams
-    subcluster: List[DPMMParams]
+    subcluster: DPMMParams
+    """Stacked subcluster params of shape [k, 2, ...]"""
+
+
+class DPMSCStats(NamedTuple):
+    cluster: GaussianParams
+    subcluster: GaussianParams
+    """Stacked subcluster statistics of shape [k, 2, ...]"""
+
+
+class ClusterPartition(NamedTuple):
+    perm: Tensor
+    """Permutation which sorts the points by cluster"""
+    sizes: List[int]
+    """Number of points in each cluster"""
+    X: Tensor
+    """Points sorted by cluster"""
+    z: Tensor
+    """Sorted cluster labels"""
+
+    @property
+    def parts(self) -> List[Tensor]:
+        return list(self.X.split(self.sizes))
+
+    def sort(self, t: Optional[Tensor]) -> Optional[Tensor]:
+        """
+        Orders per-point values (e.g. weights) the same way as X.
+        """
+        return t[self.perm] if t is not None else None
+
+    def split(self, t: Optional[Tensor]) -> Optional[List[Tensor]]:
+        return list(self.sort(t).split(self.sizes)) if t is not None else None
 
 
 @dataclass
@@ -46,83 +78,105 @@ class DPMSC(BaseMixture[DPMSCParams]):
         self.max_sub_reinit = 2
 
         self.clusters = DirichletProcessMixture(hparams)
-        self.subclusters = [
-            self._create_subcluster()
-            for _ in range(self.n_components)
-        ]
+        self.subclusters = self._create_subclusters()
         self.mh = None
-        self.reinit_count = [0 for _ in range(self.n_components)]
+        self.reinit_count = torch.zeros(self.n_components, dtype=torch.long)
         self.prev_action = Action.NoAction
+        self.stats: Optional[DPMSCStats] = None
+        """Sufficient statistics of the last M-step. Invalidated whenever the params are replaced."""
+        self.carry: Optional[DPMSCStats] = None
+        """Statistics of earlier data added to every M-step (see carry_points). Follows the splits and merges."""
 
-    def _create_subcluster(self) -> DirichletProcessMixture:
+    def _create_subclusters(self) -> StackedDirichletProcessMixture:
         hparams = copy(self.hparams)
         hparams.init_k = 2
         hparams.init_mode = InitMode.KMEANS1D
 
-        ret = DirichletProcessMixture(hparams)
-        ret.prior_dir = DirPrior.from_params(1.0 / 2.0)
+        ret = StackedDirichletProcessMixture(hparams, n_subcomponents=2)
         if self.clusters.prior_nw is not None:
             ret.prior_nw = self.clusters.prior_nw
 
         return ret
 
-    def _init(self, X: Tensor) -> None:
-        self.clusters._init(X)
-        for subcluster in self.subclusters:
-            subcluster.prior_dir = DirPrior.from_params(1.0 / 2.0)
-            subcluster.prior_nw = self.clusters.prior_nw
+    def _clear_cache(self) -> None:
+        self.clusters._clear_cache()
+
+    def _init(self, X: Tensor, weights: Tensor = None) -> None:
+        self.carry = None
+        self.clusters._init(X, weights)
+        self.subclusters.prior_nw = self.clusters.prior_nw
 
         self.mh = MetropolisHastings(self.hparams, self.clusters.prior_dir, self.clusters.prior_nw)
 
-    def _init_params(self, X: Tensor, z_init: Tensor = None) -> None:
+    def _init_params(self, X: Tensor, z_init: Tensor = None, weights: Tensor = None) -> None:
         if z_init is not None:
             k = len(torch.unique(z_init))
             if k != self.n_components:
                 self.n_components = k
                 self.clusters.n_components = k
-                self.subclusters = [
-                    self._create_subcluster()
-                    for _ in range(self.n_components)
-                ]
-                self.reinit_count = [0 for _ in range(self.n_components)]
 
-        self.clusters._init_params(X, z_init)
+        self.reinit_count = torch.zeros(self.n_components, dtype=torch.long, device=X.device)
+        self.clusters._init_params(X, z_init, weights)
         z = self.clusters.predict(X)
-        Ns = unique_count(z, self.n_components)
-        for i, subcluster in enumerate(self.subclusters):
-            subcluster._init_params(X[z == i] if Ns[i] > 2 else X)
-
-    def _e_step(self, X: Tensor) -> Tuple[Tuple[Tensor, List[Tensor]], Tuple[Tensor, List[Tensor]]]:
-        log_prob_norm, log_prob = super()._e_step(X)
-        z = log_prob.argmax(dim=1)
-
-        log_prob_norm_sub, log_prob_sub = [], []
-        for i, subcluster in enumerate(self.subclusters):
-            X_i = X[z == i]
-            log_prob_norm_i, log_prob_i = subcluster._e_step(X_i)
-            log_prob_norm_sub.append(log_prob_norm_i)
-            log_prob_sub.append(log_prob_i)
-
-        return (log_prob_norm, log_prob_norm_sub), (log_prob, log_prob_sub)
-
-    def _m_step(self, X: Tensor, log_r: Tuple[Tensor, List[Tensor]]) -> None:
-        log_r, log_r_sub = log_r
-
-        if self._mutate_clean_superclusters(X, log_r):
-            pass
-        else:
-            self.clusters._m_step(X, log_r)
-
-            z = log_r.argmax(dim=1)
-            for i, subcluster in enumerate(self.subclusters):
-                zi = log_r_sub[i].argmax(dim=1)
-                Ns_i = unique_count(zi, 2)
-                if ((Ns_i / Ns_i.sum()) < 0.1).any() and self.reinit_count[i] < self.max_sub_reinit:
-                    logger.warning(f"Encountered a saturated subcluster. Reinitializing.")
-                    subcluster._init_params(X[z == i])
-                    self.reinit_count[i] += 1
-                else:
-                    subcluster._m_step(X[z == i], log_r_sub[i])
+        part = self._partition(X, z)
+        X_parts, W_parts = part.parts, part.split(weights)
+        self.subclusters._init_params(
+            [X_i if len(X_i) > 2 else X for X_i in X_parts],
+            [W_i if len(W_i) > 2 else weights for W_i in W_parts] if weights is not None else None,
+            self.clusters.prior_nw.estimate_stats(self.clusters.params.nw),
+        )
+
+    def _partition(self, X: Tensor, z: Tensor) -> ClusterPartition:
+        """
+        Groups the points by cluster using a single sort. The points of each cluster are contiguous and keep their
+        original order.
+        """
+        perm, sizes = partition_perm(z, self.n_components)
+        return ClusterPartition(perm, sizes, X[perm], z[perm])
+
+    def _e_step(self, X: Tensor) -> Tuple[Tuple[Tensor, Tensor], Tuple[Tensor, Tensor, ClusterPartition]]:
+        entropy, log_prob = super()._e_step(X)
+        part = self._partition(X, log_prob.labels() if isinstance(log_prob, SparseResp) else log_prob.argmax(dim=1))
+        entropy_sub, log_prob_sub = self.subclusters._e_step(part.X, part.z)
+
+        # Subcluster entropies are scattered back to the point order such that they share the weights of the clusters
+        entropy_sub = torch.empty_like(entropy_sub).index_copy_(0, part.perm, entropy_sub)
+
+        return (entropy, entropy_sub), (log_prob, log_prob_sub, part)
+
+    def _m_step(self, X: Tensor, log_r: Tuple[Tensor, Tensor, ClusterPartition], weights: Tensor = None) -> None:
+        log_r, log_r_sub, part = log_r
+        weights_sub = part.sort(weights)
+
+        if self._mutate_clean_superclusters(X, log_r, part, weights):
+            return
+
+        stats = self._add_carry(self._estimate_stats(X, (log_r, log_r_sub, part), weights))
+        self.clusters._update_params(stats.cluster)
+        self.subclusters._set_params(self.subclusters._estimate_post(stats.subcluster))
+
+        Ns_sub = unique_count(
+            part.z * 2 + log_r_sub.argmax(dim=1), self.n_components * 2, weights_sub
+        ).reshape(-1, 2)
+        self.reinit_count = self.reinit_count.to(Ns_sub.device)
+        saturated = ((Ns_sub / Ns_sub.sum(dim=1, keepdim=True)) < 0.1).any(dim=1) \
+            & (self.reinit_count < self.max_sub_reinit)
+        if saturated.any():
+            logger.warning(f"Encountered saturated subclusters. Reinitializing.")
+            idx = saturated.nonzero().flatten()
+            self.subclusters._reinit_params(
+                part.parts, idx, part.split(weights), map_params(lambda t: t[idx], stats.cluster)
+            )
+            self.reinit_count[idx] += 1
+            if self.carry is not None:
+                # The carried subclusters are split again along with them, without data
+                params_split = split_params(map_params(lambda t: t[idx], self.carry.cluster))
+                self.carry = DPMSCStats(
+                    self.carry.cluster,
+                    map_params(lambda t, u: t.index_copy(0, idx, u), self.carry.subcluster, params_split),
+                )
+
+        self.stats = stats
 
     def _estimate_log_weights(self) -> Tensor:
         return self.clusters._estimate_log_weights()
@@ -130,21 +184,27 @@ class DPMSC(BaseMixture[DPMSCParams]):
     def _estimate_log_prob(self, X: Tensor) -> Tensor:
         return self.clusters._estimate_log_prob(X)
 
-    def _compute_lower_bound(self, X, log_r: Tuple[Tensor, List[Tensor]]) -> Tensor:
-        log_r, log_r_sub = log_r
-        z = log_r.argmax(dim=1)
+    def _estimate_log_prob_resp(self, X: Tensor) -> Tuple[Tensor, Union[Tensor, SparseResp], Tensor]:
+        return self.clusters._estimate_log_prob_resp(X)
 
-        lower_bound = self.clusters._compute_lower_bound(X, log_r)
-        for i, subcluster in enumerate(self.subclusters):
-            lower_bound += subcluster._compute_lower_bound(X[z == i], log_r_sub[i])
+    def estimate_log_resp(self, X: Tensor) -> Tensor:
+        return self.clusters.estimate_log_resp(X)
 
-        return lower_bound
+    def _compute_lower_bound(self, entropy: Tuple[Tensor, Tensor], weights: Tensor = None) -> Tensor:
+        entropy, entropy_sub = entropy
+
+        return (
+            self.clusters._compute_lower_bound(entropy, weights)
+            + self.subclusters._compute_lower_bound(entropy_sub, weights)
+        )
 
     def predict_full(self, X: Tensor) -> Tuple[Tensor, Tensor]:
+        X = self._cast(X)
         z = self.predict(X)
+        part = self._partition(X, z)
+
         zi = torch.zeros_like(z)
-        for i, subcluster in enumerate(self.subclusters):
-            zi[z == i] = subcluster.predict(X[z == i])
+        zi[part.perm] = self.subclusters.predict(part.X, part.z)
 
         return z, zi
 
@@ -154,142 +214,129 @@ class DPMSC(BaseMixture[DPMSCParams]):
 
     @property
     def subcluster_params(self) -> List[GaussianParams]:
-        return [cluster.cluster_params for cluster in self.subclusters]
+        params = self.subclusters.cluster_params
+        return [GaussianParams(params.Ns[i], params.mus[i], params.covs[i]) for i in range(self.n_components)]
 
-    def _on_converge(self, X: Tensor, log_r: Tensor) -> bool:
-        log_r, log_r_sub = log_r
-        changed = self._mutate(X, log_r, log_r_sub)
+    def _on_converge(
+        self, X: Tensor, log_r: Tuple[Tensor, Tensor, ClusterPartition], weights: Tensor = None
+    ) -> bool:
+        if self.stats is None:
+            # Clusters were removed during the last M-step, the assignments are stale
+            return False
+
+        log_r, log_r_sub, part = log_r
+        changed = self._mutate(log_r_sub, part, weights)
         print(f'Changed during mutation: {changed}')
         return not changed
 
-    def _mutate(self, X: Tensor, log_r: Tensor, log_r_sub: List[Tensor]) -> bool:
+    def _mutate(self, log_r_sub: Tensor, part: ClusterPartition, weights: Tensor = None) -> bool:
+        """
+        Split/merge moves on the statistics of the last M-step. The data is only revisited to seed the subclusters
+        of newly split clusters.
+        """
         if not self.hparams.mutate:
             return False
 
-        z = log_r.argmax(dim=1)
-        r_hard = torch.zeros_like(log_r)
-        r_hard[torch.arange(len(r_hard)), z] = 1
-        params_cs = estimate_gaussian_parameters(X, r_hard, self.hparams.reg_cov)
-
-        params_scs = []
-        for i in range(self.n_components):
-            r_sub_hard = torch.zeros_like(log_r_sub[i])
-            r_sub_hard[torch.arange(len(r_sub_hard)), log_r_sub[i].argmax(dim=-1)] = 1
-            params_scs.append(estimate_gaussian_parameters(X[z == i], r_sub_hard, self.hparams.reg_cov))
+        stats = self._mutation_stats(log_r_sub, part, weights)
 
         result = False
-        actions = [Action.Split, Action.Merge] if self.prev_action != Action.Split else [Action.Merge, Action.Split]
-        for action in actions:
+        for action in self._mutation_order():
             self.prev_action = action
             if action == Action.Split:
-                result = self._mutate_split(
-                    X, log_r, log_r_sub,
-                    params_cs, params_scs
-                )
+                result = self._mutate_split(stats, log_r_sub, part, weights)
             elif action == Action.Merge:
-                result = self._mutate_merge(
-                    X, log_r, log_r_sub,
-                    params_cs, params_scs
-                )
+                result = self._mutate_merge(stats)
 
             if result:
                 break
 
         return result
 
-    def _mutate_split(
-        self,
-        X: Tensor, log_r: Tensor, log_r_sub: List[Tensor],
-        params_cs: GaussianParams, params_scs: List[GaussianParams]
-    ) -> bool:
-        decisions, Hs = self.mh.propose_splits(params_cs, params_scs)
-        logger.info("Proposed splits: \n{}".format(
-            '\n'.join(map(str, enumerate(zip(decisions.tolist(), Hs.tolist()))))
+    def _mutation_stats(self, log_r_sub: Tensor, part: ClusterPartition, weights: Tensor = None) -> DPMSCStats:
+        """
+        Hard assignment statistics the split/merge proposals are based on. For hard updates these are exactly the
+        statistics of the last M-step.
+        """
+        if self.hparams.update_hard:
+            return self.stats
+
+        weights_sub = part.sort(weights)
+        return self._add_carry(DPMSCStats(
+            estimate_gaussian_parameters(
+                part.X, part.z, self.hparams.reg_cov, weights=weights_sub, k=self.n_components,
+                cov_type=self.hparams.cov_type
+            ),
+            estimate_gaussian_parameters_segmented(
+                part.X, part.z, self.n_components, log_r_sub.argmax(dim=-1), self.hparams.reg_cov,
+                weights=weights_sub, c=2, cov_type=self.hparams.cov_type
+            ),
         ))
 
-        if not decisions.any():
+    def _mutation_order(self) -> List[Action]:
+        return [Action.Split, Action.Merge] if self.prev_action != Action.Split else [Action.Merge, Action.Split]
+
+    def _mutate_split(
+        self, stats: DPMSCStats, log_r_sub: Tensor, part: ClusterPartition, weights: Tensor = None
+    ) -> bool:
+        decisions = self._propose_splits(stats)
+        if decisions is None:
             return False
 
-        # Split superclusters
-        new_log_r = [log_r[:, ~decisions]]
-        for i in decisions.nonzero().flatten():
-            _, log_r_sub_i = self.subclusters[i]._estimate_log_prob_resp(X)
-            new_log_r.append(log_r_sub_i + log_r[:, i][:, None])
-
-        new_log_r = torch.cat(new_log_r, dim=1)
-        self.clusters._m_step(X, new_log_r)
-
-        # Split subclusters
-        z = log_r.argmax(dim=1)
-        self.subclusters = [
-            self.subclusters[i]
-            for i in (~decisions).nonzero().flatten()
-        ]
-        for i in decisions.nonzero().flatten():
-            z_sub = log_r_sub[i].argmax(dim=-1)
-            for j in range(2):
-                X_sub = X[z == i][z_sub == j]
-                subcluster = self._create_subcluster()
-                subcluster._init_params(X_sub)
-                self.subclusters.append(subcluster)
+        # Split superclusters, the subclusters become clusters
+        stats_new = self._split_stats(stats, decisions)
+        self.clusters._update_params(stats_new.cluster)
+        if self.carry is not None:
+            self.carry = self._split_stats(self.carry, decisions)
+
+        # Seed the subclusters of the new clusters from their points
+        X_parts, W_parts, z_subs = part.parts, part.split(weights), log_r_sub.argmax(dim=-1).split(part.sizes)
+        split = [(i, j) for i in decisions.nonzero().flatten().tolist() for j in range(2)]
+        self.subclusters._set_params(StackedDirichletProcessMixture.cat([
+            self.subclusters.select((~decisions).nonzero().flatten()),
+            self.subclusters._init_components(
+                [X_parts[i][z_subs[i] == j] for i, j in split],
+                [W_parts[i][z_subs[i] == j] for i, j in split] if weights is not None else None,
+                map_params(lambda t: t[decisions].flatten(0, 1), stats.subcluster),
+            )
+        ]))
 
         # Ensure that params are up to date
         self._set_params(self._get_params())
-        self.reinit_count = [0 for _ in range(self.n_components)]
+        self.reinit_count = torch.zeros(self.n_components, dtype=torch.long, device=decisions.device)
 
         return True
 
-    def _mutate_merge(
-        self,
-        X: Tensor, log_r: Tensor, log_r_sub: List[Tensor],
-        params_cs: GaussianParams, params_scs: List[GaussianParams]
-    ) -> bool:
-        if self.n_components < 2:
+    def _mutate_merge(self, stats: DPMSCStats) -> bool:
+        pairs = self._propose_merges(stats)
+        if pairs is None:
             return False
 
-        pairs, Hs = self.mh.propose_merges(params_cs)
-        logger.info("Proposed merges: \n{}".format(
-            '\n'.join(map(str, zip(pairs.tolist(), Hs.tolist())))
-        ))
-
-        if len(pairs) == 0:
-            return False
-
-        decisions = mask_from_idx(pairs.flatten(), self.n_components)
-
-        # Merge superclusters
-        new_log_r = [log_r[:, ~decisions]]
-        for pair in pairs:
-            new_log_r.append(log_r[:, pair].sum(dim=1, keepdim=True))
-
-        new_log_r = torch.cat(new_log_r, dim=1)
-        self.clusters._m_step(X, new_log_r)
-
-        # Merge subclusters
-        z = log_r.argmax(dim=1)
-        self.subclusters = [
-            self.subclusters[i]
-            for i in (~decisions).nonzero().flatten()
-        ]
-        for pair in pairs:
-            X_super = X[torch.logical_or(z == pair[0], z == pair[1])]
-            subcluster = self._create_subcluster()
-            subcluster._init_params(X_super)
-            self.subclusters.append(subcluster)
+        # Merged clusters become the subclusters of their union
+        stats_new = self._merge_stats(stats, pairs)
+        self.clusters._update_params(stats_new.cluster)
+        if self.carry is not None:
+            self.carry = self._merge_stats(self.carry, pairs)
+        self.subclusters._set_params(self.subclusters._estimate_post(stats_new.subcluster))
 
         # Ensure that params are up to date
         self._set_params(self._get_params())
-        self.reinit_count = [0 for _ in range(self.n_components)]
+        self.reinit_count = torch.zeros(self.n_components, dtype=torch.long, device=stats_new.cluster.Ns.device)
 
         return True
 
-    def _mutate_clean_superclusters(self, X: Tensor, log_r: Tensor) -> bool:
-        z = log_r.argmax(dim=1)
-        Ns = unique_count(z, self.n_components)
+    def _mutate_clean_superclusters(
+        self, X: Tensor, log_r: Tensor, part: ClusterPartition, weights: Tensor = None
+    ) -> bool:
+        Ns = unique_count(part.z, self.n_components)
+        if self.carry is not None:
+            Ns = Ns + self.carry.cluster.Ns.to(Ns)
 
         if (Ns > 1).all():
             return False
 
+        if isinstance(log_r, SparseResp):
+            log_r = log_r.to_dense(self.n_components)
+
         decisions = (Ns <= 1)
         logger.info(f'Removing empty clusters: \n{decisions.nonzero().flatten().tolist()}')
 
@@ -297,33 +344,196 @@ class DPMSC(BaseMixture[DPMSCParams]):
         new_log_r = log_r[:, ~decisions]
         new_log_r = new_log_r - torch.logsumexp(new_log_r, dim=1)[:, None]
 
-        self.clusters._m_step(X, new_log_r)
+        stats = self.clusters._estimate_stats(X, new_log_r, weights)
+        if self.carry is not None:
+            self.carry = map_params(lambda t: t[~decisions], self.carry)
+            stats = add_params(self.carry.cluster, stats)
+        self.clusters._update_params(stats)
 
         # Remove subclusters
-        self.subclusters = [
-            self.subclusters[i]
-            for i in (~decisions).nonzero().flatten()
-        ]
-        self.reinit_count = [self.reinit_count[i] for i in (~decisions).nonzero().flatten()]
+        self.subclusters._set_params(self.subclusters.select((~decisions).nonzero().flatten()))
+        self.reinit_count = self.reinit_count.to(decisions.device)[~decisions]
 
         # Ensure that params are up to date
         self._set_params(self._get_params())
 
         return True
 
+    def carry_points(self, X: Tensor, decay: float = 1.0) -> None:
+        """
+        Carries the statistics of points that leave the data into the following (incremental) fits, on top of the
+        statistics carried so far. The statistics are estimated under the current params and all carried counts are
+        scaled by decay, once per call. A fit on the remaining and new points then continues from the evidence of the
+        removed points without revisiting them. Decay 0 carries nothing.
+        """
+        if decay <= 0:
+            self.carry = None
+            return
+
+        if len(X) > 0:
+            X = self._cast(X)
+            _, log_r = self._e_step(X)
+            stats = self._estimate_stats(X, log_r)
+            self.carry = self._add_carry(stats)
+
+        if self.carry is not None:
+            self.carry = DPMSCStats(*[GaussianParams(decay * Ns, mus, covs) for Ns, mus, covs in self.carry])
+
+    def _posterior_stats(self) -> DPMSCStats:
+        """
+        Sufficient statistics the current posterior was estimated from.
+        """
+        return DPMSCStats(
+            self.clusters.prior_nw.estimate_stats(self.clusters.params.nw),
+            self.subclusters.prior_nw.estimate_stats(self.subclusters.params.nw),
+        )
+
+    def _add_carry(self, stats: DPMSCStats) -> DPMSCStats:
+        if self.carry is None:
+            return stats
+
+        return DPMSCStats(*[add_params(carry, params) for carry, params in zip(self.carry, stats)])
+
+    def _estimate_stats(
+        self, X: Tensor, log_r: Tuple[Tensor, Tensor, ClusterPartition], weights: Tensor = None
+    ) -> DPMSCStats:
+        log_r, log_r_sub, part = log_r
+        return DPMSCStats(
+            self.clusters._estimate_stats(X, log_r, weights),
+            self.subclusters._estimate_stats(part.X, part.z, self.n_components, log_r_sub, part.sort(weights)),
+        )
+
+    def _interpolate_stats(self, stats: DPMSCStats, stats_new: DPMSCStats, rho: float, scale: float) -> DPMSCStats:
+        return DPMSCStats(
+            interpolate_params(stats.cluster, stats_new.cluster, rho, scale),
+            interpolate_params(stats.subcluster, stats_new.subcluster, rho, scale),
+        )
+
+    def _m_step_stats(self, stats: DPMSCStats) -> DPMSCStats:
+        # Statistics accumulated across batches already stand in for the earlier data
+        self.carry = None
+        Ns = stats.cluster.Ns
+        if (Ns <= 1).any():
+            keep = (Ns > 1).nonzero().flatten()
+            logger.info(f'Removing empty clusters: \n{(Ns <= 1).nonzero().flatten().tolist()}')
+            stats = map_params(lambda t: t[keep], stats)
+            self.reinit_count = self.reinit_count.to(keep.device)[keep]
+
+        # Subclusters are reinitialized from the moments of their cluster as no data is at hand
+        Ns_sub = stats.subcluster.Ns
+        self.reinit_count = self.reinit_count.to(Ns_sub.device)
+        saturated = ((Ns_sub / Ns_sub.sum(dim=1, keepdim=True)) < 0.1).any(dim=1) \
+            & (self.reinit_count < self.max_sub_reinit)
+        if saturated.any():
+            logger.warning(f"Encountered saturated subclusters. Reinitializing.")
+            idx = saturated.nonzero().flatten()
+            params_split = split_params(map_params(lambda t: t[idx], stats.cluster))
+            stats = DPMSCStats(
+                stats.cluster,
+                map_params(lambda t, u: t.index_copy(0, idx, u), stats.subcluster, params_split),
+            )
+            self.reinit_count[idx] += 1
+
+        self.clusters._update_params(stats.cluster)
+        self.subclusters._set_params(self.subclusters._estimate_post(stats.subcluster))
+        self._set_params(self._get_params())
+
+        return stats
+
+    def _mutate_stats(self, stats: DPMSCStats) -> Tuple[bool, DPMSCStats]:
+        """
+        Split/merge moves on the accumulated statistics. Both are data free: a split promotes the subclusters to
+        clusters and splits them along their principal axis, a merge demotes the merged clusters to subclusters.
+        """
+        if not self.hparams.mutate:
+            return False, stats
+
+        stats_new = None
+        for action in self._mutation_order():
+            self.prev_action = action
+            if action == Action.Split:
+                stats_new = self._mutate_split_stats(stats)
+            elif action == Action.Merge:
+                stats_new = self._mutate_merge_stats(stats)
+
+            if stats_new is not None:
+                break
+
+        if stats_new is None:
+            return False, stats
+
+        self.reinit_count = torch.zeros_like(stats_new.cluster.Ns, dtype=torch.long)
+        return True, self._m_step_stats(stats_new)
+
+    def _propose_splits(self, stats: DPMSCStats) -> Optional[Tensor]:
+        decisions, Hs = self.mh.propose_splits(stats.cluster, stats.subcluster)
+        logger.info("Proposed splits: \n{}".format(
+            '\n'.join(map(str, enumerate(zip(decisions.tolist(), Hs.tolist()))))
+        ))
+
+        return decisions if decisions.any() else None
+
+    def _split_stats(self, stats: DPMSCStats, decisions: Tensor) -> DPMSCStats:
+        """
+        Promotes the subclusters of the split clusters to clusters. Their subclusters are split along the principal
+        axis.
+        """
+        keep, split = (~decisions).nonzero().flatten(), decisions.nonzero().flatten()
+        params_split = map_params(lambda t: t[split].flatten(0, 1), stats.subcluster)
+        return DPMSCStats(
+            StackedDirichletProcessMixture.cat([map_params(lambda t: t[keep], stats.cluster), params_split]),
+            StackedDirichletProcessMixture.cat([
+                map_params(lambda t: t[keep], stats.subcluster), split_params(params_split)
+            ]),
+        )
+
+    def _mutate_split_stats(self, stats: DPMSCStats) -> Optional[DPMSCStats]:
+        decisions = self._propose_splits(stats)
+        return self._split_stats(stats, decisions) if decisions is not None else None
+
+    def _propose_merges(self, stats: DPMSCStats) -> Optional[Tensor]:
+        if self.n_components < 2:
+            return None
+
+        pairs, Hs = self.mh.propose_merges(stats.cluster)
+        logger.info("Proposed merges: \n{}".format(
+            '\n'.join(map(str, zip(pairs.tolist(), Hs.tolist())))
+        ))
+
+        return pairs if len(pairs) > 0 else None
+
+    def _mutate_merge_stats(self, stats: DPMSCStats) -> Optional[DPMSCStats]:
+        pairs = self._propose_merges(stats)
+        return self._merge_stats(stats, pairs) if pairs is not None else None
+
+    def _merge_stats(self, stats: DPMSCStats, pairs: Tensor) -> DPMSCStats:
+        """
+        Merges the pairs of clusters. The merged clusters become the subclusters of their union.
+        """
+        keep = (~mask_from_idx(pairs.flatten(), self.n_components)).nonzero().flatten()
+        params_pairs = map_params(lambda t: t[pairs], stats.cluster)
+        return DPMSCStats(
+            StackedDirichletProcessMixture.cat([
+                map_params(lambda t: t[keep], stats.cluster), merge_params_batched(*params_pairs)
+            ]),
+            StackedDirichletProcessMixture.cat([map_params(lambda t: t[keep], stats.subcluster), params_pairs]),
+        )
+
     def _get_params(self) -> DPMSCParams:
         return DPMSCParams(
             self.clusters._get_params(),
-            [subcluster._get_params() for subcluster in self.subclusters]
+            self.subclusters._get_params(),
         )
 
     def _set_params(self, params: DPMSCParams) -> None:
         if params.cluster is not None:
             self.clusters._set_params(params.cluster)
-            for i, subcluster in enumerate(self.subclusters):
-                subcluster._set_params(params.subcluster[i])
+            self.subclusters._set_params(params.subcluster)
+            self.stats = None
             super()._set_params(params)
             self.n_components = self.clusters.n_components
+            if len(self.reinit_count) != self.n_components:
+                self.reinit_count = torch.zeros_like(params.cluster.dir.a, dtype=torch.long)
 
     def _get_params_prior(self) -> Any:
         return self.clusters._get_params_prior()
@@ -331,6 +541,6 @@ class DPMSC(BaseMixture[DPMSCParams]):
     def _set_params_prior(self, params: Any) -> None:
         if params is not None:
             self.clusters._set_params_prior(params)
-            for subcluster in self.subclusters:
-                subcluster.prior_dir = DirPrior.from_params(1.0 / 2.0)
-                subcluster.prior_nw = self.clusters.prior_nw
+            self.subclusters.prior_nw = self.clusters.prior_nw
+            if self.clusters.prior_nw is not None:
+                self.mh = MetropolisHastings(self.hparams, self.clusters.prior_dir, self.clusters.prior_nw)
@@ -2,11 +2,10 @@ from dataclasses import dataclass
 from typing import Tuple, Union, List
 
 import torch
-from sklearn.neighbors import NearestNeighbors
 from torch import Tensor, lgamma
 
 from ml.algo.dpmm.prior import NWPrior, DirPrior
-from ml.algo.dpmm.statistics import GaussianParams, merge_params
+from ml.algo.dpmm.statistics import GaussianParams, merge_params_batched
 from ml.utils import HParams, Metric
 
 SplitDecisions = Union[Tensor, List[bool]]
@@ -27,88 +26,127 @@ class MetropolisHastings:
     prior_dir: DirPrior
     prior_nw: NWPrior
 
-    def compute_log_h_split(self, params_c: GaussianParams, params_sc: GaussianParams) -> Tuple[Tensor, int]:
-        lgamma_N_c = lgamma(params_c.Ns * self.hparams.ds_scale)[0]
+    def compute_log_h_split(self, params_c: GaussianParams, params_sc: GaussianParams) -> Tuple[Tensor, Tensor]:
+        """
+        Computes the log Hastings ratio of splitting clusters into their subclusters. Batched over the leading
+        dimensions: cluster statistics of shape [...] and subcluster statistics of shape [..., 2].
+        """
+        lgamma_N_c = lgamma(params_c.Ns * self.hparams.ds_scale)
         lgamma_N_sc = lgamma(params_sc.Ns * self.hparams.ds_scale)
 
-        log_ll_c = self.prior_nw.estimate_marginal_log_prob(params_c.Ns, params_c.mus, params_c.covs)[0]
+        log_ll_c = self.prior_nw.estimate_marginal_log_prob(params_c.Ns, params_c.mus, params_c.covs)
         log_ll_sc = self.prior_nw.estimate_marginal_log_prob(params_sc.Ns, params_sc.mus, params_sc.covs)
 
         H = (
-            (self.prior_dir.alpha.log() + sum(lgamma_N_sc) + sum(log_ll_sc))
+            (self.prior_dir.alpha.log() + lgamma_N_sc.sum(dim=-1) + log_ll_sc.sum(dim=-1))
             - (lgamma_N_c + log_ll_c)
         )
 
-        return H, log_ll_sc.argmax()
+        return H, log_ll_sc.argmax(dim=-1)
 
-    def check_split(self, params_c: GaussianParams, params_sc: GaussianParams) -> Tuple[Tensor, bool]:
-        if sum(params_c.Ns) < self.hparams.min_split_points + 1:
-            return torch.tensor(-torch.inf), False  # Supercluster is too small
+    @staticmethod
+    def _accept(log_H: Tensor) -> Tensor:
+        # Accept if H > 1 or with probability H
+        return (log_H > 0) | (torch.exp(log_H) > torch.rand(log_H.shape, device=log_H.device))
 
-        if (params_sc.Ns < self.hparams.min_split_points).any():
-            return torch.tensor(-torch.inf), False  # Subclusters are too small
+    def check_splits(self, params_cs: GaussianParams, params_scs: GaussianParams) -> Tuple[Tensor, Tensor]:
+        valid = (
+            (params_cs.Ns >= self.hparams.min_split_points + 1)  # Supercluster is too small
+            & (params_scs.Ns >= self.hparams.min_split_points).all(dim=-1)  # Subclusters are too small
+        )
 
-        log_H, _ = self.compute_log_h_split(params_c, params_sc)
+        log_H, _ = self.compute_log_h_split(params_cs, params_scs)
+        log_H = torch.where(valid, log_H, torch.full_like(log_H, -torch.inf))
 
-        # Accept split if H > 1 or with probability H
-        return log_H, (log_H > 0 or bool(torch.exp(log_H) > torch.rand(1, device=log_H.device)))
+        return log_H, valid & self._accept(log_H)
 
-    def check_merge(self, params_c: GaussianParams, params_sc: GaussianParams) -> Tuple[Tensor, bool, int]:
-        if (params_sc.Ns < 1).any():  # One of the subclusters is empty. Always merge.
-            return torch.tensor(torch.inf), True, params_sc.Ns.argmax()
+    def check_merges(self, params_cs: GaussianParams, params_scs: GaussianParams) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+        Evaluates merging the pairs of clusters params_scs ([p, 2, ...]) into clusters params_cs ([p, ...]).
+        Returns the log Hastings ratios, the accept decisions and the index of the dominant cluster of each pair.
+        """
+        empty = (params_scs.Ns < 1).any(dim=-1)  # One of the subclusters is empty. Always merge.
 
-        # Compute combined cluster center
-        log_H, max_k = self.compute_log_h_split(params_c, params_sc)
-        log_H = -log_H
+        log_H, max_k = self.compute_log_h_split(params_cs, params_scs)
+        log_H = torch.where(empty, torch.full_like(log_H, torch.inf), -log_H)
+        max_k = torch.where(empty, params_scs.Ns.argmax(dim=-1), max_k)
 
-        # Accept merge if H > 1 or with probability H
-        return log_H, (log_H > 0 or bool(torch.exp(log_H) > torch.rand(1, device=log_H.device))), max_k
+        return log_H, empty | self._accept(log_H), max_k
 
     def propose_splits(
-        self, params_cs: GaussianParams, params_scs: List[GaussianParams]
+        self, params_cs: GaussianParams, params_scs: GaussianParams
     ) -> Tuple[SplitDecisions, Tensor]:
-        k = len(params_cs.mus)
-        decisions = torch.zeros(k, dtype=torch.bool)
-        Hs = torch.zeros(k, dtype=torch.float)
-
-        for i in range(k):
-            Hs[i], decisions[i] = self.check_split(
-                GaussianParams(params_cs.Ns[[i]], params_cs.mus[[i]], params_cs.covs[[i]]),
-                params_scs[i],
-            )
+        """
+        Evaluates the split proposals of all clusters in a single batched computation.
 
+        :param params_cs: Cluster statistics of shape [k, ...]
+        :param params_scs: Stacked subcluster statistics of shape [k, 2, ...]
+        """
+        Hs, decisions = self.check_splits(params_cs, params_scs)
         return decisions, Hs
 
     def propose_merges(self, params_cs: GaussianParams) -> Tuple[MergeDecisions, Tensor]:
+        """
+        Evaluates merging each cluster with its nearest neighbors in one batched computation and greedily picks
+        accepted non-overlapping pairs, closest pairs first.
+        """
         k = len(params_cs.mus)
-
-        mus = params_cs.mus.cpu()
-        neigh = NearestNeighbors(
-            n_neighbors=min(self.hparams.n_merge_neighbors, k),
-            metric=self.hparams.metric.sk_metric()
-        )
-        neigh.fit(mus)
-
-        candidates = []
-        Ds, Js = neigh.kneighbors(mus, return_distance=True)
-        for i, (D, J) in enumerate(zip(Ds, Js)):
-            candidates.extend([(d, i, j) for (d, j) in zip(D, J) if j < i])
-        candidates = list(sorted(candidates, key=lambda x: x[0]))
-
-        considered = set()
-        decisions = []
-        Hs = []
-        for (_, i, j) in candidates:
-            if i in considered or j in considered:
-                continue  # Skip if any of the clusters is already considered
-
-            obs_sc = GaussianParams(params_cs.Ns[[i, j]], params_cs.mus[[i, j], :], params_cs.covs[[i, j], :, :])
-            obs_c_new = merge_params(obs_sc.Ns, obs_sc.mus, obs_sc.covs)
-            H, decision, max_k = self.check_merge(obs_c_new, obs_sc)
-
-            if decision:
-                considered.update([i, j])
-                decisions.append((i, j) if max_k == 0 else (j, i))
-                Hs.append(H)
-
-        return torch.tensor(decisions, dtype=torch.long), torch.tensor(Hs, dtype=torch.float)
+        device = params_cs.mus.device
+
+        # Candidate pairs from the nearest neighbor graph over the centroids
+        mus = params_cs.mus
+        dists = self.hparams.metric.pairwise_dist_fn(mus.unsqueeze(1), mus.unsqueeze(0))
+        _, Js = dists.topk(min(self.hparams.n_merge_neighbors, k), dim=1, largest=False)
+        Is = torch.arange(k, device=device).unsqueeze(1).expand_as(Js)
+        keys = torch.minimum(Is, Js) * k + torch.maximum(Is, Js)
+        keys = torch.unique(keys[Is != Js])
+        pairs = torch.stack([keys // k, keys % k], dim=1)
+        if len(pairs) == 0:
+            return torch.zeros(0, 2, dtype=torch.long, device=device), torch.zeros(0, dtype=torch.float, device=device)
+
+        order = torch.sort(dists[pairs[:, 0], pairs[:, 1]], stable=True).indices
+        pairs = pairs[order]
+
+        # Merged statistics of all candidates at once
+        params_scs = GaussianParams(params_cs.Ns[pairs], params_cs.mus[pairs], params_cs.covs[pairs])
+        params_cs_new = merge_params_batched(*params_scs)
+        Hs, accepted, max_k = self.check_merges(params_cs_new, params_scs)
+
+        selected = accepted.nonzero().flatten()
+        selected = selected[self._greedy_matching(pairs[selected], k)]
+
+        pairs = torch.where((max_k[selected] == 0).unsqueeze(1), pairs[selected], pairs[selected].flip(1))
+        return pairs, Hs[selected]
+
+    @staticmethod
+    def _greedy_matching(pairs: Tensor, k: int) -> Tensor:
+        """
+        Greedy matching over pairs ordered by priority. Equivalent to walking the pairs in order and taking each
+        pair whose nodes are both still free, but computed in rounds: each round takes every pair that has the best
+        priority among the remaining pairs of both of its nodes.
+        """
+        P = len(pairs)
+        device = pairs.device
+        rank = torch.arange(P, device=device)
+        active = torch.ones(P, dtype=torch.bool, device=device)
+        selected = torch.zeros(P, dtype=torch.bool, device=device)
+
+        while active.any():
+            idx = active.nonzero().flatten()
+            nodes = pairs[idx].flatten()
+            node_order = torch.sort(nodes, stable=True).indices
+            nodes_sorted = nodes[node_order]
+            first = torch.ones_like(nodes_sorted, dtype=torch.bool)
+            first[1:] = nodes_sorted[1:] != nodes_sorted[:-1]
+
+            best = torch.full((k,), P, dtype=torch.long, device=device)
+            best[nodes_sorted[first]] = rank[idx].repeat_interleave(2)[node_order][first]
+
+            dominant = idx[(best[pairs[idx, 0]] == idx) & (best[pairs[idx, 1]] == idx)]
+            selected[dominant] = True
+
+            used = torch.zeros(k, dtype=torch.bool, device=device)
+            used[pairs[dominant].flatten()] = True
+            active &= ~(used[pairs[:, 0]] | used[pairs[:, 1]])
+
+        return selected
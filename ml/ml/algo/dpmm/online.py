@@ -0,0 +1,175 @@
+from dataclasses import fields
+from pathlib import Path
+from typing import Any, Dict, Tuple, Union
+
+import torch
+from torch import Tensor
+
+from ml.algo.dpmm.dpmsc import DPMSC, DPMSCHParams, DPMSCStats
+from ml.algo.dpmm.statistics import BLOCK_NUMEL, LOG_2PI, GaussianParams, block_rows, estimate_gaussian_log_prob, \
+    add_params
+from shared import get_logger
+
+logger = get_logger(Path(__file__).stem)
+
+
+def cluster_hparams(values: Dict[str, Any]) -> DPMSCHParams:
+    """
+    Decodes the cluster hparams from a (serialized) dict of hparams. Entries of other hparams (e.g. those of the
+    clustering model) are ignored.
+    """
+    names = {f.name for f in fields(DPMSCHParams)}
+    return DPMSCHParams.from_dict({k: v for k, v in values.items() if k in names})
+
+
+class OnlineDPMSC:
+    """
+    Inference engine for a fitted DPMSC. The precision factors, log-weights and normalizers of the clusters are
+    folded into a single dense matrix once, such that assigning a batch of points is one blocked matrix product.
+    New points can optionally be folded into the sufficient statistics of the model (see update).
+    """
+
+    def __init__(
+            self,
+            model: DPMSC,
+            mutate_every: int = 10,
+            decay: float = 1.0,
+            max_numel: int = BLOCK_NUMEL,
+    ) -> None:
+        """
+        :param mutate_every: Number of updates between split/merge tests on the accumulated statistics
+        :param decay: Weight of the accumulated statistics before each update. Values below 1 forget old points
+        :param max_numel: Maximum number of elements of the intermediates allocated per block of points
+        """
+        super().__init__()
+        self.model = model
+        self.mutate_every = mutate_every
+        self.decay = decay
+        self.max_numel = max_numel
+
+        self.stats: DPMSCStats = None
+        self.n_updates = 0
+        self._cache()
+
+    @staticmethod
+    def from_state(state: Dict[str, Any], hparams: DPMSCHParams = None, **kwargs) -> 'OnlineDPMSC':
+        """
+        Builds the engine from the extra state of a clustering model checkpoint (cluster hparams, params and prior).
+
+        :param hparams: Overrides the cluster hparams stored in the state
+        """
+        if hparams is None:
+            hparams = cluster_hparams(state.get('cluster_hparams', {}))
+        model = DPMSC(hparams)
+        model._set_params_prior(state['cluster_prior'])
+        model._set_params(state['cluster_params'])
+        model.is_fitted = True
+
+        return OnlineDPMSC(model, **kwargs)
+
+    @staticmethod
+    def from_checkpoint(path: Union[str, Path], hparams: DPMSCHParams = None, **kwargs) -> 'OnlineDPMSC':
+        """
+        Loads the engine from a Lightning checkpoint without instantiating the Lightning module. Checkpoints without
+        cluster hparams in their extra state fall back to the hyperparameters of the module.
+        """
+        checkpoint = torch.load(path, map_location='cpu')
+        state = checkpoint['state_dict']['_extra_state']
+        if hparams is None and 'cluster_hparams' not in state:
+            hparams = cluster_hparams(checkpoint.get('hyper_parameters', {}))
+        return OnlineDPMSC.from_state(state, hparams, **kwargs)
+
+    @property
+    def n_components(self) -> int:
+        return self.model.n_components
+
+    def _cache(self) -> None:
+        clusters = self.model.clusters
+        nw = clusters.params.nw.cached()
+        k, D = nw.mus.shape
+
+        self.nw = nw
+        self.log_bias = clusters._estimate_log_weights() + clusters.prior_nw._log_prob_offset(nw, D)
+        if nw.Ws_lowrank is not None:
+            # Low-rank corrections don't fold into a single product, these use the generic blocked estimate
+            self.W, self.b = None, None
+            self.row_numel = k * D
+            return
+
+        self.log_bias = self.log_bias + nw.Ws_logdet - 0.5 * D * LOG_2PI
+        if nw.Ws.dim() == 3:
+            # Block j of X @ W equals X @ Ws[j]
+            self.W = nw.Ws.permute(1, 0, 2).reshape(D, k * D)
+            self.b = torch.bmm(nw.mus.unsqueeze(1), nw.Ws).reshape(k * D)
+            self.row_numel = k * D
+        else:
+            # Expanded squared distances: [X^2, X] @ W, the constant term is folded into the bias
+            prec_sq = nw.Ws.square().expand_as(nw.mus)
+            self.W = torch.cat([prec_sq, -2 * nw.mus * prec_sq], dim=1).T
+            self.b = None
+            self.log_bias = self.log_bias - 0.5 * (nw.mus.square() * prec_sq).sum(dim=-1)
+            self.row_numel = 2 * D + k
+
+    def estimate_log_prob(self, X: Tensor) -> Tensor:
+        """
+        Joint log probabilities log p(x, z) of a block of points under each cluster of shape (N, k).
+        """
+        k, D = self.nw.mus.shape
+        if self.W is None:
+            return estimate_gaussian_log_prob(
+                X, self.nw.mus, self.nw.Ws, self.nw.Ws_logdet, self.max_numel, self.nw.Ws_lowrank,
+            ) + self.log_bias
+        elif self.b is not None:
+            M = (X @ self.W - self.b).square().reshape(len(X), k, D).sum(dim=-1)
+        else:
+            M = torch.cat([X.square(), X], dim=1) @ self.W
+
+        return self.log_bias - 0.5 * M
+
+    def assign(self, X: Tensor) -> Tuple[Tensor, Tensor]:
+        """
+        Assigns the points to their most likely cluster. Returns the labels and the log-likelihood of each point
+        under the mixture. At most max_numel intermediate elements are allocated at once.
+        """
+        X = X.to(self.nw.mus)
+        z = torch.empty(len(X), dtype=torch.long, device=X.device)
+        log_prob = torch.empty(len(X), dtype=X.dtype, device=X.device)
+
+        step = block_rows(self.row_numel, self.max_numel)
+        for start in range(0, len(X), step):
+            log_joint = self.estimate_log_prob(X[start:start + step])
+            z[start:start + step] = log_joint.argmax(dim=1)
+            log_prob[start:start + step] = torch.logsumexp(log_joint, dim=1)
+
+        return z, log_prob
+
+    def update(self, X: Tensor, weights: Tensor = None) -> bool:
+        """
+        Folds a batch of new points into the sufficient statistics and refreshes the posterior. Split/merge moves
+        are tested on the accumulated statistics every mutate_every updates. Returns whether the clusters changed.
+        """
+        model = self.model
+        X, weights = model._cast(X.to(self.nw.mus.device)), model._cast(weights)
+        k = model.n_components
+        if self.stats is None:
+            self.stats = model._posterior_stats()
+
+        _, log_r = model._e_step(X)
+        stats = DPMSCStats(*[
+            self._accumulate(params, params_new)
+            for params, params_new in zip(self.stats, model._estimate_stats(X, log_r, weights))
+        ])
+        stats = model._m_step_stats(stats)
+
+        self.n_updates += 1
+        if self.mutate_every > 0 and self.n_updates % self.mutate_every == 0:
+            _, stats = model._mutate_stats(stats)
+
+        self.stats = stats
+        self._cache()
+
+        return model.n_components != k
+
+    def _accumulate(self, params: GaussianParams, params_new: GaussianParams) -> GaussianParams:
+        Ns, mus, covs = params
+        return add_params(GaussianParams(self.decay * Ns, mus, covs), params_new)
@@ -3,13 +3,13 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import NamedTuple, Tuple
 
-import numpy as np
 import torch
 from torch import Tensor, lgamma, mvlgamma, digamma
 from typing_extensions import Self
 
-from ml.algo.dpmm.statistics import estimate_gaussian_log_prob, covs_to_prec
-from ml.utils import batchwise_outer
+from ml.algo.dpmm.statistics import estimate_gaussian_log_prob, estimate_gaussian_log_prob_segmented, \
+    estimate_gaussian_log_prob_indexed, covs_to_chol_prec, chol_log_det, CovarianceType, mean_outer, GaussianParams, \
+    EPS
 from shared import get_logger
 
 logger = get_logger(Path(__file__).stem)
@@ -19,6 +19,9 @@ class DirParams(NamedTuple):
     a: Tensor
     b: Tensor
 
+    def __getitem__(self, item):
+        return DirParams(self.a[item], self.b[item])
+
 
 @dataclass
 class DirPrior:
@@ -31,7 +34,8 @@ class DirPrior:
 
     @staticmethod
     def from_params(alpha: float) -> Self:
-        return DirPrior(torch.tensor(alpha))
+        # A double precision scalar does not promote the dtype of the statistics it is combined with
+        return DirPrior(torch.tensor(alpha, dtype=torch.float64))
 
     @staticmethod
     def log_norm(params: DirParams) -> Tensor:
@@ -40,10 +44,12 @@ class DirPrior:
     def estimate_post(self, Ns: Tensor) -> DirParams:
         """
         Estimate concentration parameter of the Dirichlet distribution.
+        Components are laid out along the last dimension, leading dimensions are treated as a batch.
         """
+        Ns_tail = Ns.flip(-1).cumsum(dim=-1).flip(-1)[..., 1:]
         return DirParams(
             1.0 + Ns,
-            self.alpha + torch.tensor(np.hstack([np.cumsum(Ns.numpy()[::-1])[-2::-1], 0.0]), dtype=torch.float)
+            self.alpha + torch.cat([Ns_tail, torch.zeros_like(Ns[..., :1])], dim=-1)
         )
 
     @staticmethod
@@ -52,9 +58,10 @@ class DirPrior:
         digamma_sum = torch.digamma(params.a + params.b)
         digamma_a = torch.digamma(params.a)
         digamma_b = torch.digamma(params.b)
+        digamma_b_cum = torch.cumsum(digamma_b - digamma_sum, dim=-1)
         return (
             digamma_a - digamma_sum +
-            torch.hstack((torch.tensor(0.0), torch.cumsum(digamma_b - digamma_sum, dim=0)[:-1]))
+            torch.cat([torch.zeros_like(digamma_b_cum[..., :1]), digamma_b_cum[..., :-1]], dim=-1)
         )
 
     def get_params(self) -> Tuple[float]:
@@ -66,10 +73,27 @@ class NWParams(NamedTuple):
     kappas: Tensor
     nus: Tensor
     Ws: Tensor
+    """Cholesky factors of the precision matrices"""
     covs: Tensor
+    covs_chol: Tensor = None
+    """Cholesky factors of the covariance matrices"""
+    Ws_logdet: Tensor = None
+    """Log-determinants of the precision factors Ws (equals -0.5 * logdet(covs))"""
+    Ws_lowrank: Tensor = None
+    """Low-rank correction A of diagonal precision factors Ws: precision = diag(Ws)^2 - A A^T"""
 
     def __getitem__(self, item):
-        return NWParams(self.mus[item], self.kappas[item], self.nus[item], self.Ws[item], self.covs[item])
+        return NWParams(*[f[item] if f is not None else None for f in self])
+
+    def cached(self) -> 'NWParams':
+        """
+        Fills in the cached factorizations if they are missing (e.g. params loaded from older checkpoints).
+        """
+        if self.Ws_logdet is not None:
+            return self
+
+        covs_chol = torch.linalg.cholesky(self.covs)
+        return self._replace(covs_chol=covs_chol, Ws_logdet=-chol_log_det(covs_chol))
 
 
 @dataclass
@@ -85,78 +109,211 @@ class NWPrior:
     """Degrees of freedom of the Wishart distribution."""
     W_inv: Tensor
     """Inverse of the scale matrix of the Wishart distribution. (covariance matrix)"""
+    W_inv_logdet: Tensor = None
+    """Log-determinant of W_inv. Computed once on construction."""
+    cov_type: CovarianceType = CovarianceType.FULL
+    """Covariance family. For diagonal and spherical covariances the Wishart reduces to a Gamma per dimension
+    (a Normal-Gamma prior) and W_inv is stored as a vector."""
+    rank: int = None
+    """Rank of the low-rank part of low-rank plus diagonal covariances"""
+
+    def __post_init__(self):
+        if self.W_inv_logdet is None:
+            self.W_inv_logdet = self.W_inv.logdet() if self.cov_type.is_matrix \
+                else self.W_inv.log().expand_as(self.mu_0).sum()
 
     @staticmethod
-    def from_data(X: Tensor, kappa: float, nu: float, prior_cov_scale: float = 1.0) -> Self:
+    def from_data(
+        X: Tensor, kappa: float, nu: float, prior_cov_scale: float = 1.0,
+        cov_type: CovarianceType = CovarianceType.FULL, rank: int = None,
+        weights: Tensor = None,
+    ) -> Self:
         assert prior_cov_scale > 0, 'prior_cov_scale must be positive'
 
-        mu, cov = torch.mean(X, dim=0), torch.diag(torch.std(X, dim=0))  # torch.cov(X.T)
+        if weights is None:
+            mu, std = torch.mean(X, dim=0), torch.std(X, dim=0)  # torch.cov(X.T)
+        else:
+            w = weights[:, None] / weights.sum()
+            mu = (w * X).sum(dim=0)
+            std = (w * (X - mu).square()).sum(dim=0).sqrt()
+        if cov_type.is_matrix:
+            cov = torch.diag(std)
+        elif cov_type == CovarianceType.DIAG:
+            cov = std
+        else:
+            cov = std.mean(dim=0, keepdim=True)
+
         return NWPrior.from_params(
-            kappa, nu, mu, cov * prior_cov_scale
+            kappa, nu, mu, cov * prior_cov_scale, cov_type, rank
         )
 
     @staticmethod
-    def from_params(kappa: float, nu: float, mu: Tensor, cov: Tensor) -> Self:
+    def from_params(
+        kappa: float, nu: float, mu: Tensor, cov: Tensor,
+        cov_type: CovarianceType = CovarianceType.FULL, rank: int = None,
+    ) -> Self:
         assert kappa > 0, 'kappa must be positive'
         assert nu >= mu.shape[0] + 1, 'nu must be larger or equal to D + 1'
+        assert cov_type != CovarianceType.LOWRANK or 0 < rank < mu.shape[0], 'rank must be in [1, D)'
 
-        return NWPrior(mu, torch.tensor(kappa), torch.tensor(nu), cov)
+        return NWPrior(
+            mu, mu.new_tensor(kappa), mu.new_tensor(nu), cov.to(mu.dtype), cov_type=cov_type, rank=rank
+        )
 
-    @staticmethod
-    def log_norm(nu: Tensor, W: Tensor, D: int) -> Tensor:
+    def _mvlgamma(self, x: Tensor, D: int) -> Tensor:
+        # Product of independent Gammas instead of a Wishart for diagonal covariances
+        return mvlgamma(x, D) if self.cov_type.is_matrix else lgamma(x) * D
+
+    def log_norm(self, nu: Tensor, W_logdet: Tensor, D: int) -> Tensor:
         return -(
-            (W.logdet() - 0.5 * D * nu.log()) * nu
-            + np.log(2) * (nu * D / 2)
-            + mvlgamma(nu / 2, D)
+            (W_logdet - 0.5 * D * nu.log()) * nu
+            + math.log(2) * (nu * D / 2)
+            + self._mvlgamma(nu / 2, D)
         )
 
     def estimate_post(self, Ns: Tensor, mus: Tensor, covs: Tensor) -> NWParams:
-        _, D = mus.shape
+        # Leading dimensions of the statistics are treated as a batch (e.g. [k] or [k, 2] for subclusters)
+        D = mus.shape[-1]
         kappas_k = self.kappa + Ns
         nus_k = self.nu + Ns
-        mus_k = (self.kappa * self.mu_0 + Ns[:, None] * mus) / kappas_k[:, None]
+        mus_k = (self.kappa * self.mu_0 + Ns[..., None] * mus) / kappas_k[..., None]
 
-        diff = mus_k - self.mu_0[None, :]
+        diff = mus_k - self.mu_0
+        n = covs.dim() - Ns.dim()  # Number of dimensions of a single covariance
         covs_k = (
-                     self.W_inv[None, :, :]
-                     + Ns[:, None, None] * covs
-                     + ((self.kappa * Ns) / kappas_k)[:, None, None]
-                     * batchwise_outer(diff, diff)
-                 ) / (nus_k[:, None, None] + D + 2)  # TODO: check whether D + 2 is fine
-        Ws_k = covs_to_prec(covs_k)
+                     self.W_inv
+                     + Ns.reshape(*Ns.shape, *[1] * n) * covs
+                     + ((self.kappa * Ns) / kappas_k).reshape(*Ns.shape, *[1] * n)
+                     * mean_outer(diff, covs)
+                 ) / (nus_k.reshape(*Ns.shape, *[1] * n) + D + 2)  # TODO: check whether D + 2 is fine
+
+        if self.cov_type == CovarianceType.LOWRANK:
+            return NWParams(mus_k, kappas_k, nus_k, *self._lowrank_factors(covs_k))
+        elif not self.cov_type.is_matrix:
+            Ws_k = covs_k.rsqrt()
+            return NWParams(
+                mus_k, kappas_k, nus_k, Ws_k, covs_k, covs_k.sqrt(), Ws_k.log().expand_as(mus_k).sum(dim=-1)
+            )
+
+        covs_chol_k, Ws_k = covs_to_chol_prec(covs_k)
+        return NWParams(mus_k, kappas_k, nus_k, Ws_k, covs_k, covs_chol_k, -chol_log_det(covs_chol_k))
+
+    def estimate_stats(self, params: NWParams) -> GaussianParams:
+        """
+        Inverse of estimate_post. Recovers the statistics (Ns, mus, covs) the posterior params were estimated from.
+        """
+        D = params.mus.shape[-1]
+        Ns = (params.kappas - self.kappa).clamp_min(EPS)
+        mus = (params.kappas[..., None] * params.mus - self.kappa * self.mu_0) / Ns[..., None]
 
-        return NWParams(mus_k, kappas_k, nus_k, Ws_k, covs_k)
+        diff = params.mus - self.mu_0
+        n = params.covs.dim() - Ns.dim()  # Number of dimensions of a single covariance
+        covs = (
+                   params.covs * (params.nus.reshape(*Ns.shape, *[1] * n) + D + 2)
+                   - self.W_inv
+                   - ((self.kappa * Ns) / params.kappas).reshape(*Ns.shape, *[1] * n) * mean_outer(diff, params.covs)
+               ) / Ns.reshape(*Ns.shape, *[1] * n)
 
-    @staticmethod
-    def estimate_log_prob(X: Tensor, params: NWParams) -> Tensor:
+        return GaussianParams(Ns, mus, covs)
+
+    def _lowrank_factors(self, covs: Tensor) -> Tuple[Tensor, Tensor, None, Tensor, Tensor]:
+        """
+        Approximates the covariances by U U^T + diag(psi), keeping the top rank eigen directions and the exact
+        diagonal. Returns the diagonal precision factors, the approximated covariances, the log-determinants of
+        the precision factors and the low-rank precision correction (Woodbury identity).
+        """
+        D = covs.shape[-1]
+        eigvals, eigvecs = torch.linalg.eigh(covs)
+        sigma2 = eigvals[..., :D - self.rank].mean(dim=-1, keepdim=True)
+        Us = eigvecs[..., D - self.rank:] * (eigvals[..., D - self.rank:] - sigma2).clamp_min(0).sqrt().unsqueeze(-2)
+        psi = covs.diagonal(dim1=-2, dim2=-1) - Us.square().sum(dim=-1)
+
+        # precision = diag(psi)^-1 - A A^T with A = diag(psi)^-1 U L^-T and L L^T = I + U^T diag(psi)^-1 U
+        Us_psi = Us / psi.unsqueeze(-1)
+        Id = torch.eye(self.rank, dtype=covs.dtype, device=covs.device)
+        L = torch.linalg.cholesky(Id + Us.transpose(-1, -2) @ Us_psi)
+        A = torch.linalg.solve_triangular(L, Us_psi.transpose(-1, -2), upper=False).transpose(-1, -2)
+
+        covs_lr = Us @ Us.transpose(-1, -2) + torch.diag_embed(psi)
+        Ws_logdet = -0.5 * psi.log().sum(dim=-1) - chol_log_det(L)
+        return psi.rsqrt(), covs_lr, None, Ws_logdet, A
+
+    def _log_prob_offset(self, params: NWParams, D: int) -> Tensor:
+        if self.cov_type.is_matrix:
+            dims = torch.arange(D, dtype=params.nus.dtype, device=params.nus.device)
+            log_lambda = (
+                D * math.log(2.0)
+                + digamma(0.5 * (params.nus.unsqueeze(-1) - dims)).sum(dim=-1)
+            )  # Bishop eq. (B.81)
+        else:
+            log_lambda = D * (math.log(2.0) + digamma(0.5 * params.nus))
+
+        return 0.5 * (log_lambda - D / params.kappas) - 0.5 * D * params.nus.log()  # Bishop eq. (B.78)
+
+    def estimate_log_prob(self, X: Tensor, params: NWParams, compute_dtype: torch.dtype = None) -> Tensor:
         # Basically Multi-variate Normal Distribution with computed mu and cov (or W in this case which is its inverse)
-        k, D = params.mus.shape
-        log_gauss = estimate_gaussian_log_prob(X, params.mus, params.Ws) - 0.5 * D * params.nus.log()
-        log_lambda = (
-            D * math.log(2.0)
-            + digamma(0.5 * (params.nus - torch.arange(D)[:, None])).sum(dim=0)
-        )  # Bishop eq. (B.81)
+        D = params.mus.shape[-1]
+        log_gauss = estimate_gaussian_log_prob(
+            X, params.mus, params.Ws, params.Ws_logdet, precs_lowrank=params.Ws_lowrank, compute_dtype=compute_dtype
+        )
+
+        return log_gauss + self._log_prob_offset(params, D)
+
+    def estimate_log_prob_segmented(
+        self, X: Tensor, z: Tensor, params: NWParams, compute_dtype: torch.dtype = None
+    ) -> Tensor:
+        """
+        Log probabilities of points X under the components of their own segment z for stacked params of shape
+        [k, C, ...]. Returns a tensor of shape (N, C).
+        """
+        D = params.mus.shape[-1]
+        log_gauss = estimate_gaussian_log_prob_segmented(
+            X, z, params.mus, params.Ws, params.Ws_logdet,
+            precs_lowrank=params.Ws_lowrank, compute_dtype=compute_dtype,
+        )
 
-        return log_gauss + 0.5 * (log_lambda - D / params.kappas)  # Bishop eq. (B.78)
+        return log_gauss + self._log_prob_offset(params, D)[z]
+
+    def estimate_log_prob_indexed(
+        self, X: Tensor, idx: Tensor, params: NWParams, compute_dtype: torch.dtype = None
+    ) -> Tensor:
+        """
+        Log probabilities of points X under their own candidate components idx of shape (N, m).
+        Returns a tensor of shape (N, m).
+        """
+        D = params.mus.shape[-1]
+        log_gauss = estimate_gaussian_log_prob_indexed(
+            X, idx, params.mus, params.Ws, params.Ws_logdet,
+            precs_lowrank=params.Ws_lowrank, compute_dtype=compute_dtype,
+        )
+
+        return log_gauss + self._log_prob_offset(params, D)[idx]
 
     def estimate_marginal_log_prob(self, Ns: Tensor, mus: Tensor, covs: Tensor) -> Tensor:
         # Computes: P(D_new | D)
         # Note: Use hard assignment with this one
-        _, D = mus.shape
-        mus_post, kappas_post, nus_post, Ws_post, covs_post = self.estimate_post(Ns, mus, covs)
+        return self.estimate_marginal_log_prob_post(Ns, self.estimate_post(Ns, mus, covs))
+
+    def estimate_marginal_log_prob_post(self, Ns: Tensor, params_post: NWParams) -> Tensor:
+        """
+        Marginal log likelihood given an already computed posterior. Reuses its cached log-determinants.
+        """
+        D = params_post.mus.shape[-1]
+        nus_post, kappas_post = params_post.nus, params_post.kappas
+        logdet_covs_post = -2.0 * params_post.cached().Ws_logdet
 
         return (
-            -(np.log(torch.pi) * (Ns * D / 2.0))
-            + mvlgamma(nus_post / 2.0, D)
-            - mvlgamma(self.nu / 2.0, D)
-            + self.W_inv.logdet() * (self.nu / 2.0)
-            - (covs_post * (nus_post[:, None, None] + D + 2)).logdet() * (
+            -(math.log(math.pi) * (Ns * D / 2.0))
+            + self._mvlgamma(nus_post / 2.0, D)
+            - self._mvlgamma(self.nu / 2.0, D)
+            + self.W_inv_logdet * (self.nu / 2.0)
+            - (logdet_covs_post + D * torch.log(nus_post + D + 2)) * (
                     nus_post / 2.0)  # TODO: shouldn't we use Ws instead?
             + (torch.log(self.kappa) - torch.log(kappas_post)) * (D / 2.0)
         )
 
-    def get_params(self) -> Tuple[float, float, Tensor, Tensor]:
-        return (float(self.kappa), float(self.nu), self.mu_0, self.W_inv)
+    def get_params(self) -> Tuple[float, float, Tensor, Tensor, CovarianceType, int]:
+        return (float(self.kappa), float(self.nu), self.mu_0, self.W_inv, self.cov_type, self.rank)
 
 # class NIWPrior:
 #     """
@@ -0,0 +1,194 @@
+from typing import List, Tuple, Callable, Union, Optional, Any
+
+import torch
+from torch import Tensor
+
+from ml.algo.dpmm.dpm import DPMMParams, DirichletProcessMixtureParams
+from ml.algo.dpmm.prior import DirPrior, NWPrior
+from ml.algo.dpmm.statistics import GaussianParams, InitMode, initial_labels, estimate_gaussian_parameters_segmented, \
+    block_rows, to_full_covs, resp_entropy, principal_split
+
+
+def map_params(fn: Callable[..., Tensor], *params):
+    """
+    Applies fn field-wise over (nested) parameter tuples of the same structure.
+    """
+    if params[0] is None:
+        return None
+    if isinstance(params[0], tuple):
+        return type(params[0])(*[map_params(fn, *fields) for fields in zip(*params)])
+    return fn(*params)
+
+
+def segment_ids(sizes: List[int], device=None) -> Tensor:
+    """
+    Returns the segment index of each element for contiguous segments of the given sizes.
+    """
+    return torch.arange(len(sizes), device=device).repeat_interleave(torch.tensor(sizes, device=device))
+
+
+class StackedDirichletProcessMixture:
+    """
+    k independent c-component Dirichlet process mixtures (e.g. the subclusters of each cluster) stored as stacked
+    [k, c, ...] parameter tensors. Each point is only scored against the components of its own segment z, which
+    allows E and M steps of all mixtures to run as a single batched computation over the data sorted by segment.
+    """
+    hparams: DirichletProcessMixtureParams
+    params: DPMMParams = None
+    prior_nw: NWPrior = None
+
+    def __init__(self, hparams: DirichletProcessMixtureParams, n_subcomponents: int = 2) -> None:
+        super().__init__()
+        self.hparams = hparams
+        self.n_subcomponents = n_subcomponents
+        self.prior_dir = DirPrior.from_params(1.0 / n_subcomponents)
+
+    @property
+    def n_components(self) -> int:
+        return len(self.params.dir.a) if self.params is not None else 0
+
+    def _block_size(self, X: Tensor) -> int:
+        max_numel = self.hparams.mem_budget * 2 ** 20 // X.element_size()
+        D = X.shape[1]
+        return block_rows(self.n_subcomponents * D * (D + 1), max_numel)
+
+    def _estimate_post(self, params: GaussianParams) -> DPMMParams:
+        Ns, mus, covs = params
+        return DPMMParams(self.prior_dir.estimate_post(Ns), self.prior_nw.estimate_post(Ns, mus, covs))
+
+    def _estimate_stats(self, X: Tensor, z: Tensor, k: int, log_r: Tensor, weights: Tensor = None) -> GaussianParams:
+        r = log_r.argmax(dim=1) if self.hparams.update_hard else log_r.exp()
+        return estimate_gaussian_parameters_segmented(
+            X, z, k, r, self.hparams.reg_cov, weights=weights, c=self.n_subcomponents, cov_type=self.hparams.cov_type
+        )
+
+    def _estimate_params(self, X: Tensor, z: Tensor, k: int, r: Tensor, weights: Tensor = None) -> DPMMParams:
+        return self._estimate_post(estimate_gaussian_parameters_segmented(
+            X, z, k, r, self.hparams.reg_cov, weights=weights, c=self.n_subcomponents, cov_type=self.hparams.cov_type
+        ))
+
+    def _init_components(
+        self, X_parts: List[Tensor], W_parts: Optional[List[Tensor]] = None, params: Any = None
+    ) -> DPMMParams:
+        """
+        Initializes a mixture for each of the given point sets by splitting it along its principal direction.
+        Two-component mixtures of all sets are initialized in a single batched pass.
+
+        :param W_parts: Optional weights of the points of each set
+        :param params: Optional moments (mus, covs) of the point sets, used for their principal directions
+        """
+        X = torch.cat(X_parts)
+        z = segment_ids([len(X_i) for X_i in X_parts], device=X.device)
+        weights = torch.cat(W_parts) if W_parts is not None else None
+
+        if self.n_subcomponents == 2:
+            zi = principal_split(X, z, len(X_parts), weights, params)
+        else:
+            W_parts = W_parts if W_parts is not None else [None] * len(X_parts)
+            zi = torch.cat([
+                initial_labels(X_i, self.n_subcomponents, InitMode.KMEANS1D, self.hparams.metric, weights=W_i)
+                if len(X_i) >= self.n_subcomponents
+                else torch.arange(len(X_i), device=X_i.device) % self.n_subcomponents
+                for X_i, W_i in zip(X_parts, W_parts)
+            ])
+
+        return self._estimate_params(X, z, len(X_parts), zi, weights)
+
+    def _init_params(
+        self, X_parts: List[Tensor], W_parts: Optional[List[Tensor]] = None, params: Any = None
+    ) -> None:
+        self._set_params(self._init_components(X_parts, W_parts, params))
+
+    def _reinit_params(
+        self, X_parts: List[Tensor], idx: Tensor, W_parts: Optional[List[Tensor]] = None, params: Any = None
+    ) -> None:
+        """
+        Reinitializes the mixtures at the given indices from their point sets.
+
+        :param params: Optional moments (mus, covs) of the reinitialized point sets
+        """
+        params = self._init_components(
+            [X_parts[i] for i in idx.tolist()],
+            [W_parts[i] for i in idx.tolist()] if W_parts is not None else None,
+            params,
+        )
+        self._set_params(map_params(lambda t, u: t.index_copy(0, idx, u), self.params, params))
+
+    def _e_step(self, X: Tensor, z: Tensor) -> Tuple[Tensor, Tensor]:
+        _, log_prob, entropy = self._estimate_log_prob_resp(X, z)
+        return entropy, log_prob
+
+    def _m_step(self, X: Tensor, z: Tensor, log_r: Tensor, weights: Tensor = None) -> None:
+        self._set_params(self._estimate_post(self._estimate_stats(X, z, self.n_components, log_r, weights)))
+
+    def _estimate_log_weights(self) -> Tensor:
+        return self.prior_dir.estimate_log_prob(self.params.dir)
+
+    def _estimate_log_prob_resp(self, X: Tensor, z: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        log_weights = self._estimate_log_weights()
+
+        compute_dtype = self.hparams.estep_precision.dtype(X.dtype)
+
+        log_prob_norm, log_resp, entropy = [], [], []
+        step = self._block_size(X)
+        for X_b, z_b in zip(X.split(step), z.split(step)):
+            weighted_log_prob = (
+                log_weights[z_b]
+                + self.prior_nw.estimate_log_prob_segmented(X_b, z_b, self.params.nw, compute_dtype)
+            )
+            log_prob_norm_b = torch.logsumexp(weighted_log_prob, dim=1)
+            log_resp_b = weighted_log_prob - log_prob_norm_b[:, None]
+            log_prob_norm.append(log_prob_norm_b)
+            log_resp.append(log_resp_b)
+            entropy.append(resp_entropy(log_resp_b))
+
+        return torch.cat(log_prob_norm), torch.cat(log_resp), torch.cat(entropy)
+
+    def estimate_log_resp_component(self, X: Tensor, i: int) -> Tensor:
+        """
+        Log responsibilities of all points X under the components of mixture i.
+        """
+        weighted_log_prob = (
+            self.prior_dir.estimate_log_prob(self.params.dir[i])
+            + self.prior_nw.estimate_log_prob(X, self.params.nw[i], self.hparams.estep_precision.dtype(X.dtype))
+        )
+        return weighted_log_prob - torch.logsumexp(weighted_log_prob, dim=1, keepdim=True)
+
+    def predict(self, X: Tensor, z: Tensor) -> Tensor:
+        _, log_resp, _ = self._estimate_log_prob_resp(X, z)
+        return log_resp.argmax(dim=1)
+
+    def _compute_lower_bound(self, entropy: Tensor, weights: Tensor = None) -> Tensor:
+        D = self.params.nw.mus.shape[-1]
+        log_wishart = self.prior_nw.log_norm(self.params.nw.nus, self.params.nw.Ws_logdet, D).sum()
+        log_dir = -self.prior_dir.log_norm(self.params.dir).sum()
+
+        return (
+            (entropy.sum() if weights is None else torch.dot(entropy, weights))
+            - log_wishart
+            - log_dir
+            - 0.5 * D * self.params.nw.kappas.log().sum()
+        )
+
+    def select(self, idx: Tensor) -> DPMMParams:
+        return map_params(lambda t: t[idx], self.params)
+
+    def _get_params(self) -> DPMMParams:
+        return self.params
+
+    def _set_params(self, params: Union[DPMMParams, List[DPMMParams]]) -> None:
+        if isinstance(params, list):  # Legacy format: a list of per-cluster mixture params
+            params = map_params(lambda *ts: torch.stack(ts), *params) if len(params) > 0 else None
+        if params is not None:
+            params = DPMMParams(params.dir, params.nw.cached())
+        self.params = params
+
+    @property
+    def cluster_params(self) -> GaussianParams:
+        return GaussianParams(
+            self.params.dir.a - 1, self.params.nw.mus, to_full_covs(self.params.nw.mus, self.params.nw.covs)
+        )
+
+    @staticmethod
+    def cat(params: List[DPMMParams]) -> DPMMParams:
+        return map_params(lambda *ts: torch.cat(ts), *params)
@@ -1,44 +1,369 @@
+import math
 from enum import Enum
-from typing import NamedTuple
+from typing import NamedTuple, Tuple, Any
 
 import torch
 from torch import Tensor
 
-from ml.algo.clustering import KMeans, KMeans1D
+from ml.algo.clustering import KMeans, KMeans1D, KMeansInit
 from ml.utils import Metric
 
 EPS = 1e-6
+LOG_2PI = math.log(2 * math.pi)
 
 GaussianParams = NamedTuple('GaussianParams', [('Ns', Tensor), ('mus', Tensor), ('covs', Tensor)])
 
 
-def estimate_gaussian_parameters(X: Tensor, r: Tensor, reg_covar: float = 1e-6) -> GaussianParams:
+class CovarianceType(Enum):
+    """
+    Covariance family of the mixture components. Determines the layout of covs: [..., D, D] for full and low-rank,
+    [..., D] for diagonal and [..., 1] for spherical covariances.
+    """
+    FULL = 'full'
+    DIAG = 'diag'
+    SPHERICAL = 'spherical'
+    LOWRANK = 'lowrank'
+    """Low-rank plus diagonal. Estimated from full statistics, but evaluated in O(D * rank) per point"""
+
+    @property
+    def is_matrix(self) -> bool:
+        return self in (CovarianceType.FULL, CovarianceType.LOWRANK)
+
+
+class Precision(Enum):
+    """
+    Floating point precision of a computation. NATIVE keeps the dtype of the data.
+    """
+    NATIVE = 'native'
+    FLOAT64 = 'float64'
+    FLOAT32 = 'float32'
+    BFLOAT16 = 'bfloat16'
+
+    def dtype(self, default: torch.dtype) -> torch.dtype:
+        return default if self == Precision.NATIVE else getattr(torch, self.value)
+
+
+def mean_outer(mus: Tensor, covs: Tensor) -> Tensor:
+    """
+    Outer product of the means in the layout of covs (see CovarianceType).
+    """
+    if covs.dim() > mus.dim():
+        return mus.unsqueeze(-1) @ mus.unsqueeze(-2)
+    elif covs.shape[-1] == mus.shape[-1]:
+        return mus.square()
+    else:
+        return mus.square().mean(dim=-1, keepdim=True)
+
+
+def to_full_covs(mus: Tensor, covs: Tensor) -> Tensor:
+    """
+    Expands diagonal or spherical covariances to full matrices of shape [..., D, D].
+    """
+    if covs.dim() > mus.dim():
+        return covs
+    return torch.diag_embed(covs.expand_as(mus))
+
+
+def _reduce_covs(covs: Tensor, cov_type: CovarianceType) -> Tensor:
+    return covs.mean(dim=-1, keepdim=True) if cov_type == CovarianceType.SPHERICAL else covs
+
+
+BLOCK_NUMEL = 2 ** 24
+"""Maximum number of elements in the intermediate tensors of blocked computations (64MB for float32)."""
+
+
+def block_rows(row_numel: int, max_numel: int = BLOCK_NUMEL) -> int:
+    """
+    Number of rows that fit in a block given the number of intermediate elements each row allocates.
+    """
+    return max(1, max_numel // max(1, row_numel))
+
+
+def estimate_gaussian_parameters(
+    X: Tensor, r: Tensor,
+    reg_covar: float = 1e-6,
+    weights: Tensor = None,
+    k: int = None,
+    cov_type: CovarianceType = CovarianceType.FULL,
+) -> GaussianParams:
+    """
+    Estimates cluster sizes, means and covariances of all clusters in a single batched pass over X.
+
+    :param X: Data points of shape (N, D)
+    :param r: Either (soft) responsibilities of shape (N, k) or integer cluster labels of shape (N,)
+    :param reg_covar: Regularization added to the diagonal of the covariances
+    :param weights: Optional per-point weights of shape (N,)
+    :param k: Number of clusters. Only used (and inferred if omitted) for integer labels
+    :param cov_type: Covariance family which determines the layout of the covariances
+    """
+    if r.dim() == 1:
+        k = int(r.max()) + 1 if k is None else k
+        return estimate_gaussian_parameters_hard(X, r, k, reg_covar, weights, cov_type)
+
+    if weights is not None:
+        r = r * weights[:, None]
+
     Ns = r.sum(dim=0) + EPS
     mus = torch.mm(r.T, X) / Ns[:, None]
 
     k, D = mus.shape
-    covs = torch.zeros(k, D, D)
-    for i in range(k):
-        diff = X - mus[i][None, :]
-        covs[i] = torch.mm(r[:, i] * diff.T, diff) / Ns[i] + torch.eye(D) * reg_covar
+    if not cov_type.is_matrix:
+        covs = (torch.mm(r.T, X.square()) / Ns[:, None] - mus.square()).clamp_min(0) + reg_covar
+        return GaussianParams(Ns, mus, _reduce_covs(covs, cov_type))
+
+    covs = torch.zeros(k, D, D, dtype=X.dtype, device=X.device)
+    step = block_rows(2 * k * D)
+    for start in range(0, len(X), step):
+        X_b, r_b = X[start:start + step], r[start:start + step]
+        diff = X_b.unsqueeze(0) - mus.unsqueeze(1)
+        covs += torch.bmm((r_b.T.unsqueeze(2) * diff).transpose(1, 2), diff)
 
+    covs = covs / Ns[:, None, None] + torch.eye(D, dtype=X.dtype, device=X.device) * reg_covar
     return GaussianParams(Ns, mus, covs)
 
 
+def estimate_gaussian_parameters_hard(
+    X: Tensor, z: Tensor, k: int,
+    reg_covar: float = 1e-6,
+    weights: Tensor = None,
+    cov_type: CovarianceType = CovarianceType.FULL,
+) -> GaussianParams:
+    """
+    Estimates cluster parameters from integer labels using segment reductions. Only O(N) memory is used
+    for the assignment and the cost of the covariance reduction does not depend on k.
+    """
+    N, D = X.shape
+    w = weights if weights is not None else torch.ones(N, dtype=X.dtype, device=X.device)
+
+    Ns = torch.zeros(k, dtype=X.dtype, device=X.device).index_add_(0, z, w) + EPS
+    Xw = X if weights is None else X * w[:, None]
+    mus = torch.zeros(k, D, dtype=X.dtype, device=X.device).index_add_(0, z, Xw) / Ns[:, None]
+
+    if not cov_type.is_matrix:
+        diff = X - mus[z]
+        diff_w = diff if weights is None else diff * w[:, None]
+        covs = torch.zeros(k, D, dtype=X.dtype, device=X.device).index_add_(0, z, diff_w * diff)
+        return GaussianParams(Ns, mus, _reduce_covs(covs / Ns[:, None] + reg_covar, cov_type))
+
+    covs = torch.zeros(k, D, D, dtype=X.dtype, device=X.device)
+    step = block_rows(2 * D * D)
+    for start in range(0, N, step):
+        z_b = z[start:start + step]
+        diff = X[start:start + step] - mus[z_b]
+        diff_w = diff if weights is None else diff * w[start:start + step, None]
+        covs.index_add_(0, z_b, diff_w.unsqueeze(2) * diff.unsqueeze(1))
+
+    covs = covs / Ns[:, None, None] + torch.eye(D, dtype=X.dtype, device=X.device) * reg_covar
+    return GaussianParams(Ns, mus, covs)
+
+
+def estimate_gaussian_parameters_segmented(
+    X: Tensor, z: Tensor, k: int, r: Tensor,
+    reg_covar: float = 1e-6,
+    weights: Tensor = None,
+    c: int = None,
+    cov_type: CovarianceType = CovarianceType.FULL,
+) -> GaussianParams:
+    """
+    Estimates the parameters of k independent c-component mixtures at once. Every point only contributes to
+    the components of its own segment z. Returns stacked parameters of shape [k, c, ...].
+
+    :param z: Segment (cluster) index of each point of shape (N,)
+    :param r: Either responsibilities within the segment of shape (N, c) or integer labels of shape (N,)
+    :param c: Number of components per segment. Only used (and inferred if omitted) for integer labels
+    """
+    if r.dim() == 1:
+        c = int(r.max()) + 1 if c is None else c
+        Ns, mus, covs = estimate_gaussian_parameters_hard(X, z * c + r, k * c, reg_covar, weights, cov_type)
+        return GaussianParams(Ns.reshape(k, c), mus.reshape(k, c, -1), covs.reshape(k, c, *covs.shape[1:]))
+
+    params = [
+        estimate_gaussian_parameters_hard(
+            X, z, k, reg_covar, r[:, j] if weights is None else r[:, j] * weights, cov_type
+        )
+        for j in range(r.shape[1])
+    ]
+    return GaussianParams(*[torch.stack(ps, dim=1) for ps in zip(*params)])
+
+
+def estimate_gaussian_parameters_sparse(
+    X: Tensor, idx: Tensor, r: Tensor, k: int,
+    reg_covar: float = 1e-6,
+    weights: Tensor = None,
+    cov_type: CovarianceType = CovarianceType.FULL,
+) -> GaussianParams:
+    """
+    Estimates the parameters of k clusters from sparse responsibilities, where each point only has weights r
+    of shape (N, m) for its candidate clusters idx of shape (N, m). Costs O(N * m) instead of O(N * k).
+    """
+    params = [
+        estimate_gaussian_parameters_hard(
+            X, idx[:, j], k, reg_covar, r[:, j] if weights is None else r[:, j] * weights, cov_type
+        )
+        for j in range(idx.shape[1])
+    ]
+    return merge_params_batched(*[torch.stack(ps, dim=1) for ps in zip(*params)])
+
+
 def covs_to_prec(covs):
+    _, prec_chol = covs_to_chol_prec(covs)
+    return prec_chol
+
+
+def covs_to_chol_prec(covs: Tensor) -> Tuple[Tensor, Tensor]:
+    """
+    Factorizes the covariances once. Returns both the Cholesky factors of the covariances and of the precisions.
+    """
     cov_chol = torch.linalg.cholesky(covs)
     Id = torch.eye(covs.shape[-1], dtype=covs.dtype, device=covs.device)
     prec_chol = torch.linalg.solve_triangular(cov_chol, Id, upper=False)
-    return prec_chol.transpose(-1, -2)
+    return cov_chol, prec_chol.transpose(-1, -2)
+
 
+def chol_log_det(chol: Tensor) -> Tensor:
+    """
+    Log-determinant of a triangular (Cholesky) factor.
+    """
+    return chol.diagonal(dim1=-2, dim2=-1).log().sum(dim=-1)
 
-def estimate_gaussian_log_prob(X: Tensor, mus: Tensor, precs: Tensor) -> Tensor:
+
+def estimate_gaussian_log_prob(
+    X: Tensor, mus: Tensor, precs: Tensor,
+    half_log_det: Tensor = None,
+    max_numel: int = BLOCK_NUMEL,
+    precs_lowrank: Tensor = None,
+    compute_dtype: torch.dtype = None,
+) -> Tensor:
+    """
+    Computes the log probability of each point under each gaussian. The k x N x D intermediate is computed in
+    blocks of rows so that at most max_numel elements are allocated at once.
+
+    :param precs: Precision factors. Either full matrices [k, D, D] or square roots of diagonal precisions [k, D]
+        (or [k, 1] for spherical covariances)
+    :param half_log_det: Optional precomputed log-determinants of the precision factors precs
+    :param precs_lowrank: Optional low-rank correction [k, D, R] of diagonal precisions: P = diag(precs)^2 - A A^T
+    :param compute_dtype: Optional (lower) precision of the products with the precisions. The centering and the
+        squared distances are still computed in the dtype of X
+    """
     k, D = mus.shape
-    ys = torch.bmm(X.expand(k, *X.shape), precs) - torch.bmm(mus.unsqueeze(1), precs)
-    M = ys.square().sum(dim=-1).T
+    if precs.dim() == 2:
+        return _estimate_gaussian_log_prob_diag(X, mus, precs, half_log_det, max_numel, precs_lowrank, compute_dtype)
+
+    compute_dtype = compute_dtype or X.dtype
+    precs_c = precs.to(compute_dtype)
+    mus_prec = torch.bmm(mus.unsqueeze(1), precs)
 
-    half_log_det = precs.diagonal(dim1=-2, dim2=-1).log().sum(dim=-1)
-    return -0.5 * (D * torch.log(2 * torch.tensor(torch.pi)) + M) + half_log_det.unsqueeze(0)
+    M = torch.empty(len(X), k, dtype=X.dtype, device=X.device)
+    step = block_rows(k * D, max_numel)
+    for start in range(0, len(X), step):
+        ys = torch.matmul(X[start:start + step].to(compute_dtype), precs_c).to(X.dtype) - mus_prec
+        M[start:start + step] = ys.square().sum(dim=-1).T
+
+    half_log_det = chol_log_det(precs) if half_log_det is None else half_log_det
+    return -0.5 * (D * LOG_2PI + M) + half_log_det.unsqueeze(0)
+
+
+def _estimate_gaussian_log_prob_diag(
+    X: Tensor, mus: Tensor, precs: Tensor,
+    half_log_det: Tensor = None,
+    max_numel: int = BLOCK_NUMEL,
+    precs_lowrank: Tensor = None,
+    compute_dtype: torch.dtype = None,
+) -> Tensor:
+    """
+    Diagonal (plus low-rank) variant of estimate_gaussian_log_prob. The squared distances are expanded into
+    matrix products, so no k x N x D intermediate is needed. The expanded terms cancel, so they are always computed
+    in the dtype of X. The compute_dtype only applies to the low-rank correction.
+    """
+    k, D = mus.shape
+    prec_sq = precs.square().expand_as(mus)
+    M = (
+        torch.mm(X.square(), prec_sq.T)
+        - 2 * torch.mm(X, (mus * prec_sq).T)
+        + (mus.square() * prec_sq).sum(dim=-1)
+    )
+
+    if precs_lowrank is not None:
+        R = precs_lowrank.shape[-1]
+        compute_dtype = compute_dtype or X.dtype
+        precs_lowrank_c = precs_lowrank.to(compute_dtype)
+        mus_lr = torch.bmm(mus.unsqueeze(1), precs_lowrank)
+        step = block_rows(k * R, max_numel)
+        for start in range(0, len(X), step):
+            ys = torch.matmul(X[start:start + step].to(compute_dtype), precs_lowrank_c).to(X.dtype) - mus_lr
+            M[start:start + step] -= ys.square().sum(dim=-1).T
+
+    half_log_det = precs.log().expand_as(mus).sum(dim=-1) if half_log_det is None else half_log_det
+    return -0.5 * (D * LOG_2PI + M) + half_log_det.unsqueeze(0)
+
+
+def estimate_gaussian_log_prob_segmented(
+    X: Tensor, z: Tensor, mus: Tensor, precs: Tensor,
+    half_log_det: Tensor = None,
+    max_numel: int = BLOCK_NUMEL,
+    precs_lowrank: Tensor = None,
+    compute_dtype: torch.dtype = None,
+) -> Tensor:
+    """
+    Computes the log probability of each point under the C gaussians of its own segment z for stacked params
+    mus of shape [k, C, D] and precs of shape [k, C, D, D]. Returns a tensor of shape (N, C).
+    Diagonal precision factors [k, C, D] (with optional low-rank correction) are supported as in
+    estimate_gaussian_log_prob.
+    """
+    k, C, D = mus.shape
+    idx = z[:, None] * C + torch.arange(C, device=z.device)
+    return estimate_gaussian_log_prob_indexed(
+        X, idx, mus.flatten(0, 1), precs.flatten(0, 1),
+        half_log_det.flatten(0, 1) if half_log_det is not None else None,
+        max_numel,
+        precs_lowrank.flatten(0, 1) if precs_lowrank is not None else None,
+        compute_dtype,
+    )
+
+
+def estimate_gaussian_log_prob_indexed(
+    X: Tensor, idx: Tensor, mus: Tensor, precs: Tensor,
+    half_log_det: Tensor = None,
+    max_numel: int = BLOCK_NUMEL,
+    precs_lowrank: Tensor = None,
+    compute_dtype: torch.dtype = None,
+) -> Tensor:
+    """
+    Computes the log probability of each point under its own subset of gaussians idx of shape (N, m), e.g. the
+    m nearest components. Only the N x m pairs are evaluated. Returns a tensor of shape (N, m).
+    """
+    k, D = mus.shape
+    m = idx.shape[1]
+    compute_dtype = compute_dtype or X.dtype
+
+    M = torch.empty(len(X), m, dtype=X.dtype, device=X.device)
+    if precs.dim() == 2:
+        R = precs_lowrank.shape[-1] if precs_lowrank is not None else 0
+        precs_c = precs.to(compute_dtype)
+        precs_lowrank_c = precs_lowrank.to(compute_dtype) if precs_lowrank is not None else None
+        step = block_rows(m * D * (R + 1), max_numel)
+        for start in range(0, len(X), step):
+            idx_b = idx[start:start + step]
+            diff = (X[start:start + step, None, :] - mus[idx_b]).to(compute_dtype)
+            M[start:start + step] = (diff * precs_c[idx_b]).square().sum(dim=-1, dtype=X.dtype)
+            if precs_lowrank is not None:
+                ys = torch.matmul(diff.unsqueeze(-2), precs_lowrank_c[idx_b]).squeeze(-2)
+                M[start:start + step] -= ys.square().sum(dim=-1, dtype=X.dtype)
+
+        half_log_det = precs.log().expand_as(mus).sum(dim=-1) if half_log_det is None else half_log_det
+    else:
+        precs_c = precs.to(compute_dtype)
+        mus_prec = torch.matmul(mus.unsqueeze(-2), precs).squeeze(-2)
+        step = block_rows(m * D * (D + 1), max_numel)
+        for start in range(0, len(X), step):
+            idx_b = idx[start:start + step]
+            X_b = X[start:start + step, None, None, :].to(compute_dtype)
+            ys = torch.matmul(X_b, precs_c[idx_b]).squeeze(-2).to(X.dtype) - mus_prec[idx_b]
+            M[start:start + step] = ys.square().sum(dim=-1)
+
+        half_log_det = chol_log_det(precs) if half_log_det is None else half_log_det
+
+    return -0.5 * (D * LOG_2PI + M) + half_log_det[idx]
 
 
 class InitMode(Enum):
@@ -48,31 +373,125 @@ class InitMode(Enum):
     HARD = 'hard'
 
 
-def initial_assignment(X: Tensor, k: int, mode: InitMode, metric: Metric, z_init: Tensor = None) -> Tensor:
+def initial_labels(
+    X: Tensor, k: int, mode: InitMode, metric: Metric, z_init: Tensor = None, weights: Tensor = None
+) -> Tensor:
+    """
+    Computes initial hard cluster labels of shape (N,) without materializing a dense assignment matrix.
+
+    :param weights: Optional per-point weights of shape (N,) used by the k-means initializations
+    """
     N, D = X.shape
 
     if z_init is not None:
-        r = torch.zeros(N, k)
-        r[torch.arange(N), z_init] = 1
+        return z_init.to(X.device)
     elif mode == InitMode.KMEANS:
-        z = KMeans(D, k, metric).fit(X).assign(X)
-        r = torch.zeros(N, k)
-        r[torch.arange(N), z] = 1
+        kmeans = KMeans(D, k, metric, init=KMeansInit.KMEANSPP, tol=1e-4)
+        return kmeans.fit(X, weights).assign(X).to(X.device)
     elif mode == InitMode.KMEANS1D:
-        z = KMeans1D(D, k, metric).fit(X).assign(X)
-        r = torch.zeros(N, k)
-        r[torch.arange(N), z] = 1
+        return KMeans1D(D, k, metric).fit(X, weights).assign(X).to(X.device)
     else:
-        r = torch.rand(N, k)
+        return torch.randint(k, (N,), device=X.device)
+
+
+def principal_axes(mus: Tensor, covs: Tensor, n_iter: int = 20) -> Tensor:
+    """
+    Leading principal directions of a batch of covariances ([..., D, D]) by batched power iteration. For diagonal
+    covariances this is the dimension with the largest variance. Spherical covariances have no preferred direction,
+    these get a random one (see scatter_axes for directions from the data).
+    """
+    if covs.dim() == mus.dim():
+        if covs.shape[-1] != mus.shape[-1]:
+            return torch.nn.functional.normalize(torch.randn_like(mus), dim=-1)
+        return torch.nn.functional.one_hot(covs.argmax(dim=-1), mus.shape[-1]).to(mus.dtype)
+
+    v = torch.nn.functional.normalize(torch.randn_like(mus).unsqueeze(-1), dim=-2)
+    for _ in range(n_iter):
+        v = torch.nn.functional.normalize(covs @ v, dim=-2)
+
+    return v.squeeze(-1)
+
+
+def scatter_axes(X: Tensor, z: Tensor, mus: Tensor, weights: Tensor = None, n_iter: int = 20) -> Tensor:
+    """
+    Leading principal directions of the scatter of the points of each segment around its mean ([k, D]) by batched
+    power iteration over the points, without forming the D x D scatter matrices.
+    """
+    X_c = X - mus[z]
+    v = torch.nn.functional.normalize(torch.randn_like(mus), dim=-1)
+    for _ in range(n_iter):
+        t = (X_c * v[z]).sum(dim=1)
+        if weights is not None:
+            t = t * weights
+        v = torch.nn.functional.normalize(torch.zeros_like(mus).index_add_(0, z, X_c * t[:, None]), dim=-1)
+
+    return v
+
+
+def principal_split(
+    X: Tensor, z: Tensor, k: int, weights: Tensor = None, params: Any = None, n_iter: int = 10,
+) -> Tensor:
+    """
+    Splits each of the k segments of X in two along its leading principal direction, all segments at once. The
+    points are projected onto the directions, after which the projections are split by a 1-D two-means. Diagonal
+    and spherical covariances only capture axis-aligned spread, so these take the direction from the data scatter.
+    Returns labels in {0, 1} of shape (N,).
+
+    :param z: Segment index of each point of shape (N,)
+    :param weights: Optional per-point weights of shape (N,)
+    :param params: Optional moments (mus, covs) of the segments (e.g. the params of the clusters they belong to).
+        Estimated from the points if omitted
+    """
+    N, D = X.shape
+    if params is None:
+        params = estimate_gaussian_parameters_hard(X, z, k, 0.0, weights)
+    mus, covs = params.mus.to(X.dtype), params.covs.to(X.dtype)
+    axes = principal_axes(mus, covs) if covs.dim() > mus.dim() else scatter_axes(X, z, mus, weights)
+    t = ((X - mus[z]) * axes[z]).sum(dim=1)
+
+    # Two-means on the projections, starting from the halves on either side of the segment mean
+    w = weights if weights is not None else torch.ones(N, dtype=X.dtype, device=X.device)
+    zeros = torch.zeros(k, dtype=X.dtype, device=X.device)
+    r = t > 0
+    for _ in range(n_iter):
+        w_1 = w * r
+        c_1 = zeros.index_add(0, z, w_1 * t) / zeros.index_add(0, z, w_1).clamp_min(EPS)
+        c_0 = zeros.index_add(0, z, (w - w_1) * t) / zeros.index_add(0, z, w - w_1).clamp_min(EPS)
+        r_new = t > (c_0 + c_1)[z] / 2
+        if torch.equal(r_new, r):
+            break
+        r = r_new
+
+    return r.long()
+
+
+def initial_assignment(
+    X: Tensor, k: int, mode: InitMode, metric: Metric, z_init: Tensor = None, weights: Tensor = None
+) -> Tensor:
+    N, D = X.shape
+
+    if z_init is None and mode not in (InitMode.KMEANS, InitMode.KMEANS1D):
+        r = torch.rand(N, k, dtype=X.dtype, device=X.device)
         r /= r.sum(dim=1, keepdim=True)
+    else:
+        z = initial_labels(X, k, mode, metric, z_init, weights)
+        r = torch.zeros(N, k, dtype=X.dtype, device=X.device)
+        r[torch.arange(N, device=X.device), z] = 1
 
     return r
 
 
+def resp_entropy(log_r: Tensor) -> Tensor:
+    """
+    Entropy of the responsibilities of each point given its log responsibilities of shape (N, k).
+    """
+    return -torch.sum(log_r.exp() * log_r, dim=-1)
+
+
 def to_hard_assignment(log_r: Tensor) -> Tensor:
     z = log_r.argmax(dim=1)
     r = torch.zeros_like(log_r)
-    r[torch.arange(len(log_r)), z] = 1
+    r[torch.arange(len(log_r), device=log_r.device), z] = 1
     return r
 
 def merge_params(Ns: Tensor, mus: Tensor, covs: Tensor) -> GaussianParams:
@@ -97,3 +516,71 @@ def merge_params(Ns: Tensor, mus: Tensor, covs: Tensor) -> GaussianParams:
         return GaussianParams(Ns_c, mus_c, covs_c)
     else:
         raise ValueError('Trying to merge empty clusters')
+
+
+def merge_params_batched(Ns: Tensor, mus: Tensor, covs: Tensor) -> GaussianParams:
+    """
+    Merges the components along the last dimension of Ns ([..., c]) into a single component per batch entry.
+    The result has the leading dimensions of Ns ([...]).
+    """
+    n = covs.dim() - Ns.dim()  # Number of dimensions of a single covariance
+    Ns_c = Ns.sum(dim=-1)
+    mus_c = (Ns[..., None] * mus).sum(dim=-2) / Ns_c[..., None]
+    covs_c = (
+        (Ns.reshape(*Ns.shape, *[1] * n) * (covs + mean_outer(mus, covs))).sum(dim=-n - 1)
+        / Ns_c.reshape(*Ns_c.shape, *[1] * n)
+    )
+    return GaussianParams(Ns_c, mus_c, covs_c - mean_outer(mus_c, covs_c))
+
+
+def add_params(params: GaussianParams, params_new: GaussianParams) -> GaussianParams:
+    """
+    Statistics of the union of the points both params were estimated from. The leading dimensions of both params
+    must match.
+    """
+    Ns, mus, covs = params
+    Ns_new, mus_new, covs_new = params_new
+    return merge_params_batched(
+        torch.stack([Ns, Ns_new], dim=-1),
+        torch.stack([mus, mus_new], dim=Ns.dim()),
+        torch.stack([covs, covs_new], dim=Ns.dim()),
+    )
+
+
+def interpolate_params(
+    params: GaussianParams, params_new: GaussianParams,
+    rho: float, scale: float = 1.0,
+) -> GaussianParams:
+    """
+    Moves the sufficient statistics of params towards the statistics of params_new (scaled by scale) with step size
+    rho: s = (1 - rho) * s + rho * scale * s_new. The leading dimensions of both params must match.
+    """
+    Ns, mus, covs = params
+    Ns_new, mus_new, covs_new = params_new
+    return merge_params_batched(
+        torch.stack([(1 - rho) * Ns, rho * scale * Ns_new], dim=-1),
+        torch.stack([mus, mus_new], dim=Ns.dim()),
+        torch.stack([covs, covs_new], dim=Ns.dim()),
+    )
+
+
+def split_params(params: GaussianParams) -> GaussianParams:
+    """
+    Splits each component into two halves along its principal axis. The first two moments of each pair match
+    the original component. The result has an extra component dimension ([..., 2]).
+    """
+    Ns, mus, covs = params
+    if covs.dim() > mus.dim():
+        eigvals, eigvecs = torch.linalg.eigh(covs)
+        scale, axis = eigvals[..., -1], eigvecs[..., -1]
+    else:  # Largest variance dimension of a diagonal covariance, a random direction of a spherical one
+        axis = principal_axes(mus, covs)
+        scale = (covs.expand_as(mus) * axis.square()).sum(dim=-1)
+    offset = (2 * scale.clamp_min(0) / math.pi).sqrt()[..., None] * axis
+
+    covs_split = covs - mean_outer(offset, covs)
+    return GaussianParams(
+        torch.stack([Ns / 2, Ns / 2], dim=-1),
+        torch.stack([mus - offset, mus + offset], dim=Ns.dim()),
+        torch.stack([covs_split, covs_split], dim=Ns.dim()),
+    )
@@ -67,9 +67,9 @@ class ClusteringVisualizerCallback(IntermittentCallback[ClusteringVisualizerCall
 
         # Collect sample data
         k = cluster_model.n_components
-        X = self.subsample.transform(pl_module.val_outputs.extract_first('X', cache=True, device='cpu'))
-        z = self.subsample.transform(pl_module.val_outputs.extract_first('z', cache=True, device='cpu'))
-        zi = self.subsample.transform(pl_module.val_outputs.extract_first('zi', cache=True, device='cpu'))
+        X = self.subsample.transform(pl_module.val_outputs.extract_cat('X', cache=True, device='cpu'))
+        z = self.subsample.transform(pl_module.val_outputs.extract_cat('z', cache=True, device='cpu'))
+        zi = self.subsample.transform(pl_module.val_outputs.extract_cat('zi', cache=True, device='cpu'))
 
         # Transform sample data
         if not self.remap.is_fitted or pl_module.sample_space_version != self.sample_space_version:
@@ -46,7 +46,7 @@ class SaveGraphCallback(Callback):
             return
 
         if isinstance(pl_module, MGCOMComDetModel):
-            Z = outputs.extract_first('X', device='cpu')
+            Z = outputs.extract_cat('X', device='cpu')
         else:
             Z = outputs.extract_cat_kv('Z_dict', device='cpu')
 
@@ -83,7 +83,7 @@ class SaveGraphCallback(Callback):
 
         if isinstance(pl_module, MGCOMComDetModel):
             logger.info('Saving resulting cluster_model')
-            z = outputs.extract_first('z')
+            z = outputs.extract_cat('z')
             G.vs['mgtcom'] = z.numpy()
         elif isinstance(pl_module, MGCOME2EModel):
             logger.info('Saving resulting cluster_model')
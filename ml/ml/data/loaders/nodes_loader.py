@@ -16,15 +16,32 @@ class NodesLoader(BatchedLoader):
             transform: Callable = None,
             batch_size_tmp: int = None,
             node_order: Optional[Tensor] = None,
+            epoch_order_fn: Callable[[int], Tensor] = None,
             *args, **kwargs
     ):
+        """
+        :param epoch_order_fn: Gives the order nodes are visited in for each epoch (e.g. the order of a precomputed walk
+            corpus). Should be combined with shuffle=False
+        """
         kwargs.pop('dataset', None)
         self.node_order = node_order if node_order is not None else torch.arange(num_nodes)
         assert self.node_order.shape == (num_nodes,), 'node_order must be of shape (num_nodes,)'
+        self.epoch_order_fn = epoch_order_fn
+        self.epoch = 0
+        if epoch_order_fn is not None:
+            # Persistent workers see the order of later epochs
+            self.node_order = self.node_order.clone().share_memory_()
 
         super().__init__(self.node_order, transform, batch_size_tmp=batch_size_tmp, *args, **kwargs)
         self.num_nodes = num_nodes
 
+    def __iter__(self):
+        if self.epoch_order_fn is not None:
+            self.node_order.copy_(self.epoch_order_fn(self.epoch))
+            self.epoch += 1
+
+        return super().__iter__()
+
 
 class HeteroNodesLoader(NodesLoader):
     def __init__(
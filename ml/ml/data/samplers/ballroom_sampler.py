@@ -1,13 +1,17 @@
 from dataclasses import dataclass
-from typing import Tuple, Callable, Any
+from typing import Tuple, Callable, Any, Optional
 
 import torch
 from torch import Tensor
 
 from datasets.utils.temporal import TemporalNodeIndex
 from ml.data.samplers.base import Sampler
+from ml.data.samplers.context import NodeRelabeler, walk_contexts
+from ml.data.samplers.negative import NegativeSampler
+from ml.data.samplers.timestamps import TimestampPool, pick_timestamps
+from ml.data.samplers.walk_corpus import WalkCorpus
 from ml.data.samplers.node2vec_sampler import Node2VecBatch
-from ml.utils import HParams, randint_range
+from ml.utils import HParams
 
 try:
     import tch_geometric.tch_geometric as tch_native
@@ -30,6 +34,17 @@ class BallroomSamplerParams(HParams):
     walks_per_node: int = 10
     """Number of random walks to start at each node. (i.e. number of partners per node)"""
     num_neg_samples: int = 1
+    timestamp_pool_walks: int = 10
+    """Number of temporal walks started from each node without a timestamp to collect its candidate timestamps from
+    (once, at construction). If 0, the timestamps are inferred with new walks on every batch."""
+    timestamp_pool_refresh: int = 0
+    """Number of epochs after which the candidate timestamps are resampled. Never if 0."""
+    neg_alpha: float = 0.0
+    """Exponent of the degree^alpha distribution negatives are drawn from. 0 draws uniformly, word2vec uses 0.75."""
+    neg_per_type: bool = False
+    """Whether to draw negatives from the nodes of the same type as the walk head (if node types are given)."""
+    neg_in_batch: bool = False
+    """Whether to draw negatives from the nodes of the positive walks, which adds no new nodes to the batch."""
 
 
 class BallroomSampler(Sampler):
@@ -39,6 +54,7 @@ class BallroomSampler(Sampler):
             window: Tuple[int, int],
             hparams: BallroomSamplerParams = None,
             transform_meta: Callable[[Tensor], Any] = None,
+            node_type: Tensor = None,
     ) -> None:
         super().__init__()
 
@@ -52,22 +68,40 @@ class BallroomSampler(Sampler):
 
         self.temporal_index = TemporalNodeIndex().fit(node_timestamps, edge_index, edge_timestamps)
         self.num_nodes = len(node_timestamps)
+        self.relabel = NodeRelabeler(self.num_nodes)
+        self.corpus: Optional[WalkCorpus] = None
         self.row_ptrs, self.col_indices, self.perm = tch_native.to_csr(edge_index, self.num_nodes)
         self.node_timestamps = node_timestamps
         self.edge_timestamps = edge_timestamps[self.perm]
+        self.neg_sampler = NegativeSampler.from_csr(
+            self.row_ptrs, self.hparams.neg_alpha,
+            node_type if self.hparams.neg_per_type else None, self.hparams.neg_in_batch,
+        )
+        self.timestamp_pool = TimestampPool(
+            self.temporal_index, self.num_nodes, self._temporal_random_walk, self.hparams.timestamp_pool_walks
+        ) if self.hparams.timestamp_pool_walks > 0 else None
+        self.num_sampled = 0
 
     def sample(self, node_ids: Tensor) -> Node2VecBatch:
-        pos_walks, neg_walks = self._pos_sample(node_ids), self._neg_sample(node_ids)
-        walks = torch.cat([pos_walks, neg_walks], dim=0).view(-1)
+        pos_walks = self.corpus.pos_sample(node_ids) if self.corpus is not None else None
+        if pos_walks is None:
+            pos_walks = self._pos_sample(node_ids)
 
-        node_idx, perm = torch.unique(walks.view(-1), return_inverse=True)
-        walks = perm.view(-1, self.hparams.context_size)
-        pos_walks, neg_walks = walks[:pos_walks.shape[0]], walks[pos_walks.shape[0]:]
+        node_idx, pos_walks, neg_walks = walk_contexts(
+            self.relabel, pos_walks, self._neg_sample(node_ids, pos_walks), self.hparams.context_size
+        )
 
         node_meta = node_idx if self.transform_meta is None else self.transform_meta(node_idx)
         return Node2VecBatch(pos_walks, neg_walks, node_meta)
 
     def _pos_sample(self, node_ids: Tensor) -> Tensor:
+        # Resample the candidate timestamps every timestamp_pool_refresh epochs
+        self.num_sampled += len(node_ids)
+        refresh_after = self.hparams.timestamp_pool_refresh * self.num_nodes
+        if self.timestamp_pool is not None and 0 < refresh_after <= self.num_sampled:
+            self.timestamp_pool.refresh()
+            self.num_sampled = 0
+
         node_timestamps = self.temporal_index.node_to_timestamp(node_ids)
 
         # Infer timestamps for nodes that have no timestamp
@@ -89,39 +123,25 @@ class BallroomSampler(Sampler):
         contexts = neigh_walks.reshape(-1, self.hparams.walks_per_node * self.walk_length)
         contexts = contexts[:, torch.randperm(self.hparams.walks_per_node * self.walk_length)]\
             .view(-1, self.walk_length)
-        contexts = torch.cat([batch.reshape(-1, 1), contexts], dim=1)
-
-        # Construct context from the walks
-        walks = [] # In total there should be (walks_per_node * (walk_length - context_size)) walks
-        num_walks_per_rw = 1 + self.walk_length - self.hparams.context_size
-        for j in range(num_walks_per_rw):
-            walks.append(contexts[:, j:j + self.hparams.context_size])
+        # Last step is dropped to get as many context windows as the negative walks
+        contexts = torch.cat([batch.reshape(-1, 1), contexts[:, :self.walk_length - 1]], dim=1)
 
-        return torch.cat(walks, dim=0)
+        return contexts
 
-    def _neg_sample(self, node_ids: Tensor) -> Tensor:
+    def _neg_sample(self, node_ids: Tensor, pos_walks: Tensor) -> Tensor:
         batch = node_ids.repeat(self.hparams.walks_per_node * self.hparams.num_neg_samples)
 
-        rw = torch.randint(self.num_nodes, (batch.size(0), self.walk_length - 1))
+        rw = self.neg_sampler.sample(batch, self.walk_length - 1, pos_walks)
         rw = torch.cat([batch.view(-1, 1), rw], dim=-1)
 
-        walks = []
-        num_walks_per_rw = 1 + self.walk_length - self.hparams.context_size
-        for j in range(num_walks_per_rw):
-            walks.append(rw[:, j:j + self.hparams.context_size])
-        return torch.cat(walks, dim=0)
+        return rw
 
     def _infer_missing_timestamps(self, node_ids: Tensor) -> Tensor:
-        _, walks_timestamps = self._temporal_random_walk(node_ids, torch.full(node_ids.shape, NAN_TIMESTAMP))
-        n_timestamps = (walks_timestamps != NAN_TIMESTAMP).sum(dim=1)
-        timestamp_idx = randint_range(n_timestamps.clamp(min=1))
-
-        node_timestamps = torch.full(node_ids.shape, NAN_TIMESTAMP)
-        for i, (n, ti) in enumerate(zip(n_timestamps, timestamp_idx)):
-            if n > 0:
-                node_timestamps[i] = walks_timestamps[i, walks_timestamps[i] != NAN_TIMESTAMP][ti]
+        if self.timestamp_pool is not None:
+            return self.timestamp_pool.sample(node_ids)
 
-        return node_timestamps
+        _, walks_timestamps = self._temporal_random_walk(node_ids, torch.full(node_ids.shape, NAN_TIMESTAMP))
+        return pick_timestamps(walks_timestamps)
 
     def _temporal_random_walk(self, node_ids: Tensor, node_timestamps: Tensor) -> Tuple[Tensor, Tensor]:
         return tempo_random_walk(
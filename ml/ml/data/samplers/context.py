@@ -0,0 +1,64 @@
+from typing import List, Optional, Tuple
+
+import torch
+from torch import Tensor
+
+
+def context_windows(walks: Tensor, context_size: int) -> Tensor:
+    """
+    Sliding context windows over a batch of walks of shape (N, L) as a strided view of shape (N, L - context_size + 1,
+    context_size). The windows share the storage of the walks, nothing is copied while sampling. Pinning or moving the
+    batch to another device does copy them, the losses embed them once per walk position (see `SkipgramLoss.windows_Z`).
+    """
+    return walks.unfold(1, context_size, 1)
+
+
+class NodeRelabeler:
+    """
+    Relabels node ids to consecutive ids with a lookup table over all nodes. The table is allocated on first use,
+    hence once per data loader worker, and reused across batches. Every entry is written before it is read, so a batch
+    only touches the entries of its own ids and costs O(L + u log u) for L ids of which u unique, independent of the
+    number of nodes.
+    """
+    map: Optional[Tensor] = None
+    """Scratch map of shape (num_nodes,) from node id to a position or relabeled id. Entries are written before being
+    read"""
+
+    def __init__(self, num_nodes: int) -> None:
+        super().__init__()
+        self.num_nodes = num_nodes
+
+    def __call__(self, *walks: Tensor) -> Tuple[Tensor, List[Tensor]]:
+        return self.relabel(*walks)
+
+    def relabel(self, *walks: Tensor) -> Tuple[Tensor, List[Tensor]]:
+        """
+        Relabels the node ids of all given walks in a single pass.
+        Returns the sorted unique node ids and the relabeled walks (with their original shapes), same as torch.unique.
+        """
+        ids = torch.cat([w.reshape(-1).long() for w in walks])
+        if self.map is None or self.map.device != ids.device:
+            self.map = torch.empty(self.num_nodes, dtype=torch.long, device=ids.device)
+
+        # Of the positions of an id written to the map exactly one is kept, which marks one occurrence per id
+        pos = torch.arange(len(ids), device=ids.device)
+        self.map.index_copy_(0, ids, pos)
+        node_idx, _ = ids[self.map.index_select(0, ids) == pos].sort()
+
+        self.map.index_copy_(0, node_idx, torch.arange(len(node_idx), device=ids.device))
+        perm = self.map.index_select(0, ids)
+
+        return node_idx, [p.view(w.shape) for p, w in zip(perm.split([w.numel() for w in walks]), walks)]
+
+
+def walk_contexts(
+        relabel: NodeRelabeler, pos_walks: Tensor, neg_walks: Tensor, context_size: int
+) -> Tuple[Tensor, Tensor, Tensor]:
+    """
+    Turns positive and negative walks into relabeled context windows. The walks are relabeled before being windowed,
+    such that the relabel pass only touches each walk position once.
+
+    :return: Unique node ids, positive and negative windows of shape (N, W, context_size)
+    """
+    node_idx, (pos_walks, neg_walks) = relabel(pos_walks, neg_walks)
+    return node_idx, context_windows(pos_walks, context_size), context_windows(neg_walks, context_size)
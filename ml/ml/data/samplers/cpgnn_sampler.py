@@ -6,6 +6,7 @@ from torch import Tensor
 from torch_geometric.utils.num_nodes import maybe_num_nodes
 
 from ml.data.samplers.base import Sampler
+from ml.data.samplers.context import NodeRelabeler
 from ml.data.samplers.node2vec_sampler import Node2VecBatch, Node2VecSampler, Node2VecSamplerParams
 from ml.utils import HParams
 
@@ -35,6 +36,7 @@ class CPGNNSampler(Sampler):
         self.hparams = hparams or CPGNNSamplerParams()
 
         self.num_nodes = maybe_num_nodes(edge_index, num_nodes)
+        self.relabel = NodeRelabeler(self.num_nodes)
         self.transform_meta = transform_meta
 
         self.n2v = Node2VecSampler(
@@ -54,14 +56,10 @@ class CPGNNSampler(Sampler):
 
         pos_walks, neg_walks, node_idx = self.n2v.sample(node_ids)
 
-        pos_walks = torch.stack([pos_walks[:, 0], pos_walks[:, -1]], dim=1)
-        neg_walks = torch.stack([neg_walks[:, 0], neg_walks[:, -1]], dim=1)
-        walks = torch.cat([pos_walks, neg_walks], dim=0).view(-1)
-        walks = node_idx[walks]
-
-        node_idx, perm = torch.unique(walks.view(-1), return_inverse=True)
-        walks = perm.view(-1, 2)
-        pos_walks, neg_walks = walks[:pos_walks.shape[0]], walks[pos_walks.shape[0]:]
+        # Only the endpoints of the k long paths are kept
+        pos_walks = node_idx[torch.stack([pos_walks[..., 0], pos_walks[..., -1]], dim=-1).view(-1, 2)]
+        neg_walks = node_idx[torch.stack([neg_walks[..., 0], neg_walks[..., -1]], dim=-1).view(-1, 2)]
+        node_idx, (pos_walks, neg_walks) = self.relabel(pos_walks, neg_walks)
 
         node_meta = node_idx if self.transform_meta is None else self.transform_meta(node_idx)
         return k, Node2VecBatch(pos_walks, neg_walks, node_meta)
@@ -11,6 +11,9 @@ from torch_sparse import SparseTensor
 
 from datasets.utils.temporal import TemporalNodeIndex
 from ml.data.samplers.base import Sampler
+from ml.data.samplers.context import NodeRelabeler, walk_contexts
+from ml.data.samplers.negative import NegativeSampler
+from ml.data.samplers.walk_corpus import WalkCorpus
 from ml.data.samplers.node2vec_sampler import Node2VecBatch
 from ml.utils import HParams
 
@@ -39,6 +42,12 @@ class CTDNESamplerParams(HParams):
     """Number of random walks to start at each node."""
     num_neg_samples: int = 1
     """The number of negative samples to use for each positive sample."""
+    neg_alpha: float = 0.0
+    """Exponent of the degree^alpha distribution negatives are drawn from. 0 draws uniformly, word2vec uses 0.75."""
+    neg_per_type: bool = False
+    """Whether to draw negatives from the nodes of the same type as the walk head (if node types are given)."""
+    neg_in_batch: bool = False
+    """Whether to draw negatives from the nodes of the positive walks, which adds no new nodes to the batch."""
     walk_bias: BiasType = BiasType.Uniform
     """Distribution to use when choosing a random neighbour to walk through. 
     If set to 'Uniform', The initial edge is picked from a uniform distribution. 
@@ -56,6 +65,7 @@ class CTDNESampler(Sampler):
             node_timestamps: Tensor, edge_index: Tensor, edge_timestamps: Tensor,
             hparams: CTDNESamplerParams = None,
             transform_meta: Callable[[Tensor], Any] = None,
+            node_type: Tensor = None,
     ) -> None:
         """
         The Node2Vec model from the
@@ -79,17 +89,24 @@ class CTDNESampler(Sampler):
 
         self.temporal_index = TemporalNodeIndex().fit(node_timestamps, edge_index, edge_timestamps)
         self.num_nodes = len(node_timestamps)
+        self.relabel = NodeRelabeler(self.num_nodes)
+        self.corpus: Optional[WalkCorpus] = None
         self.row_ptrs, self.col_indices, self.perm = tch_native.to_csr(edge_index, self.num_nodes)
         self.node_timestamps = node_timestamps
         self.edge_timestamps = edge_timestamps[self.perm]
+        self.neg_sampler = NegativeSampler.from_csr(
+            self.row_ptrs, self.hparams.neg_alpha,
+            node_type if self.hparams.neg_per_type else None, self.hparams.neg_in_batch,
+        )
 
     def sample(self, node_ids: Tensor) -> Node2VecBatch:
-        pos_walks, neg_walks = self._pos_sample(node_ids), self._neg_sample(node_ids)
-        walks = torch.cat([pos_walks, neg_walks], dim=0).view(-1)
+        pos_walks = self.corpus.pos_sample(node_ids) if self.corpus is not None else None
+        if pos_walks is None:
+            pos_walks = self._pos_sample(node_ids)
 
-        node_idx, perm = torch.unique(walks.view(-1), return_inverse=True)
-        walks = perm.view(-1, self.hparams.context_size)
-        pos_walks, neg_walks = walks[:pos_walks.shape[0]], walks[pos_walks.shape[0]:]
+        node_idx, pos_walks, neg_walks = walk_contexts(
+            self.relabel, pos_walks, self._neg_sample(node_ids, pos_walks), self.hparams.context_size
+        )
 
         node_meta = node_idx if self.transform_meta is None else self.transform_meta(node_idx)
         return Node2VecBatch(pos_walks, neg_walks, node_meta)
@@ -109,20 +126,12 @@ class CTDNESampler(Sampler):
         # Fill "dead" reandom walks with root node
         rw[rw == -1] = rw[:, 0][:, None].repeat(1, rw.shape[1])[rw == -1]
 
-        walks = []
-        num_walks_per_rw = 1 + self.walk_length + 1 - self.hparams.context_size
-        for j in range(num_walks_per_rw):
-            walks.append(rw[:, j:j + self.hparams.context_size])
-        return torch.cat(walks, dim=0)
+        return rw[:, :self.walk_length + 1]
 
-    def _neg_sample(self, node_ids: Tensor) -> Tensor:
+    def _neg_sample(self, node_ids: Tensor, pos_walks: Tensor) -> Tensor:
         batch = node_ids.repeat(self.hparams.walks_per_node * self.hparams.num_neg_samples)
 
-        rw = torch.randint(self.num_nodes, (batch.size(0), self.walk_length - 1))
+        rw = self.neg_sampler.sample(batch, self.walk_length - 1, pos_walks)
         rw = torch.cat([batch.view(-1, 1), rw], dim=-1)
 
-        walks = []
-        num_walks_per_rw = 1 + self.walk_length - self.hparams.context_size
-        for j in range(num_walks_per_rw):
-            walks.append(rw[:, j:j + self.hparams.context_size])
-        return torch.cat(walks, dim=0)
+        return rw
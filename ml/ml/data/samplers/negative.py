@@ -0,0 +1,115 @@
+from typing import Optional, Tuple
+
+import torch
+from torch import Tensor
+
+
+def alias_table(probs: Tensor) -> Tuple[Tensor, Tensor]:
+    """
+    Alias table (Walker, Vose) of an unnormalized discrete distribution, such that drawing from it takes O(1).
+    The table is built in vectorized rounds. In every round all under-full entries are paired at once with the
+    over-full entries whose surplus covers the start of their deficit (both laid out back to back). Over-full entries
+    that are drawn below one become under-full entries of the next round.
+
+    :return: Acceptance probabilities and aliases of shape (n,)
+    """
+    n = len(probs)
+    q = probs.double() * n / probs.sum()
+    prob = torch.ones(n, dtype=torch.double)
+    alias = torch.arange(n)
+
+    small, large = (q < 1).nonzero().view(-1), (q >= 1).nonzero().view(-1)
+    while len(small) > 0 and len(large) > 0:
+        deficit = 1 - q[small]
+        start = deficit.cumsum(0) - deficit
+        j = torch.searchsorted((q[large] - 1).cumsum(0), start, right=True).clamp_max(len(large) - 1)
+
+        prob[small] = q[small]
+        alias[small] = large[j]
+        q.index_add_(0, large[j], -deficit)
+
+        drained = q[large] < 1
+        small, large = large[drained], large[~drained]
+
+    return prob.clamp(0, 1).float(), alias
+
+
+class NegativeSampler:
+    """
+    Draws negative nodes from a degree^alpha unigram distribution (as in word2vec) with alias tables.
+    Given node types, negatives are drawn from the nodes of the same type as the walk head. With in_batch, negatives
+    are drawn from the nodes of the positive walks instead, which adds no new nodes to the batch.
+    """
+    prob: Optional[Tensor] = None
+    """Acceptance probabilities of the alias tables of shape (num_nodes,), indexed by position in perm"""
+    alias: Optional[Tensor] = None
+    """Aliases of the alias tables of shape (num_nodes,), indexed by position in perm"""
+
+    def __init__(
+            self,
+            degree: Tensor,
+            alpha: float = 0.0,
+            node_type: Tensor = None,
+            in_batch: bool = False,
+    ) -> None:
+        """
+        :param degree: Degree of each node of shape (num_nodes,)
+        :param alpha: Exponent of the degree distribution. Zero draws uniformly
+        :param node_type: Type of each node of shape (num_nodes,). Each type gets its own distribution if given
+        :param in_batch: Whether to draw negatives from the positive walks of the batch
+        """
+        super().__init__()
+        self.num_nodes = len(degree)
+        self.in_batch = in_batch
+        self.node_type = node_type
+
+        if alpha == 0.0 and node_type is None:
+            return
+
+        weights = degree.double().pow(alpha)
+        if node_type is None:
+            self.perm, self.ptr = None, torch.tensor([0, self.num_nodes])
+        else:
+            self.perm = torch.sort(node_type, stable=True).indices
+            counts = torch.bincount(node_type)
+            self.ptr = torch.cat([counts.new_zeros(1), counts.cumsum(0)])
+            weights = weights[self.perm]
+
+        self.prob = torch.ones(self.num_nodes)
+        self.alias = torch.arange(self.num_nodes)
+        for start, end in zip(self.ptr[:-1].tolist(), self.ptr[1:].tolist()):
+            w = weights[start:end]
+            if end == start or w.sum() <= 0:
+                continue
+
+            self.prob[start:end], alias = alias_table(w)
+            self.alias[start:end] = alias + start
+
+    @staticmethod
+    def from_csr(row_ptrs: Tensor, alpha: float = 0.0, node_type: Tensor = None, in_batch: bool = False):
+        return NegativeSampler(row_ptrs[1:] - row_ptrs[:-1], alpha, node_type, in_batch)
+
+    def sample(self, heads: Tensor, num_samples: int, pos_walks: Tensor = None) -> Tensor:
+        """
+        Draws num_samples negatives for every walk head.
+
+        :param pos_walks: Positive walks of the batch (required for in batch negatives)
+        :return: Negative nodes of shape (len(heads), num_samples)
+        """
+        shape = (len(heads), num_samples)
+        if self.in_batch and pos_walks is not None:
+            nodes = pos_walks.reshape(-1)
+            return nodes[torch.randint(len(nodes), shape)].long()
+
+        if self.prob is None:
+            return torch.randint(self.num_nodes, shape)
+
+        if self.node_type is None:
+            low, size = self.ptr[0], self.ptr[1] - self.ptr[0]
+        else:
+            t = self.node_type[heads].unsqueeze(1)
+            low, size = self.ptr[t], self.ptr[t + 1] - self.ptr[t]
+
+        idx = low + (torch.rand(shape) * size).long().clamp_max(size - 1)
+        idx = torch.where(torch.rand(shape) < self.prob[idx], idx, self.alias[idx])
+        return idx if self.perm is None else self.perm[idx]
@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from dataclasses import dataclass
-from typing import Any, NamedTuple, Callable
+from typing import Any, NamedTuple, Callable, Optional
 
 import torch
 from torch import Tensor
@@ -8,6 +8,9 @@ from torch_geometric.utils.num_nodes import maybe_num_nodes
 from torch_sparse import SparseTensor
 
 from ml.data.samplers.base import Sampler
+from ml.data.samplers.context import NodeRelabeler, walk_contexts
+from ml.data.samplers.negative import NegativeSampler
+from ml.data.samplers.walk_corpus import WalkCorpus
 from ml.utils import HParams
 
 try:
@@ -31,6 +34,12 @@ class Node2VecSamplerParams(HParams):
     """Number of random walks to start at each node."""
     num_neg_samples: int = 1
     """The number of negative samples to use for each positive sample."""
+    neg_alpha: float = 0.0
+    """Exponent of the degree^alpha distribution negatives are drawn from. 0 draws uniformly, word2vec uses 0.75."""
+    neg_per_type: bool = False
+    """Whether to draw negatives from the nodes of the same type as the walk head (if node types are given)."""
+    neg_in_batch: bool = False
+    """Whether to draw negatives from the nodes of the positive walks, which adds no new nodes to the batch."""
     p: float = 1
     """Likelihood of immediately revisiting a node in the walk."""
     q: float = 0.5
@@ -45,6 +54,7 @@ class Node2VecSampler(Sampler):
             num_nodes=None,
             hparams: Node2VecSamplerParams = None,
             transform_meta: Callable[[Tensor], Any] = None,
+            node_type: Tensor = None,
     ) -> None:
         """
         The Node2Vec model from the
@@ -65,18 +75,25 @@ class Node2VecSampler(Sampler):
         self.transform_meta = transform_meta
 
         self.num_nodes = maybe_num_nodes(edge_index, num_nodes)
+        self.relabel = NodeRelabeler(self.num_nodes)
+        self.corpus: Optional[WalkCorpus] = None
         self.walk_length = self.hparams.walk_length - 1
 
         row, col = edge_index
         self.adj = SparseTensor(row=row, col=col, sparse_sizes=(self.num_nodes, self.num_nodes)).to('cpu')
+        self.neg_sampler = NegativeSampler.from_csr(
+            self.adj.storage.rowptr(), self.hparams.neg_alpha,
+            node_type if self.hparams.neg_per_type else None, self.hparams.neg_in_batch,
+        )
 
     def sample(self, node_ids: Tensor) -> Node2VecBatch:
-        pos_walks, neg_walks = self._pos_sample(node_ids), self._neg_sample(node_ids)
-        walks = torch.cat([pos_walks, neg_walks], dim=0).view(-1)
+        pos_walks = self.corpus.pos_sample(node_ids) if self.corpus is not None else None
+        if pos_walks is None:
+            pos_walks = self._pos_sample(node_ids)
 
-        node_idx, perm = torch.unique(walks.view(-1), return_inverse=True)
-        walks = perm.view(-1, self.hparams.context_size)
-        pos_walks, neg_walks = walks[:pos_walks.shape[0]], walks[pos_walks.shape[0]:]
+        node_idx, pos_walks, neg_walks = walk_contexts(
+            self.relabel, pos_walks, self._neg_sample(node_ids, pos_walks), self.hparams.context_size
+        )
 
         node_meta = node_idx if self.transform_meta is None else self.transform_meta(node_idx)
         return Node2VecBatch(pos_walks, neg_walks, node_meta)
@@ -88,20 +105,12 @@ class Node2VecSampler(Sampler):
         if not isinstance(rw, Tensor):
             rw = rw[0]
 
-        walks = []
-        num_walks_per_rw = 1 + self.walk_length + 1 - self.hparams.context_size
-        for j in range(num_walks_per_rw):
-            walks.append(rw[:, j:j + self.hparams.context_size])
-        return torch.cat(walks, dim=0)
+        return rw
 
-    def _neg_sample(self, node_ids: Tensor) -> Tensor:
+    def _neg_sample(self, node_ids: Tensor, pos_walks: Tensor) -> Tensor:
         batch = node_ids.repeat(self.hparams.walks_per_node * self.hparams.num_neg_samples)
 
-        rw = torch.randint(self.adj.sparse_size(0), (batch.size(0), self.walk_length))
+        rw = self.neg_sampler.sample(batch, self.walk_length, pos_walks)
         rw = torch.cat([batch.view(-1, 1), rw], dim=-1)
 
-        walks = []
-        num_walks_per_rw = 1 + self.walk_length + 1 - self.hparams.context_size
-        for j in range(num_walks_per_rw):
-            walks.append(rw[:, j:j + self.hparams.context_size])
-        return torch.cat(walks, dim=0)
+        return rw
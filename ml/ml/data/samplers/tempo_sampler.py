@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Tuple, Callable, Any
+from typing import Tuple, Callable, Any, Optional
 
 import torch
 from torch import Tensor
@@ -8,8 +8,12 @@ from typing_extensions import Self
 from datasets.utils.temporal import TemporalNodeIndex
 from ml.data.samplers.ballroom_sampler import BallroomSamplerParams
 from ml.data.samplers.base import Sampler
+from ml.data.samplers.context import NodeRelabeler, walk_contexts
+from ml.data.samplers.negative import NegativeSampler
+from ml.data.samplers.timestamps import TimestampPool, pick_timestamps
+from ml.data.samplers.walk_corpus import WalkCorpus
 from ml.data.samplers.node2vec_sampler import Node2VecBatch
-from ml.utils import HParams, randint_range
+from ml.utils import HParams
 
 try:
     import tch_geometric.tch_geometric as tch_native
@@ -29,6 +33,7 @@ class TemporalSampler(Sampler):
             window: Tuple[int, int],
             hparams: BallroomSamplerParams = None,
             transform_meta: Callable[[Tensor], Any] = None,
+            node_type: Tensor = None,
     ) -> None:
         super().__init__()
 
@@ -42,22 +47,40 @@ class TemporalSampler(Sampler):
 
         self.temporal_index = TemporalNodeIndex().fit(node_timestamps, edge_index, edge_timestamps)
         self.num_nodes = len(node_timestamps)
+        self.relabel = NodeRelabeler(self.num_nodes)
+        self.corpus: Optional[WalkCorpus] = None
         self.row_ptrs, self.col_indices, self.perm = tch_native.to_csr(edge_index, self.num_nodes)
         self.node_timestamps = node_timestamps
         self.edge_timestamps = edge_timestamps[self.perm]
+        self.neg_sampler = NegativeSampler.from_csr(
+            self.row_ptrs, self.hparams.neg_alpha,
+            node_type if self.hparams.neg_per_type else None, self.hparams.neg_in_batch,
+        )
+        self.timestamp_pool = TimestampPool(
+            self.temporal_index, self.num_nodes, self._temporal_random_walk, self.hparams.timestamp_pool_walks
+        ) if self.hparams.timestamp_pool_walks > 0 else None
+        self.num_sampled = 0
 
     def sample(self, node_ids: Tensor) -> Node2VecBatch:
-        pos_walks, neg_walks = self._pos_sample(node_ids), self._neg_sample(node_ids)
-        walks = torch.cat([pos_walks, neg_walks], dim=0).view(-1)
+        pos_walks = self.corpus.pos_sample(node_ids) if self.corpus is not None else None
+        if pos_walks is None:
+            pos_walks = self._pos_sample(node_ids)
 
-        node_idx, perm = torch.unique(walks.view(-1), return_inverse=True)
-        walks = perm.view(-1, self.hparams.context_size)
-        pos_walks, neg_walks = walks[:pos_walks.shape[0]], walks[pos_walks.shape[0]:]
+        node_idx, pos_walks, neg_walks = walk_contexts(
+            self.relabel, pos_walks, self._neg_sample(node_ids, pos_walks), self.hparams.context_size
+        )
 
         node_meta = node_idx if self.transform_meta is None else self.transform_meta(node_idx)
         return Node2VecBatch(pos_walks, neg_walks, node_meta)
 
     def _pos_sample(self, node_ids: Tensor) -> Tensor:
+        # Resample the candidate timestamps every timestamp_pool_refresh epochs
+        self.num_sampled += len(node_ids)
+        refresh_after = self.hparams.timestamp_pool_refresh * self.num_nodes
+        if self.timestamp_pool is not None and 0 < refresh_after <= self.num_sampled:
+            self.timestamp_pool.refresh()
+            self.num_sampled = 0
+
         node_timestamps = self.temporal_index.node_to_timestamp(node_ids)
 
         # Infer timestamps for nodes that have no timestamp
@@ -77,25 +100,20 @@ class TemporalSampler(Sampler):
         walks = neighbor_idx.reshape(-1, self.hparams.context_size)
         return walks
 
-    def _neg_sample(self, node_ids: Tensor) -> Tensor:
+    def _neg_sample(self, node_ids: Tensor, pos_walks: Tensor) -> Tensor:
         batch = node_ids.repeat(self.hparams.walks_per_node * self.hparams.num_neg_samples)
 
-        rw = torch.randint(self.num_nodes, (batch.size(0), self.hparams.context_size - 1))
+        rw = self.neg_sampler.sample(batch, self.hparams.context_size - 1, pos_walks)
         walks = torch.cat([batch.view(-1, 1), rw], dim=-1)
 
         return walks
 
     def _infer_missing_timestamps(self, node_ids: Tensor) -> Tensor:
-        _, walks_timestamps = self._temporal_random_walk(node_ids, torch.full(node_ids.shape, NAN_TIMESTAMP))
-        n_timestamps = (walks_timestamps != NAN_TIMESTAMP).sum(dim=1)
-        timestamp_idx = randint_range(n_timestamps.clamp(min=1))
-
-        node_timestamps = torch.full(node_ids.shape, NAN_TIMESTAMP)
-        for i, (n, ti) in enumerate(zip(n_timestamps, timestamp_idx)):
-            if n > 0:
-                node_timestamps[i] = walks_timestamps[i, walks_timestamps[i] != NAN_TIMESTAMP][ti]
+        if self.timestamp_pool is not None:
+            return self.timestamp_pool.sample(node_ids)
 
-        return node_timestamps
+        _, walks_timestamps = self._temporal_random_walk(node_ids, torch.full(node_ids.shape, NAN_TIMESTAMP))
+        return pick_timestamps(walks_timestamps)
 
     def _temporal_random_walk(self, node_ids: Tensor, node_timestamps: Tensor) -> Tuple[Tensor, Tensor]:
         return tempo_random_walk(
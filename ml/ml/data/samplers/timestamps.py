@@ -0,0 +1,99 @@
+from typing import Callable, Tuple
+
+import torch
+from torch import Tensor
+
+from datasets.utils.temporal import NAN_TIMESTAMP, TemporalNodeIndex
+from ml.utils import randint_range
+
+TemporalWalkFn = Callable[[Tensor, Tensor], Tuple[Tensor, Tensor]]
+
+
+def pick_timestamps(walks_timestamps: Tensor) -> Tensor:
+    """
+    Picks a random valid timestamp from every row of walks_timestamps of shape (N, L).
+    Rows without any valid timestamp get NAN_TIMESTAMP.
+    """
+    mask = walks_timestamps != NAN_TIMESTAMP
+    n_timestamps = mask.sum(dim=1)
+    timestamp_idx = randint_range(n_timestamps.clamp(min=1))
+
+    # Position of the picked valid timestamp within its row
+    pick = mask & (mask.cumsum(dim=1) == (timestamp_idx + 1).unsqueeze(1))
+    timestamps = walks_timestamps.gather(1, pick.int().argmax(dim=1, keepdim=True)).squeeze(1)
+
+    return torch.where(n_timestamps > 0, timestamps, torch.full_like(timestamps, NAN_TIMESTAMP))
+
+
+class TimestampPool:
+    """
+    Candidate timestamps for the nodes without a timestamp. The set of these nodes is fixed, so their candidates are
+    collected once from temporal random walks and stored back to back (CSR), after which inferring the timestamps of
+    a batch is a single gather.
+    """
+
+    def __init__(
+            self,
+            temporal_index: TemporalNodeIndex,
+            num_nodes: int,
+            walk_fn: TemporalWalkFn,
+            num_walks: int = 10,
+            max_rows: int = 2 ** 16,
+    ) -> None:
+        """
+        :param walk_fn: Temporal random walk returning the visited nodes and timestamps for given start nodes
+        :param num_walks: Number of walks started from each node to collect its candidates
+        :param max_rows: Maximum number of walks sampled at once
+        """
+        super().__init__()
+        self.walk_fn = walk_fn
+        self.num_walks = num_walks
+        self.max_rows = max_rows
+
+        missing = torch.ones(num_nodes, dtype=torch.bool)
+        missing[temporal_index.node_ids] = False
+        self.node_ids = missing.nonzero().view(-1)
+        self.node_pos = torch.full((num_nodes,), -1, dtype=torch.long)
+        self.node_pos[self.node_ids] = torch.arange(len(self.node_ids))
+
+        self.refresh()
+
+    def refresh(self) -> None:
+        """
+        Resamples the candidate timestamps of all nodes without a timestamp.
+        """
+        node_pos, timestamps = [], []
+        batch = self.node_ids.repeat(self.num_walks)
+        for start in range(0, len(batch), self.max_rows):
+            nodes = batch[start:start + self.max_rows]
+            _, walks_timestamps = self.walk_fn(nodes, torch.full_like(nodes, NAN_TIMESTAMP))
+            row, col = (walks_timestamps != NAN_TIMESTAMP).nonzero(as_tuple=True)
+            node_pos.append(self.node_pos[nodes[row]])
+            timestamps.append(walks_timestamps[row, col])
+
+        node_pos = torch.cat(node_pos) if len(node_pos) > 0 else torch.empty(0, dtype=torch.long)
+        timestamps = torch.cat(timestamps) if len(timestamps) > 0 else torch.empty(0, dtype=torch.long)
+
+        perm = torch.sort(node_pos, stable=True).indices
+        self.timestamps = timestamps[perm]
+        self.ptr = torch.cat([
+            torch.zeros(1, dtype=torch.long),
+            torch.bincount(node_pos, minlength=len(self.node_ids)).cumsum(0)
+        ])
+
+    def sample(self, node_ids: Tensor) -> Tensor:
+        """
+        Picks a random candidate timestamp for each of the given nodes (without a timestamp). Nodes without candidates
+        get NAN_TIMESTAMP.
+        """
+        pos = self.node_pos[node_ids]
+        assert (pos >= 0).all(), 'pool only holds nodes without a timestamp'
+
+        ptr_from, counts = self.ptr[pos], self.ptr[pos + 1] - self.ptr[pos]
+        result = torch.full_like(node_ids, NAN_TIMESTAMP)
+        has_candidates = counts > 0
+        result[has_candidates] = self.timestamps[
+            randint_range(counts[has_candidates]) + ptr_from[has_candidates]
+        ]
+
+        return result
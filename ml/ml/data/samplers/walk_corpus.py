@@ -0,0 +1,161 @@
+import hashlib
+import multiprocessing
+import os
+from pathlib import Path
+from typing import Optional, List
+
+import numpy as np
+import torch
+from torch import Tensor
+
+from ml.data.samplers.base import Sampler
+from shared import get_logger, CACHE_PATH
+
+logger = get_logger(Path(__file__).stem)
+
+WALK_CORPUS_PATH = CACHE_PATH / 'walks'
+
+
+def graph_hash(*tensors: Tensor) -> str:
+    h = hashlib.sha1()
+    for t in tensors:
+        h.update(str((t.dtype, tuple(t.shape))).encode())
+        h.update(t.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def corpus_node_order(num_nodes: int, walk_set: int) -> Tensor:
+    """
+    Order in which walk set walk_set visits the nodes. Depends only on the number of nodes, such that corpora of
+    different samplers over the same nodes share their batches.
+    """
+    generator = torch.Generator().manual_seed(walk_set)
+    return torch.randperm(num_nodes, generator=generator)
+
+
+class WalkCorpus:
+    """
+    Precomputed positive walks of a walk sampler. The corpus consists of num_sets walk sets over all nodes, each stored
+    as a memory-mapped int32 file. Walk set r visits the nodes in corpus_node_order(num_nodes, r) in batches of
+    batch_size, and the walks of every batch are stored contiguously. A loader visiting the nodes in the same order
+    therefore gets its walks as zero-copy slices of the file. Epochs rotate through the walk sets. The walk set of the
+    current epoch is kept in shared memory, such that copies of the corpus in (persistent) loader workers follow it.
+
+    Corpora are keyed by a hash of the graph, the sampler and its params, and are shared across runs.
+    """
+    walk_set: Optional[int] = None
+    """Walk set loaded by this copy of the corpus"""
+    walks: Optional[np.ndarray] = None
+    """Memory-mapped walks of the current walk set of shape (num_nodes * rows_per_node, walk_length)"""
+    perm: Optional[Tensor] = None
+    """Node order of the current walk set of shape (num_nodes,)"""
+
+    def __init__(
+            self,
+            sampler: Sampler,
+            num_nodes: int,
+            num_sets: int,
+            batch_size: int,
+            graph_key: str,
+            root: Path = WALK_CORPUS_PATH,
+    ) -> None:
+        super().__init__()
+        self.sampler = sampler
+        self.num_nodes = num_nodes
+        self.num_sets = num_sets
+        self.batch_size = batch_size
+
+        key = hashlib.sha1(str((
+            graph_key, type(sampler).__name__, sampler.hparams.to_dict(), getattr(sampler, 'window', None),
+            num_nodes, batch_size,
+        )).encode()).hexdigest()
+        self.path = Path(root) / key
+        self.epoch_walk_set = torch.full((1,), -1, dtype=torch.long).share_memory_()
+        """Walk set of the current epoch, shared with the copies of the corpus in loader workers"""
+
+    def set_path(self, walk_set: int) -> Path:
+        return self.path / f'{walk_set}.npy'
+
+    def missing_sets(self) -> List[int]:
+        return [r for r in range(self.num_sets) if not self.set_path(r).exists()]
+
+    def build(self, background: bool = False) -> 'WalkCorpus':
+        """
+        Samples the walk sets that are not stored yet. In the background, epochs sample their walks on the fly until
+        their walk set is ready.
+        """
+        missing = self.missing_sets()
+        if len(missing) == 0:
+            return self
+
+        logger.info(f'Building {len(missing)} walk sets in {self.path}')
+        if background:
+            process = multiprocessing.get_context('fork').Process(target=self._build_sets, args=(missing,), daemon=True)
+            process.start()
+        else:
+            self._build_sets(missing)
+
+        return self
+
+    def _build_sets(self, walk_sets: List[int]) -> None:
+        self.path.mkdir(parents=True, exist_ok=True)
+        for r in walk_sets:
+            perm = corpus_node_order(self.num_nodes, r)
+            tmp_path = self.path / f'{r}.{os.getpid()}.tmp.npy'
+
+            walks = None
+            for start in range(0, self.num_nodes, self.batch_size):
+                batch_walks = self.sampler._pos_sample(perm[start:start + self.batch_size])
+                if walks is None:
+                    rows_per_node = len(batch_walks) // min(self.batch_size, self.num_nodes)
+                    walks = np.lib.format.open_memmap(
+                        tmp_path, mode='w+', dtype=np.int32,
+                        shape=(self.num_nodes * rows_per_node, batch_walks.shape[1])
+                    )
+
+                rows_per_node = len(walks) // self.num_nodes
+                walks[start * rows_per_node:start * rows_per_node + len(batch_walks)] = batch_walks.numpy()
+
+            walks.flush()
+            del walks
+            # Readers only ever see complete walk sets
+            os.replace(tmp_path, self.set_path(r))
+
+    def set_epoch(self, epoch: int) -> Tensor:
+        """
+        Switches to the walk set of the given epoch. Returns the node order the loader should visit the nodes in.
+        """
+        self.epoch_walk_set.fill_(epoch % self.num_sets)
+        self._load(epoch % self.num_sets)
+        if self.walks is None:
+            logger.warning(f'Walk set {self.walk_set} is not ready, sampling walks on the fly')
+
+        return self.perm
+
+    def _load(self, walk_set: int) -> None:
+        self.walk_set = walk_set
+        self.perm = corpus_node_order(self.num_nodes, self.walk_set)
+        self.inv_perm = torch.empty_like(self.perm)
+        self.inv_perm[self.perm] = torch.arange(self.num_nodes)
+
+        path = self.set_path(self.walk_set)
+        self.walks = np.load(path, mmap_mode='c') if path.exists() else None
+
+    def pos_sample(self, node_ids: Tensor) -> Optional[Tensor]:
+        """
+        Stored walks of a batch of nodes as a zero-copy view of the corpus. Returns None if the walk set is not ready
+        or the batch does not match a stored batch.
+        """
+        walk_set = int(self.epoch_walk_set)
+        if walk_set != self.walk_set and walk_set >= 0:
+            self._load(walk_set)
+        if self.walks is None or len(node_ids) == 0:
+            return None
+
+        start = int(self.inv_perm[node_ids[0]])
+        end = min(start + self.batch_size, self.num_nodes)
+        if start % self.batch_size != 0 or not torch.equal(self.perm[start:end], node_ids):
+            return None
+
+        rows_per_node = len(self.walks) // self.num_nodes
+        return torch.from_numpy(self.walks[start * rows_per_node:end * rows_per_node])
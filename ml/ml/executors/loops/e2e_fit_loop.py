@@ -1,5 +1,6 @@
 from functools import partial
 from pathlib import Path
+from typing import Iterator
 
 import torch
 import wandb
@@ -18,6 +19,25 @@ from shared import get_logger
 logger = get_logger(Path(__file__).stem)
 
 
+class EmbeddingStream:
+    """
+    Re-iterable stream of the node embeddings of the model, computed batch by batch on the model device and moved
+    to the host.
+    """
+
+    def __init__(self, loop: 'E2EFitLoop', dataloader) -> None:
+        super().__init__()
+        self.loop = loop
+        self.dataloader = dataloader
+
+    def __iter__(self) -> Iterator[Tensor]:
+        for batch in self.dataloader:
+            batch = self.loop.trainer._call_strategy_hook("batch_to_device", batch, dataloader_idx=0)
+            with torch.no_grad():
+                X = self.loop.model.forward_homogenous(batch).cpu()
+            yield X
+
+
 class E2EFitLoop(FitLoop, EMCallback):
     def __init__(
         self,
@@ -29,7 +49,12 @@ class E2EFitLoop(FitLoop, EMCallback):
         n_cluster_epochs: int = 100,
         checkpoint_callback: ModelCheckpoint = None,
         skip_pretraining: bool = False,
+        cluster_stochastic: bool = False,
     ) -> None:
+        """
+        :param cluster_stochastic: Fit the clustering with stochastic EM over the embeddings of each batch, such
+            that the embeddings of all nodes are never concatenated
+        """
         super().__init__(min_epochs, max_epochs)
         self.epoch_cycle_progress = Progress()
         self.epoch_feat_progress = Progress()
@@ -46,6 +71,7 @@ class E2EFitLoop(FitLoop, EMCallback):
         self.sample_space_version = 0
         self.pretraining = True
         self.skip_pretraining = skip_pretraining
+        self.cluster_stochastic = cluster_stochastic
         self.X = None
 
     @property
@@ -106,6 +132,9 @@ class E2EFitLoop(FitLoop, EMCallback):
             self.model.sample_space_version += 1
 
     def run_cluster(self) -> None:
+        if self.cluster_stochastic:
+            return self.run_cluster_stochastic()
+
         self.model.stage = ClusteringStage.GatherSamples
         dataloader = self.datamodule.cluster_dataloader()
         dataloader = self.trainer.strategy.process_dataloader(dataloader)
@@ -130,21 +159,52 @@ class E2EFitLoop(FitLoop, EMCallback):
         self.model.r_prev = self.model.cluster_model.estimate_log_resp(self.X).exp().to(self.model.device)
         self.X = None
 
+    def run_cluster_stochastic(self) -> None:
+        """
+        Fits the clustering on the stream of node embeddings. Predictions and responsibilities are computed in a
+        single pass over the stream once the fit is done.
+        """
+        dataloader = self.trainer.strategy.process_dataloader(self.datamodule.cluster_dataloader())
+        embeddings = EmbeddingStream(self, dataloader)
+
+        self.model.stage = ClusteringStage.Clustering
+        self.model.cluster_model.fit_stochastic(
+            embeddings,
+            n_samples=self.datamodule.train_data.num_nodes,
+            max_iter=self.n_cluster_epochs,
+            incremental=self.model.cluster_model.is_fitted,
+            callbacks=[self],
+        )
+
+        outputs, r = [], []
+        for X_b in embeddings:
+            z, zi = self.model.cluster_model.predict_full(X_b)
+            outputs.append({'X': X_b, 'z': z, 'zi': zi})
+            r.append(self.model.cluster_model.estimate_log_resp(X_b).exp())
+
+        self.model.r_prev = torch.cat(r, dim=0).to(self.model.device)
+        self.model.val_outputs = OutputExtractor(outputs)
+        self.trainer._call_callback_hooks("on_validation_epoch_end")
+        self.trainer._call_callback_hooks("on_validation_end")
+
     def on_before_step(self, model: 'BaseMixture') -> None:
         self.on_advance_start()
         self.epoch_feat_progress.increment_ready()
         self.epoch_feat_progress.increment_started()
 
     def on_after_step(self, _model: BaseMixture, lower_bound: Tensor) -> None:
-        z, zi = self.model.cluster_model.predict_full(self.X)
-        self.model.val_outputs = OutputExtractor([{'X': self.X, 'z': z, 'zi': zi}])
+        if self.X is not None:
+            z, zi = self.model.cluster_model.predict_full(self.X)
+            self.model.val_outputs = OutputExtractor([{'X': self.X, 'z': z, 'zi': zi}])
 
         self.epoch_feat_progress.increment_processed()
         self.epoch_feat_progress.increment_completed()
         self.epoch_loop.batch_loop.optimizer_loop.optim_progress.optimizer.step.increment_completed()
         self.on_advance_end()
-        self.trainer._call_callback_hooks("on_validation_epoch_end")
-        self.trainer._call_callback_hooks("on_validation_end")
+        if self.X is not None:
+            # Stochastic fits are validated once they are done (see run_cluster_stochastic)
+            self.trainer._call_callback_hooks("on_validation_epoch_end")
+            self.trainer._call_callback_hooks("on_validation_end")
         self.model.pretraining = False
         self.pretraining = False
 
@@ -1,8 +1,10 @@
+import time
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Optional, Type, List
 
 import torch
+import wandb
 from pytorch_lightning import LightningDataModule, Callback
 from pytorch_lightning.trainer.states import RunningStage
 from torch import Tensor
@@ -10,6 +12,7 @@ from torch.utils.data import Dataset
 
 from datasets import GraphDataset
 from datasets.utils.graph_dataset import DATASET_REGISTRY
+from ml.algo.clustering import KMeansCoreset
 from ml.algo.dpmm.base import EMCallback, BaseMixture
 from ml.callbacks.clustering_eval_callback import ClusteringEvalCallback
 from ml.callbacks.clustering_visualizer_callback import ClusteringVisualizerCallback
@@ -20,7 +23,7 @@ from ml.executors.base import BaseExecutorArgs, BaseExecutor
 from ml.executors.loops.trainless_fit_loop import TrainlessFitLoop
 from ml.models.mgcom_comdet import MGCOMComDetDataModuleParams, MGCOMComDetDataModule, MGCOMComDetModel, \
     MGCOMComDetModelParams
-from ml.utils import dataset_choices, DataLoaderParams, TrainerParams
+from ml.utils import dataset_choices, DataLoaderParams, TrainerParams, unique_count
 from ml.utils.outputs import OutputExtractor
 from ml.utils.training import override_trainer_state
 from shared import get_logger
@@ -31,6 +34,14 @@ TASK_NAME = 'community_detection'
 logger = get_logger(EXECUTOR_NAME)
 
 
+def track_clusters(z_prev: Tensor, z: Tensor, k_prev: int, k: int) -> Tensor:
+    """
+    Links every cluster to the cluster of the previous snapshot it shares the most points with.
+    """
+    overlap = unique_count(z_prev * k + z, k_prev * k).reshape(k_prev, k)
+    return overlap.argmax(dim=0)
+
+
 @dataclass
 class Args(BaseExecutorArgs):
     dataset: str = dataset_choices()
@@ -84,23 +95,143 @@ class MGCOMComDetExecutor(BaseExecutor[MGCOMComDetModel]):
         # self.trainer.strategy.model = self.model
 
         loader = self.datamodule.predict_dataloader()
-        X = torch.cat([batch for batch in loader], dim=0)
         # z_init = torch.cat(list(self.datamodule.graph_dataset.data.louvain_dict.values()), dim=0)
         z_init = None
 
+        masks = None
+        if args.hparams.temporal:
+            masks = self.datamodule.snapshot_masks(args.hparams.temporal_snapshots)
+            if masks is None:
+                self.logger.warning('Dataset does not define snapshots, fitting on all embeddings at once')
+
+        # Stochastic EM streams the batches of the loader, such that the embeddings are never concatenated
+        stochastic = args.hparams.stochastic and masks is None
+        X = torch.cat([batch for batch in loader], dim=0) if not stochastic else None
+
+        # Clustering is fit on a weighted coreset while predictions are made for all points
+        start_time = time.time()
+        X_fit, weights = X, None
+        use_coreset = args.hparams.coreset_size is not None and not stochastic and masks is None
+        if use_coreset:
+            coreset = KMeansCoreset(
+                X.shape[1], args.hparams.coreset_size, args.hparams.coreset_k, metric=args.hparams.metric
+            ).fit(X)
+            X_fit, weights = coreset.sample(X), coreset.weights
+            if args.hparams.coreset_rescale:
+                weights = weights * len(coreset.idx) / weights.sum()
+            self.logger.info(f'Fitting on a coreset of {len(X_fit)} out of {len(X)} points')
+
+        # Fits that don't see all points at once, or run their restarts in workers, predict all points once they
+        # are done
+        parallel = args.hparams.n_restart > 1 and args.hparams.n_restart_jobs > 1 and masks is None
+        predict_after_fit = stochastic or use_coreset or parallel
+
         class MyLoop(TrainlessFitLoop, EMCallback):
             def do_advance_loop(self):
                 self._restarting = False
                 self.on_advance_start()
-                model.cluster_model.fit(
-                    X, callbacks=[self], z_init=z_init,
-                    max_iter=args.trainer_params.max_epochs,
-                    n_init=args.hparams.n_restart,
-                )
+                if masks is not None:
+                    self.fit_snapshots()
+                elif stochastic:
+                    model.cluster_model.fit_stochastic(
+                        loader, callbacks=[self],
+                        max_iter=args.trainer_params.max_epochs,
+                    )
+                else:
+                    model.cluster_model.fit(
+                        X_fit, callbacks=[self], z_init=z_init,
+                        max_iter=args.trainer_params.max_epochs,
+                        n_init=args.hparams.n_restart,
+                        n_jobs=args.hparams.n_restart_jobs,
+                        weights=weights,
+                    )
+                trainer.logger.log_metrics({
+                    'fit_time': time.time() - start_time,
+                    'fit_size': len(X_fit) if X_fit is not None else len(loader.dataset),
+                })
+                if predict_after_fit:
+                    self.predict_all()
                 self.on_advance_end()
 
+            def predict_all(self):
+                """
+                Predicts all points in a single pass after a coreset, stochastic or parallel fit. Stochastic fits
+                predict the batches of the loader and keep the outputs per batch.
+                """
+                predict_time = time.time()
+                outputs = []
+                for X_b in (loader if stochastic else [X]):
+                    z, zi = model.cluster_model.predict_full(X_b)
+                    outputs.append({'X': X_b, 'z': z, 'zi': zi})
+
+                model.val_outputs = OutputExtractor(outputs)
+                trainer.logger.log_metrics({'predict_time': time.time() - predict_time})
+
+            def fit_snapshots(self):
+                """
+                Fits the snapshots in order. Each fit continues from the posterior and keeps the prior of the first
+                snapshot. Points that leave the data are not revisited: their sufficient statistics are carried into
+                the later fits with counts decayed once per snapshot (see DPMSC.carry_points). Points that stay are
+                fitted in every snapshot and do not decay. Points that return after leaving count in both.
+                """
+                cluster_model = model.cluster_model
+                decay = args.hparams.temporal_decay
+                z_snapshots, predecessors = [], []
+                fitted = False
+                for t, mask in enumerate(masks):
+                    idx = mask.nonzero().flatten()
+
+                    snapshot_time = time.time()
+                    self.snapshot_iter = 0
+                    k_prev = cluster_model.n_components
+                    if fitted:
+                        cluster_model.carry_points(X[masks[t - 1] & ~mask], decay)
+                    if len(idx) > 0:
+                        cluster_model.fit(
+                            X[idx], callbacks=[self],
+                            z_init=z_init[idx] if not fitted and z_init is not None else None,
+                            max_iter=args.trainer_params.max_epochs,
+                            n_init=args.hparams.n_restart if not fitted else 1,
+                            n_jobs=args.hparams.n_restart_jobs if not fitted else 1,
+                            incremental=fitted,
+                            keep_prior=fitted,
+                        )
+                        fitted = True
+
+                    z_snapshots.append(
+                        cluster_model.predict(X) if fitted else torch.zeros(len(X), dtype=torch.long)
+                    )
+                    if t > 0:
+                        predecessors.append(track_clusters(
+                            z_snapshots[-2], z_snapshots[-1], k_prev, cluster_model.n_components
+                        ))
+                    trainer.logger.log_metrics({
+                        'snapshot': t,
+                        'snapshot_k': cluster_model.n_components,
+                        'snapshot_iter': self.snapshot_iter,
+                        'snapshot_time': time.time() - snapshot_time,
+                        'snapshot_size': len(idx),
+                    })
+
+                torch.save({
+                    'masks': masks,
+                    'z': torch.stack(z_snapshots),
+                    'predecessors': predecessors,
+                }, Path(wandb.run.dir) / 'snapshot_assignments.pt')
+
+            def on_done(self, _model: BaseMixture, params, i: int) -> None:
+                self.snapshot_iter = i
+
+            def on_restart_step(self, _model: BaseMixture, restart: int, lower_bound: float, k: int) -> None:
+                trainer.logger.log_metrics({f'k_restart_{restart}': k, f'lower_bound_restart_{restart}': lower_bound})
+
             def on_after_step(self, _model: BaseMixture, lower_bound: Tensor) -> None:
                 self.advance()
+                if predict_after_fit:
+                    # Points are only predicted once the fit is done (see predict_all)
+                    trainer.logger.log_metrics({'k': _model.n_components})
+                    return
+
                 z, zi = model.cluster_model.predict_full(X)
                 model.val_outputs = OutputExtractor([{'X': X, 'z': z, 'zi': zi}])
                 trainer.logger.log_metrics({
@@ -75,7 +75,8 @@ class MGCOME2EExecutor(BaseExecutor[MGCOME2EModel]):
             n_feat_epochs=self.args.hparams.n_feat_epochs,
             num_cycles=self.args.hparams.n_cycles,
             checkpoint_callback=self.checkpoint_callback,
-            skip_pretraining=bool(self.args.load_path)
+            skip_pretraining=bool(self.args.load_path),
+            cluster_stochastic=self.args.hparams.cluster_stochastic,
         )
 
         return trainer
@@ -20,13 +20,13 @@ class HingeLoss(SkipgramLoss):
         pass
 
     def forward(self, Z: Tensor, pos_walks: Tensor, neg_walks: Tensor) -> Tensor:
-        if len(pos_walks) != len(neg_walks):
+        if pos_walks.shape[:-1] != neg_walks.shape[:-1]:
             raise ValueError("HingeLoss does not support num_neg_samples != 1")
 
-        pos_walks_Z = Z[pos_walks.view(-1)].view(*pos_walks.shape, Z.shape[-1])
+        pos_walks_Z = self.windows_Z(Z, pos_walks)
         p_aff = self.affinity(pos_walks_Z).mean(dim=-1, keepdim=True)
 
-        neg_walks_Z = Z[neg_walks.view(-1)].view(*neg_walks.shape, Z.shape[-1])
+        neg_walks_Z = self.windows_Z(Z, neg_walks)
         n_aff = self.affinity(neg_walks_Z)
         if self.adaptive:
             n_aff = torch.max(n_aff, dim=-1).values.unsqueeze(-1)
@@ -23,16 +23,30 @@ class SkipgramLoss(torch.nn.Module):
             logger.warning('Skipgram loss is only compatible with dot product similarity. Otherwise, results may vary.')
 
     def affinity(self, walks_Z: Tensor):
-        head, rest = walks_Z[:, 0].unsqueeze(dim=1), walks_Z[:, 1:]
+        head, rest = walks_Z[..., :1, :], walks_Z[..., 1:, :]
         sim = self.sim_fn(head, rest)
         return sim
 
+    @staticmethod
+    def windows_Z(Z: Tensor, windows: Tensor) -> Tensor:
+        """
+        Embeds context windows of shape (..., W, context_size) as built by `context_windows`, sliding over the same
+        walk with stride 1. The walk is recovered from the first window and the last node of every further window, its
+        embeddings are gathered once per walk position and windowed as a strided view of shape (..., W, context_size,
+        D), instead of gathering W * context_size embeddings per walk.
+        """
+        if windows.dim() < 3 or windows.shape[-2] == 0:
+            return Z[windows]
+
+        walks = torch.cat([windows[..., 0, :], windows[..., 1:, -1]], dim=-1)
+        return Z[walks].unfold(-2, windows.shape[-1], 1).transpose(-1, -2)
+
     def forward(self, Z: Tensor, pos_walks: Tensor, neg_walks: Tensor) -> Tensor:
-        pos_walks_Z = Z[pos_walks.view(-1)].view(*pos_walks.shape, Z.shape[-1])
+        pos_walks_Z = self.windows_Z(Z, pos_walks)
         p_aff = self.affinity(pos_walks_Z).view(-1)
         p_loss = -torch.log(torch.sigmoid(p_aff) + EPS).mean()
 
-        neg_walks_Z = Z[neg_walks.view(-1)].view(*neg_walks.shape, Z.shape[-1])
+        neg_walks_Z = self.windows_Z(Z, neg_walks)
         n_aff = self.affinity(neg_walks_Z).view(-1)
         # n_loss = -torch.log(1 - torch.sigmoid(n_aff) + EPS).mean()
         n_loss = -torch.log(torch.sigmoid(-n_aff) + EPS).mean()
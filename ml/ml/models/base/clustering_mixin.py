@@ -1,10 +1,10 @@
 from dataclasses import dataclass
-from typing import Any, Union, List
+from typing import Any, Union, List, Optional
 
 import torch
 from pytorch_lightning.utilities.types import EPOCH_OUTPUT
 
-from ml.algo.clustering import KMeans
+from ml.algo.clustering import KMeans, KMeansInit
 from ml.utils import HParams, Metric
 from ml.utils.outputs import OutputExtractor
 
@@ -24,6 +24,7 @@ class ClusteringMixin:
     repr_dim: int
 
     mus = None
+    kmeans: Optional[KMeans] = None
 
     def on_train_cluster(self):
         if self.hparams.infer_k > 0:
@@ -32,9 +33,14 @@ class ClusteringMixin:
             else:
                 Z = self.train_outputs.extract_cat_kv('Z_dict', cache=False, device='cpu')
 
-            kmeans = KMeans(self.repr_dim, k=self.hparams.infer_k, metric=Metric(self.hparams.metric), niter=30)
-            kmeans.fit(Z)
-            self.mus = torch.from_numpy(kmeans.centroids).float()
+            # Centroids are refined from the previous epoch, which typically converges in a few iterations
+            if self.kmeans is None:
+                self.kmeans = KMeans(
+                    self.repr_dim, k=self.hparams.infer_k, metric=Metric(self.hparams.metric), niter=30,
+                    init=KMeansInit.KMEANSPP, tol=1e-4, warm_start=True,
+                )
+            self.kmeans.fit(Z)
+            self.mus = torch.from_numpy(self.kmeans.centroids).float()
 
     def on_val_cluster_assign(self):
         if self.mus is not None:
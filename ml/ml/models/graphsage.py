@@ -137,11 +137,12 @@ class GraphSAGEDataModule(Het2VecDataModule):
     def _build_n2v_sampler(self, data: HeteroData, transform_meta=None) -> Union[Node2VecSampler, BallroomSampler]:
         hdata = data.to_homogeneous(
             node_attrs=[], edge_attrs=[],
-            add_node_type=False, add_edge_type=False
+            add_node_type=True, add_edge_type=False
         )
         n2v_sampler = Node2VecSampler(
             hdata.edge_index, hdata.num_nodes,
             hparams=self.hparams.n2v_params, transform_meta=transform_meta,
+            node_type=hdata.node_type,
         )
         return n2v_sampler
 
@@ -104,11 +104,12 @@ class Het2VecDataModule(HeteroGraphDataModule):
     def train_sampler(self, data: HeteroData) -> Optional[Sampler]:
         mapper = ToHeteroMappingTransform(data.num_nodes_dict)
 
-        hdata = data.to_homogeneous(node_attrs=[], edge_attrs=[], add_node_type=False, add_edge_type=False)
+        hdata = data.to_homogeneous(node_attrs=[], edge_attrs=[], add_node_type=True, add_edge_type=False)
         n2v_sampler = Node2VecSampler(
             hdata.edge_index, hdata.num_nodes,
             hparams=self.hparams.n2v_params,
-            transform_meta=mapper.transform
+            transform_meta=mapper.transform,
+            node_type=hdata.node_type,
         )
 
         return n2v_sampler
@@ -234,6 +234,7 @@ class MGCOMCombiDataModule(MGCOMTempoDataModule, MGCOMTopoDataModule):
     def train_sampler(self, data: HeteroData) -> Optional[Sampler]:
         mapper = ToHeteroMappingTransform(data.num_nodes_dict)
         hgt_sampler = self._build_conv_sampler(data)
+        self.walk_corpora = []
 
         def transform_meta(node_idx):
             node_idx_dict, node_perm_dict = mapper.transform(node_idx)
@@ -244,6 +245,9 @@ class MGCOMCombiDataModule(MGCOMTempoDataModule, MGCOMTopoDataModule):
             if self.hparams.use_topo_loader else None
         ballroom_sampler = MGCOMTempoDataModule._build_n2v_sampler(self, data, transform_meta) \
             if self.hparams.use_tempo_loader else None
+        for sampler in [n2v_sampler, ballroom_sampler]:
+            if sampler is not None:
+                self._build_walk_corpus(sampler, data)
 
         def combined_sampler(node_ids):
             return (
@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Union, List, Optional
+from typing import Union, List, Optional, Any
 
 import torch.nn
 from pytorch_lightning.utilities.types import STEP_OUTPUT, EPOCH_OUTPUT
@@ -7,16 +7,35 @@ from torch import Tensor
 from torch.utils.data import Dataset
 
 from datasets import GraphDataset
+from datasets.utils.labels import extract_timestamp_labels
 from ml.algo.dpmm.dpmsc import DPMSC, DPMSCHParams
 from ml.models.base.base_model import BaseModel
 from ml.models.base.clustering_datamodule import ClusteringDataModule
-from ml.utils import HParams, DataLoaderParams, OptimizerParams
+from ml.utils import HParams, DataLoaderParams, OptimizerParams, dict_catv
 from ml.utils.training import ClusteringStage
 
 
 @dataclass
 class MGCOMComDetModelParams(DPMSCHParams):
     n_restart: int = 1
+    n_restart_jobs: int = 1
+    stochastic: bool = False
+    """Fit the clustering with stochastic EM over mini-batches of the embeddings"""
+    coreset_size: Optional[int] = None
+    """Fit the clustering on a weighted coreset of this many points instead of all embeddings"""
+    coreset_k: int = 64
+    """Number of k-means centroids used to compute the sensitivities of the coreset"""
+    coreset_rescale: bool = False
+    """Rescale the coreset weights to sum to the coreset size instead of the number of points. Every sampled point then
+    counts once on average, which keeps the split/merge tests from favouring degenerate clusters at the cost of a
+    weaker prior relative to the data"""
+    temporal: bool = False
+    """Fit the clustering sequentially over the dataset snapshots, each warm-started from the previous posterior"""
+    temporal_snapshots: Optional[int] = None
+    """Snapshot definition (number of snapshots) to use, defaults to the finest one available"""
+    temporal_decay: float = 1.0
+    """Per-snapshot decay of the statistics carried over for points that left the data. 1 keeps them all, 0 forgets
+    points as soon as they leave"""
 
 
 class MGCOMComDetModel(BaseModel):
@@ -43,6 +62,19 @@ class MGCOMComDetModel(BaseModel):
     def estimate_assignment(self, X: Tensor) -> Tensor:
         return self.cluster_model.clusters.predict(X)
 
+    def get_extra_state(self) -> Any:
+        return {
+            'cluster_hparams': self.cluster_model.hparams.to_dict(dict),
+            'cluster_params': self.cluster_model._get_params(),
+            'cluster_prior': self.cluster_model._get_params_prior(),
+        }
+
+    def set_extra_state(self, state: Any):
+        self.cluster_model._set_params(state['cluster_params'])
+        self.cluster_model._set_params_prior(state['cluster_prior'])
+        if self.cluster_model.clusters.params is not None:
+            self.cluster_model.is_fitted = True
+
 
 @dataclass
 class MGCOMComDetDataModuleParams(HParams):
@@ -61,3 +93,21 @@ class MGCOMComDetDataModule(ClusteringDataModule):
     ):
         super().__init__(dataset, graph_dataset, loader_params)
         self.save_hyperparameters(hparams.to_dict())
+
+    def snapshot_masks(self, n: Optional[int] = None) -> Optional[Tensor]:
+        """
+        Boolean mask of shape (T, N) of the nodes first appearing in each snapshot. Nodes without a timestamp are
+        part of every snapshot.
+        """
+        if self.graph_dataset is None or not self.graph_dataset.snapshots:
+            return None
+
+        snapshots = self.graph_dataset.snapshots[n if n is not None else max(self.graph_dataset.snapshots.keys())]
+        node_timestamps = dict_catv(extract_timestamp_labels(self.graph_dataset.data))
+
+        # Snapshot bounds overlap by one timestamp, every node is assigned to the last snapshot starting before it
+        t = (torch.searchsorted(snapshots[:, 0].contiguous(), node_timestamps, right=True) - 1).clamp_min(0)
+        masks = t[None, :] == torch.arange(len(snapshots))[:, None]
+        masks[:, node_timestamps == -1] = True
+
+        return masks
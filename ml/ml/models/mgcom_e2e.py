@@ -21,6 +21,8 @@ class MGCOME2EModelParams(MGCOMCombiModelParams):
 
     cluster_params: DPMSCHParams = DPMSCHParams()
     cluster_weight: float = 0.1
+    cluster_stochastic: bool = False
+    """Fit the clustering with stochastic EM over mini-batches of the embeddings instead of all at once"""
 
     n_cycles: Optional[int] = None
     n_pretrain_epochs: int = 50
@@ -65,10 +67,10 @@ class MGCOME2EModel(MGCOMCombiModel):
         else:
             if self.hparams.use_topo and self.hparams.use_tempo:
                 Z_combi = self.embedding_combine_fn([Z_topo, Z_tempo])
-                idx = topo_pos_walks[:, 0]
+                idx = topo_pos_walks[..., 0].reshape(-1)
             else:
                 Z_combi = Z_topo if self.hparams.use_topo else Z_tempo
-                idx = topo_pos_walks[:, 0] if self.hparams.use_topo else tempo_pos_walks[:, 0]
+                idx = (topo_pos_walks if self.hparams.use_topo else tempo_pos_walks)[..., 0].reshape(-1)
 
         mus = self.cluster_model.cluster_params.mus.to(self.device)
         loss_cluster = self.cluster_loss_fn(Z_combi[idx, :], self.r_prev[idx, :], mus )
@@ -126,6 +128,7 @@ class MGCOME2EModel(MGCOMCombiModel):
 
     def get_extra_state(self) -> Any:
         return {
+            'cluster_hparams': self.cluster_model.hparams.to_dict(dict),
             'cluster_params': self.cluster_model._get_params(),
             'cluster_prior': self.cluster_model._get_params_prior(),
         }
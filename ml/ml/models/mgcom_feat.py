@@ -5,6 +5,7 @@ from pathlib import Path
 from typing import Optional, Dict, List, Union, Tuple
 
 from torch import Tensor
+from pytorch_lightning.utilities.types import TRAIN_DATALOADERS
 from torch_geometric.data import HeteroData
 from torch_geometric.typing import Metadata, NodeType
 
@@ -12,12 +13,14 @@ from datasets import GraphDataset
 from datasets.transforms.define_snapshots import DefineSnapshots
 from datasets.transforms.to_homogeneous import to_homogeneous
 from ml.algo.transforms import ToHeteroMappingTransform
+from ml.data.loaders.nodes_loader import NodesLoader
 from ml.data.samplers.ballroom_sampler import BallroomSamplerParams, BallroomSampler
 from ml.data.samplers.base import Sampler
 from ml.data.samplers.hgt_sampler import HGTSamplerParams, HGTSampler
 from ml.data.samplers.node2vec_sampler import Node2VecSampler, Node2VecSamplerParams
 from ml.data.samplers.sage_sampler import SAGESamplerParams, SAGESampler
 from ml.data.samplers.tempo_sampler import TemporalSampler
+from ml.data.samplers.walk_corpus import WalkCorpus, graph_hash
 from ml.layers.conv.hgt_cov_net import HGTConvNet
 from ml.layers.conv.hybrid_conv_net import HybridConvNet
 from ml.layers.conv.sage_conv_net import SAGEConvNet
@@ -123,10 +126,17 @@ class MGCOMFeatDataModuleParams(GraphDataModuleParams):
     num_samples: List[int] = field(default_factory=lambda: [3, 2])
     """The number of nodes to sample in each iteration and for each (node type in case of HGT, and edge_type in case 
     of SAGE). """
+    walk_corpus_sets: int = 0
+    """Number of random walk sets to precompute into a memory-mapped corpus (shared across runs on the same graph and
+    sampler params). Epochs rotate through the sets. If 0, walks are sampled on the fly every epoch."""
+    walk_corpus_background: bool = True
+    """Whether to precompute the walk sets in a background process. Epochs sample on the fly until their set is
+    ready."""
 
 
 class MGCOMFeatDataModule(Het2VecDataModule):
     hparams: Union[MGCOMFeatDataModuleParams, DataLoaderParams]
+    walk_corpora: List[WalkCorpus]
 
     @abstractmethod
     def _build_n2v_sampler(self, data: HeteroData, transform_meta=None) -> Union[Node2VecSampler, BallroomSampler]:
@@ -149,18 +159,52 @@ class MGCOMFeatDataModule(Het2VecDataModule):
 
         return sampler
 
+    def _build_walk_corpus(self, sampler: Sampler, data: HeteroData) -> Sampler:
+        if self.hparams.walk_corpus_sets <= 0 or not hasattr(sampler, 'corpus'):
+            return sampler
+
+        graph_key = graph_hash(*[
+            value
+            for store in data.stores
+            for key, value in store.items()
+            if key in ('edge_index', 'timestamp_from')
+        ])
+        sampler.corpus = WalkCorpus(
+            sampler, data.num_nodes, self.hparams.walk_corpus_sets, self.loader_params.batch_size, graph_key
+        ).build(background=self.hparams.walk_corpus_background)
+        self.walk_corpora.append(sampler.corpus)
+
+        return sampler
+
+    def _walk_corpus_order(self, epoch: int) -> Tensor:
+        return [corpus.set_epoch(epoch) for corpus in self.walk_corpora][0]
+
     def train_sampler(self, data: HeteroData) -> Optional[Sampler]:
         mapper = ToHeteroMappingTransform(data.num_nodes_dict)
         hgt_sampler = self._build_conv_sampler(data)
+        self.walk_corpora = []
 
         def transform_meta(node_idx):
             node_idx_dict, node_perm_dict = mapper.transform(node_idx)
             node_meta = hgt_sampler(node_idx_dict)
             return node_meta, node_perm_dict
 
-        n2v_sampler = self._build_n2v_sampler(data, transform_meta)
+        n2v_sampler = self._build_walk_corpus(self._build_n2v_sampler(data, transform_meta), data)
         return n2v_sampler
 
+    def train_dataloader(self) -> TRAIN_DATALOADERS:
+        transform = self.train_sampler(self.train_data)
+        use_corpus = len(self.walk_corpora) > 0
+
+        # Corpus walks are only valid for batches in the order they were sampled in
+        return NodesLoader(
+            self.train_data.num_nodes,
+            transform=transform,
+            shuffle=not use_corpus,
+            epoch_order_fn=self._walk_corpus_order if use_corpus else None,
+            **self.loader_params.to_dict()
+        )
+
     def eval_sampler(self, data: HeteroData) -> Optional[Sampler]:
         return self._build_conv_sampler(data)
 
@@ -176,11 +220,12 @@ class MGCOMTopoDataModule(MGCOMFeatDataModule):
     def _build_n2v_sampler(self, data: HeteroData, transform_meta=None) -> Union[Node2VecSampler, BallroomSampler]:
         hdata = data.to_homogeneous(
             node_attrs=[], edge_attrs=[],
-            add_node_type=False, add_edge_type=False
+            add_node_type=True, add_edge_type=False
         )
         n2v_sampler = Node2VecSampler(
             hdata.edge_index, hdata.num_nodes,
             hparams=self.hparams.n2v_params, transform_meta=transform_meta,
+            node_type=hdata.node_type,
         )
         return n2v_sampler
 
@@ -220,7 +265,7 @@ class MGCOMTempoDataModule(MGCOMFeatDataModule):
         hdata = to_homogeneous(
             self.train_data,
             node_attrs=['timestamp_from'], edge_attrs=['timestamp_from'],
-            add_node_type=False, add_edge_type=False
+            add_node_type=True, add_edge_type=False
         )
         if self.hparams.use_unbiased:
             ballroom_sampler = TemporalSampler(
@@ -229,7 +274,8 @@ class MGCOMTempoDataModule(MGCOMFeatDataModule):
                 hdata.edge_timestamp_from,
                 tuple(self.hparams.window),
                 hparams=self.hparams.ballroom_params,
-                transform_meta=transform_meta
+                transform_meta=transform_meta,
+                node_type=hdata.node_type,
             )
         else:
             ballroom_sampler = BallroomSampler(
@@ -238,6 +284,7 @@ class MGCOMTempoDataModule(MGCOMFeatDataModule):
                 hdata.edge_timestamp_from,
                 tuple(self.hparams.window),
                 hparams=self.hparams.ballroom_params,
-                transform_meta=transform_meta
+                transform_meta=transform_meta,
+                node_type=hdata.node_type,
             )
         return ballroom_sampler
@@ -1,5 +1,5 @@
 import sys
-from typing import Union, List, Dict
+from typing import Union, List, Dict, Tuple
 
 import numpy as np
 import torch
@@ -33,11 +33,11 @@ def ensure_numpy(x: Union[Tensor, np.ndarray]) -> np.ndarray:
         return x
 
 
-def unique_count(z: Tensor, k: int) -> Tensor:
+def unique_count(z: Tensor, k: int, weights: Tensor = None) -> Tensor:
     """
-    Counts the number of elements in each of the k partitions.
+    Counts the number of elements (or sums their weights) in each of the k partitions.
     """
-    return torch.bincount(z, minlength=k)
+    return torch.bincount(z, weights=weights, minlength=k)
 
 
 def scatter_sum(X: Tensor, z: Tensor, k: int) -> Tensor:
@@ -48,11 +48,20 @@ def tensor_partition(X: Tensor, z: Tensor, k: int) -> List[Tensor]:
     return [X[z == i] for i in range(k)]
 
 
+def partition_perm(z: Tensor, k: int) -> Tuple[Tensor, List[int]]:
+    """
+    Computes a stable permutation that groups the elements by partition index, together with the partition sizes.
+    `X[perm].split(sizes)` yields the same partitions as `tensor_partition` as contiguous views of a single copy.
+    """
+    perm = torch.sort(z, stable=True).indices
+    return perm, unique_count(z, k).tolist()
+
+
 def mask_from_idx(idx: Tensor, n: int) -> Tensor:
     """
     Creates a mask from an index vector.
     """
-    mask = torch.zeros(n, dtype=torch.bool)
+    mask = torch.zeros(n, dtype=torch.bool, device=idx.device)
     mask[idx] = True
     return mask
 
@@ -62,4 +71,4 @@ def dict_catv(d: Dict[str, Tensor], dim=0) -> Tensor:
 
 
 def batchwise_outer(x: Tensor, y: Tensor) -> Tensor:
-    return torch.einsum('bi,bj->bij', (x, y))
+    return torch.einsum('...i,...j->...ij', (x, y))
@@ -0,0 +1,20 @@
+import torch
+
+from ml.utils import unique_count
+
+
+def gaussian_blobs(k: int, n: int, D: int, scale: float = 8.0, seed: int = 0):
+    generator = torch.Generator().manual_seed(seed)
+    centers = torch.randn(k, D, generator=generator) * scale
+    X = torch.cat([centers[i] + torch.randn(n, D, generator=generator) for i in range(k)])
+    perm = torch.randperm(len(X), generator=generator)
+    return X[perm], torch.arange(k).repeat_interleave(n)[perm]
+
+
+def partition_agreement(z: torch.Tensor, z_other: torch.Tensor) -> float:
+    """
+    Fraction of points whose cluster maps to the same cluster of the other partition (up to relabeling).
+    """
+    k, k_other = int(z.max()) + 1, int(z_other.max()) + 1
+    overlap = unique_count(z * k_other + z_other, k * k_other).reshape(k, k_other)
+    return float(overlap.max(dim=1).values.sum()) / len(z)
@@ -0,0 +1,68 @@
+import unittest
+
+import torch
+
+from ml.algo.dpmm.dpm import DirichletProcessMixture, DirichletProcessMixtureParams
+from ml.utils import unique_count
+from helpers import gaussian_blobs, partition_agreement
+
+
+class TestStochasticEM(unittest.TestCase):
+    def test_full_batch_step(self):
+        # With a single batch holding all points the first pass has step size one, which is a batch EM step
+        X, _ = gaussian_blobs(4, 100, 3)
+        hparams = DirichletProcessMixtureParams(init_k=4, update_hard=False)
+
+        torch.manual_seed(0)
+        batch = DirichletProcessMixture(hparams)
+        batch.fit(X, max_iter=1)
+
+        torch.manual_seed(0)
+        stochastic = DirichletProcessMixture(DirichletProcessMixtureParams(init_k=4, update_hard=False))
+        stochastic.fit_stochastic([X], n_samples=len(X), max_iter=1)
+
+        for p, p_other in zip(batch.cluster_params, stochastic.cluster_params):
+            self.assertTrue(torch.allclose(p, p_other, rtol=1e-4, atol=1e-4))
+
+    def test_mini_batches(self):
+        X, y = gaussian_blobs(4, 500, 3)
+        batches = list(X.split(200))
+
+        torch.manual_seed(0)
+        batch = DirichletProcessMixture(DirichletProcessMixtureParams(init_k=4))
+        batch.fit(X, max_iter=50)
+
+        torch.manual_seed(0)
+        stochastic = DirichletProcessMixture(DirichletProcessMixtureParams(init_k=4))
+        stochastic.fit_stochastic(batches, n_samples=len(X), max_iter=50)
+
+        z, z_stochastic = batch.predict(X), stochastic.predict(X)
+        self.assertGreater(partition_agreement(z_stochastic, y), 0.99)
+        self.assertGreater(partition_agreement(z, z_stochastic), 0.99)
+        self.assertGreater(partition_agreement(z_stochastic, z), 0.99)
+
+        # Matched components estimate the same means and (dataset scale) counts
+        Ns, mus, _ = batch.cluster_params
+        Ns_s, mus_s, _ = stochastic.cluster_params
+        match = unique_count(z * 4 + z_stochastic, 16).reshape(4, 4).argmax(dim=1)
+        self.assertTrue(torch.allclose(mus, mus_s[match], atol=0.2))
+        self.assertTrue(torch.allclose(Ns, Ns_s[match], rtol=0.1))
+
+    def test_incremental(self):
+        # An incremental fit continues the running statistics and step sizes instead of starting over from one batch
+        X, _ = gaussian_blobs(4, 500, 3)
+        torch.manual_seed(0)
+        model = DirichletProcessMixture(DirichletProcessMixtureParams(init_k=4))
+        model.fit_stochastic(list(X.split(200)), n_samples=len(X), max_iter=20)
+        Ns, mus, _ = model.cluster_params
+        steps = model.stochastic_steps
+
+        model.fit_stochastic([X[:20]], n_samples=len(X), max_iter=1, incremental=True)
+        Ns_new, mus_new, _ = model.cluster_params
+        self.assertEqual(model.stochastic_steps, steps + 1)
+        self.assertTrue(torch.allclose(mus_new, mus, atol=0.1))
+        self.assertTrue(torch.allclose(Ns_new.sum(), Ns.sum(), rtol=1e-3))
+
+
+if __name__ == '__main__':
+    unittest.main()
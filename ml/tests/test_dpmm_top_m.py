@@ -0,0 +1,30 @@
+import unittest
+
+import torch
+
+from ml.algo.dpmm.dpm import DirichletProcessMixture, DirichletProcessMixtureParams
+from ml.utils import Metric
+
+
+class TestTopM(unittest.TestCase):
+    def test_cosine(self):
+        # Clusters along a line through the origin: the means differ mostly in norm, which inner products favour
+        generator = torch.Generator().manual_seed(0)
+        centers = torch.linspace(1, 40, 8)[:, None] * torch.tensor([1.0, 0.5, 0.25])
+        X = (centers[:, None] + torch.randn(8, 100, 3, generator=generator)).reshape(-1, 3)
+        y = torch.arange(8).repeat_interleave(100)
+
+        dense = DirichletProcessMixture(DirichletProcessMixtureParams(init_k=8, metric=Metric.COSINE))
+        dense.fit(X, max_iter=1, z_init=y)
+        sparse = DirichletProcessMixture(DirichletProcessMixtureParams(init_k=8, metric=Metric.COSINE, top_m=3))
+        sparse._init(X)
+        sparse._set_params(dense._get_params())
+        sparse.prior_dir, sparse.prior_nw = dense.prior_dir, dense.prior_nw
+
+        r_dense, r_sparse = dense.estimate_log_resp(X).exp(), sparse.estimate_log_resp(X).exp()
+        self.assertTrue(torch.equal(r_dense.argmax(dim=1), r_sparse.argmax(dim=1)))
+        self.assertLess(float((r_dense - r_sparse).abs().max()), 1e-3)
+
+
+if __name__ == '__main__':
+    unittest.main()
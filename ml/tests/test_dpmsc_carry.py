@@ -0,0 +1,46 @@
+import unittest
+
+import torch
+
+from ml.algo.dpmm.dpmsc import DPMSC, DPMSCHParams
+from helpers import gaussian_blobs, partition_agreement
+
+
+class TestCarriedStatistics(unittest.TestCase):
+    def setUp(self) -> None:
+        self.X, self.y = gaussian_blobs(4, 300, 3)
+        torch.manual_seed(0)
+        self.model = DPMSC(DPMSCHParams(init_k=1))
+        self.model.fit(self.X[:600], max_iter=60)
+
+    def test_carry(self):
+        # The carried statistics count as the points that left, which do not have to be revisited
+        prior_nw = self.model.clusters.prior_nw
+        self.model.carry_points(self.X[:300], 1.0)
+        self.model.fit(self.X[300:], max_iter=60, incremental=True, keep_prior=True)
+
+        self.assertEqual(self.model.n_components, 4)
+        self.assertAlmostEqual(float(self.model.clusters.cluster_params.Ns.sum()), len(self.X), delta=1e-3)
+        self.assertGreater(partition_agreement(self.model.predict(self.X), self.y), 0.99)
+        self.assertIs(self.model.clusters.prior_nw, prior_nw)
+
+    def test_decay(self):
+        # Carried counts decay once per call, points that stay are fitted at full weight
+        self.model.carry_points(self.X[:300], 0.5)
+        self.model.fit(self.X[300:], max_iter=5, incremental=True, keep_prior=True)
+        self.assertAlmostEqual(float(self.model.clusters.cluster_params.Ns.sum()), 900 + 150, delta=1e-3)
+
+        self.model.carry_points(self.X[:0], 0.5)
+        self.model.fit(self.X[300:], max_iter=5, incremental=True, keep_prior=True)
+        self.assertAlmostEqual(float(self.model.clusters.cluster_params.Ns.sum()), 900 + 75, delta=1e-3)
+
+    def test_incremental(self):
+        # Without keep_prior an incremental fit re-estimates the prior, e.g. for retrained embeddings
+        prior_nw = self.model.clusters.prior_nw
+        self.model.fit(self.X[300:] * 2, max_iter=5, incremental=True)
+        self.assertIsNot(self.model.clusters.prior_nw, prior_nw)
+        self.assertIsNone(self.model.carry)
+
+
+if __name__ == '__main__':
+    unittest.main()
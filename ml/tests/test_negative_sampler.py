@@ -0,0 +1,46 @@
+import unittest
+
+import torch
+
+from ml.data.samplers.negative import NegativeSampler, alias_table
+
+
+def alias_probs(prob: torch.Tensor, alias: torch.Tensor) -> torch.Tensor:
+    """
+    Distribution drawn from an alias table: an entry keeps its own share prob and hands the rest to its alias.
+    """
+    prob = prob.double()
+    return (prob + torch.zeros_like(prob).index_add_(0, alias, 1 - prob)) / len(prob)
+
+
+class TestAliasTable(unittest.TestCase):
+    def test_exact(self):
+        generator = torch.Generator().manual_seed(0)
+        for probs in [
+            torch.rand(1000, generator=generator),
+            torch.rand(1000, generator=generator).pow(8),  # Heavy tailed, takes several rounds
+            torch.tensor([0.0, 1.0, 0.0, 3.0, 0.0]),
+            torch.ones(7),
+        ]:
+            prob, alias = alias_table(probs)
+            self.assertTrue(torch.allclose(alias_probs(prob, alias), probs.double() / probs.sum(), atol=1e-6))
+
+    def test_frequencies(self):
+        torch.manual_seed(0)
+        degree = torch.tensor([1, 2, 4, 8, 16, 1, 1, 64])
+        node_type = torch.tensor([0, 0, 0, 0, 1, 1, 1, 1])
+        sampler = NegativeSampler(degree, alpha=0.75, node_type=node_type)
+
+        heads = torch.tensor([0, 4]).repeat(50000)
+        samples = sampler.sample(heads, 4)
+        self.assertTrue(torch.equal(node_type[samples], node_type[heads][:, None].expand_as(samples)))
+
+        for t in range(2):
+            nodes = (node_type == t).nonzero().view(-1)
+            expected = degree[nodes].double().pow(0.75)
+            counts = torch.bincount(samples[node_type[heads] == t].view(-1), minlength=len(degree))[nodes].double()
+            self.assertTrue(torch.allclose(counts / counts.sum(), expected / expected.sum(), atol=5e-3))
+
+
+if __name__ == '__main__':
+    unittest.main()
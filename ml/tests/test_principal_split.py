@@ -0,0 +1,38 @@
+import unittest
+
+import torch
+
+from ml.algo.dpmm.statistics import CovarianceType, estimate_gaussian_parameters, principal_split, split_params
+from helpers import partition_agreement
+
+
+class TestPrincipalSplit(unittest.TestCase):
+    def setUp(self) -> None:
+        # Two segments, each made of two blobs which are only separated along the last dimension
+        generator = torch.Generator().manual_seed(0)
+        self.y = torch.arange(4).repeat_interleave(100)
+        offsets = torch.zeros(4, 5)
+        offsets[:, -1] = torch.tensor([-4.0, 4.0, -4.0, 4.0])
+        offsets[2:, 0] = 20.0
+        self.X = offsets[self.y] + torch.randn(400, 5, generator=generator)
+        self.z = self.y // 2
+
+    def test_split(self):
+        for cov_type in CovarianceType:
+            params = estimate_gaussian_parameters(self.X, self.z, k=2, cov_type=cov_type)
+            zi = principal_split(self.X, self.z, 2, params=params)
+            self.assertGreater(partition_agreement(self.z * 2 + zi, self.y), 0.99, cov_type)
+
+    def test_split_params_spherical(self):
+        params = estimate_gaussian_parameters(self.X, self.z, k=2, cov_type=CovarianceType.SPHERICAL)
+        Ns, mus, covs = split_params(params)
+
+        # Halves are offset in different directions, which preserve the means of the components
+        offsets = mus[:, 1] - mus[:, 0]
+        self.assertFalse(torch.allclose(offsets[0], offsets[0, 0] * torch.eye(5)[0]))
+        self.assertTrue(torch.allclose(mus.mean(dim=1), params.mus, atol=1e-5))
+        self.assertTrue(torch.allclose(Ns.sum(dim=1), params.Ns))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+
+import torch
+
+from ml.data.samplers.context import context_windows
+from ml.layers.loss.hinge_loss import HingeLoss
+from ml.layers.loss.skipgram_loss import SkipgramLoss
+from ml.utils import Metric
+
+
+class TestWindowsZ(unittest.TestCase):
+    def test_windows_Z(self):
+        generator = torch.Generator().manual_seed(0)
+        Z = torch.randn(50, 8, generator=generator)
+        windows = context_windows(torch.randint(0, 50, (30, 12), generator=generator), 5)
+
+        # Strided view as sampled and contiguous copy as after pinning / moving to the device
+        for w in [windows, windows.contiguous()]:
+            self.assertTrue(torch.equal(SkipgramLoss.windows_Z(Z, w), Z[w]))
+
+    def test_loss(self):
+        generator = torch.Generator().manual_seed(0)
+        Z = torch.randn(50, 8, generator=generator)
+        pos_walks = context_windows(torch.randint(0, 50, (30, 12), generator=generator), 5).contiguous()
+        neg_walks = context_windows(torch.randint(0, 50, (30, 12), generator=generator), 5).contiguous()
+
+        for loss_fn in [SkipgramLoss(Metric.DOTP), HingeLoss(Metric.COSINE), HingeLoss(Metric.L1, adaptive=True)]:
+            loss = loss_fn(Z, pos_walks, neg_walks)
+
+            loss_fn.windows_Z = lambda Z, w: Z[w]
+            self.assertAlmostEqual(float(loss), float(loss_fn(Z, pos_walks, neg_walks)), places=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
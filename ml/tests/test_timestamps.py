@@ -0,0 +1,64 @@
+import unittest
+
+import torch
+
+from datasets.utils.temporal import NAN_TIMESTAMP, TemporalNodeIndex
+from ml.data.samplers.timestamps import TimestampPool, pick_timestamps
+from ml.utils import randint_range
+
+
+def pick_timestamps_loop(walks_timestamps: torch.Tensor) -> torch.Tensor:
+    """
+    Reference: picks the valid timestamps of every row one row at a time.
+    """
+    n_timestamps = (walks_timestamps != NAN_TIMESTAMP).sum(dim=1)
+    timestamp_idx = randint_range(n_timestamps.clamp(min=1))
+    result = torch.full((len(walks_timestamps),), NAN_TIMESTAMP)
+    for i, (n, j) in enumerate(zip(n_timestamps, timestamp_idx)):
+        if n > 0:
+            result[i] = walks_timestamps[i, walks_timestamps[i] != NAN_TIMESTAMP][j]
+    return result
+
+
+def walk_fn(nodes: torch.Tensor, _timestamps: torch.Tensor):
+    # Node v visits timestamps 10 v + j at the even positions j, nodes divisible by 5 never reach one
+    timestamps = nodes[:, None] * 10 + torch.arange(8)
+    timestamps[:, 1::2] = NAN_TIMESTAMP
+    timestamps[nodes % 5 == 0] = NAN_TIMESTAMP
+    return nodes[:, None].repeat(1, 8), timestamps
+
+
+class TestTimestamps(unittest.TestCase):
+    def test_pick_timestamps(self):
+        generator = torch.Generator().manual_seed(0)
+        walks_timestamps = torch.randint(-1, 5, (2000, 20), generator=generator)
+        walks_timestamps[::7] = NAN_TIMESTAMP
+
+        torch.manual_seed(1)
+        expected = pick_timestamps_loop(walks_timestamps)
+        torch.manual_seed(1)
+        self.assertTrue(torch.equal(pick_timestamps(walks_timestamps), expected))
+
+    def test_pool(self):
+        torch.manual_seed(0)
+        num_nodes = 100
+        node_timestamps = torch.full((num_nodes,), NAN_TIMESTAMP)
+        node_timestamps[:50] = torch.randint(0, 100, (50,))
+        edge_index = torch.randint(0, 50, (2, 200))
+        temporal_index = TemporalNodeIndex().fit(node_timestamps, edge_index, torch.randint(0, 100, (200,)))
+        pool = TimestampPool(temporal_index, num_nodes, walk_fn, num_walks=3, max_rows=16)
+
+        missing = torch.ones(num_nodes, dtype=torch.bool)
+        missing[temporal_index.node_ids] = False
+        self.assertTrue(torch.equal(pool.node_ids, missing.nonzero().view(-1)))
+
+        # Samples are drawn from the timestamps the walks of the node visit, which are all reached
+        nodes = pool.node_ids.repeat(200)
+        timestamps = pool.sample(nodes)
+        self.assertTrue(torch.equal(timestamps == NAN_TIMESTAMP, nodes % 5 == 0))
+        for v in pool.node_ids[pool.node_ids % 5 != 0].tolist():
+            self.assertEqual(set(timestamps[nodes == v].tolist()), {10 * v + j for j in range(0, 8, 2)})
+
+
+if __name__ == '__main__':
+    unittest.main()
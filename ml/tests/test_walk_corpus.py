@@ -0,0 +1,69 @@
+import tempfile
+import unittest
+from dataclasses import dataclass
+
+import torch
+from torch import Tensor
+
+from ml.data.loaders.nodes_loader import NodesLoader
+from ml.data.samplers.walk_corpus import WalkCorpus
+from ml.utils import HParams
+
+
+@dataclass
+class WalkParams(HParams):
+    walk_length: int = 3
+
+
+class WalkSampler:
+    """
+    Walks that stay at their start node, such that corpus walks are easy to verify.
+    """
+
+    def __init__(self) -> None:
+        self.hparams = WalkParams()
+        self.corpus = None
+
+    def _pos_sample(self, node_ids: Tensor) -> Tensor:
+        return node_ids.repeat_interleave(2).view(-1, 1).repeat(1, self.hparams.walk_length)
+
+    def corpus_walks(self, node_ids: Tensor) -> bool:
+        walks = self.corpus.pos_sample(node_ids)
+        return walks is not None and torch.equal(walks.long(), self._pos_sample(node_ids))
+
+
+class WorkerNodesLoader(NodesLoader):
+    """
+    Looks up the corpus walks in the loader workers (collate) as well as in the main process (transform).
+    """
+
+    def __init__(self, sampler: WalkSampler, *args, **kwargs) -> None:
+        self.walk_sampler = sampler
+        super().__init__(*args, **kwargs)
+
+    def sample(self, inputs):
+        return inputs, self.walk_sampler.corpus_walks(inputs)
+
+
+class TestWalkCorpus(unittest.TestCase):
+    def test_workers(self):
+        num_nodes, batch_size = 100, 16
+        sampler = WalkSampler()
+        with tempfile.TemporaryDirectory() as root:
+            corpus = WalkCorpus(sampler, num_nodes, num_sets=2, batch_size=batch_size, graph_key='test', root=root)
+            sampler.corpus = corpus.build()
+
+            loader = WorkerNodesLoader(
+                sampler, num_nodes,
+                transform=lambda batch: (batch[1], sampler.corpus_walks(batch[0])),
+                epoch_order_fn=corpus.set_epoch,
+                batch_size=batch_size, num_workers=2, persistent_workers=True,
+            )
+            for epoch in range(4):
+                hits = list(loader)
+                self.assertEqual(len(hits), (num_nodes + batch_size - 1) // batch_size)
+                self.assertTrue(all(worker and main for worker, main in hits), f'epoch {epoch}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+import torch
+
+from ml.algo.dpmm.statistics import CovarianceType, estimate_gaussian_parameters, \
+    estimate_gaussian_parameters_segmented, estimate_gaussian_parameters_sparse
+
+
+class TestWeightedStatistics(unittest.TestCase):
+    """
+    A point with integer weight w must count exactly as w copies of itself.
+    """
+
+    def setUp(self) -> None:
+        generator = torch.Generator().manual_seed(0)
+        self.X = torch.randn(200, 4, generator=generator, dtype=torch.float64)
+        self.weights = torch.randint(1, 5, (200,), generator=generator)
+        self.z = torch.randint(0, 3, (200,), generator=generator)
+        self.r = torch.rand(200, 3, generator=generator, dtype=torch.float64).softmax(dim=1)
+
+    def replicate(self, t: torch.Tensor) -> torch.Tensor:
+        return t.repeat_interleave(self.weights, dim=0)
+
+    def assertParamsEqual(self, params, params_other) -> None:
+        for p, p_other in zip(params, params_other):
+            self.assertTrue(torch.allclose(p, p_other, rtol=1e-10, atol=1e-10))
+
+    def test_soft(self):
+        for cov_type in CovarianceType:
+            self.assertParamsEqual(
+                estimate_gaussian_parameters(self.X, self.r, weights=self.weights.double(), cov_type=cov_type),
+                estimate_gaussian_parameters(self.replicate(self.X), self.replicate(self.r), cov_type=cov_type),
+            )
+
+    def test_hard(self):
+        for cov_type in CovarianceType:
+            self.assertParamsEqual(
+                estimate_gaussian_parameters(self.X, self.z, weights=self.weights.double(), k=3, cov_type=cov_type),
+                estimate_gaussian_parameters(self.replicate(self.X), self.replicate(self.z), k=3, cov_type=cov_type),
+            )
+
+    def test_segmented(self):
+        sub = self.r[:, :2].argmax(dim=1)
+        self.assertParamsEqual(
+            estimate_gaussian_parameters_segmented(self.X, self.z, 3, sub, weights=self.weights.double(), c=2),
+            estimate_gaussian_parameters_segmented(
+                self.replicate(self.X), self.replicate(self.z), 3, self.replicate(sub), c=2
+            ),
+        )
+
+    def test_sparse(self):
+        r, idx = self.r.topk(2, dim=1)
+        self.assertParamsEqual(
+            estimate_gaussian_parameters_sparse(self.X, idx, r, 3, weights=self.weights.double()),
+            estimate_gaussian_parameters_sparse(
+                self.replicate(self.X), self.replicate(idx), self.replicate(r), 3
+            ),
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,19 @@
+source activate.sh
+
+ARGS_CMD="python ml/ml/executors"
+ARGS_BASE="--project=MGTCOM2 --embedding_visualizer.dim_reduction_mode=TSNE --embedding_visualizer.interval=100 --classification_eval.interval=100 --clustering_visualizer.interval=100"
+
+# Time (fit_time) versus clustering quality of fitting on weighted coresets of increasing size. Coreset weights sum to
+# the number of points in expectation, the last run rescales them to the coreset size instead (--coreset_rescale)
+EXPERIMENT="$ARGS_CMD/mgcom_comdet_executor.py --dataset=DBLPHCN --experiment=abl_coreset $ARGS_BASE --max_epochs=1000 --batch_size=400 \
+  --pretrained_path=/data/pella/projects/University/Thesis/Thesis/source/config/ablations/dblp_embeddings_hetero.pt --cpu \
+  --init_k=3 --prior_sigma_scale=0.5 --prior_alpha=10 --prior_nu=65 --prior_kappa=1"
+
+for i in `seq 1 3`; do
+    $(echo $EXPERIMENT) --run_name="full"
+    $(echo $EXPERIMENT) --run_name="m=1000"  --coreset_size=1000
+    $(echo $EXPERIMENT) --run_name="m=2500"  --coreset_size=2500
+    $(echo $EXPERIMENT) --run_name="m=5000"  --coreset_size=5000
+    $(echo $EXPERIMENT) --run_name="m=10000" --coreset_size=10000
+    $(echo $EXPERIMENT) --run_name="m=2500,rescale" --coreset_size=2500 --coreset_rescale=true
+done